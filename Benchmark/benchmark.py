@@ -0,0 +1,229 @@
+"""
+Benchmark the stages of the pipeline
+
+Run each stage in its own process on the raw data of --data (e.g. written by
+generate.py) and record its time, the peak RSS of the process and the rows
+per second:
+    load              the categories, load_data and prepare of the raw splits
+    time_features     add_time_features
+    velocity          add_velocity_features, the rolling windows of chid/cano
+    family_{key}      the window aggregations of every feature of a key
+    segments_{key}    the same over a segment index of chid/cano/mchno, built
+                      in the stage
+    features          add_features of every feature (--keep-all)
+    drop_columns      drop_columns of --threshold, writes real_*.arrow
+    train             Model/train.py
+    inference         Model/inference.py
+Every stage reads the output of the stage before it from --data/benchmark/.
+--save writes the results as JSON and --baseline compares them with saved
+results, a stage slower or larger than the baseline by more than --tolerance
+is a regression and the exit code is 1.
+"""
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+import polars as pl
+
+# The stages run the code of the repository
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(root)
+sys.path.append(os.path.join(root, "Preprocess"))
+from categories import Categories, categories_path
+from feature_spec import add_features, build_feature_spec, keyed_aggregations
+from pipeline import write_splits
+from preprocess_utils import (
+    categorical_cols,
+    drop_columns,
+    load_data,
+    prepare,
+    raw_splits,
+)
+from segments import SegmentIndex, segment_features, segment_keys
+from time_features import add_time_features
+from velocity_features import add_velocity_features
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--data", default=".", help="Directory of the raw data")
+parser.add_argument("--stages", nargs="+", default=None, help="All stages by default")
+parser.add_argument("--threshold", type=float, default=0.02)
+parser.add_argument(
+    "--prev-loctm",
+    default="broadcast",
+    choices=["broadcast", "per_row"],
+    help="prev_loctm of the time_features stage",
+)
+parser.add_argument("--train-args", default="--folds 2", help="Arguments of train.py")
+parser.add_argument("--inference-args", default="", help="Arguments of inference.py")
+parser.add_argument("--save", default=None, help="Write the results to this JSON")
+parser.add_argument("--baseline", default=None, help="Compare with these results")
+parser.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.2,
+    help="Relative increase of time or peak RSS reported as a regression",
+)
+parser.add_argument("--run-stage", default=None, help=argparse.SUPPRESS)
+
+spec = build_feature_spec()
+keys = list(dict.fromkeys(f.key for f in spec if f.key is not None))
+stages = (
+    ["load", "time_features", "velocity"]
+    + [f"family_{key}" for key in keys]
+    + [f"segments_{key}" for key in segment_keys if key in keys]
+    + ["features", "drop_columns", "train", "inference"]
+)
+
+
+def run_stage(stage: str, args):
+    """Run an in-process stage, return its seconds and rows."""
+    work = os.path.join(args.data, "benchmark")
+    if stage == "load":
+        start = time.perf_counter()
+        df = [
+            load_data(path=os.path.join(args.data, path), mode=mode, lazy=True)
+            for mode, path in raw_splits.items()
+        ]
+        df = pl.concat(df, how="diagonal")
+        categories = Categories(categorical_cols).update(df)
+        df = prepare(df, categories).collect()
+        seconds = time.perf_counter() - start
+        df.write_ipc(os.path.join(work, "prepared.arrow"))
+        # The codes of the outputs, read by train.py and inference.py
+        categories.save(os.path.join(args.data, categories_path))
+        return seconds, df.height
+
+    if stage == "time_features":
+        df = pl.read_ipc(os.path.join(work, "prepared.arrow"))
+        start = time.perf_counter()
+        df = add_time_features(df, prev_loctm=args.prev_loctm)
+        seconds = time.perf_counter() - start
+        df.write_ipc(os.path.join(work, "time.arrow"))
+        return seconds, df.height
+
+    if stage == "velocity":
+        df = pl.read_ipc(os.path.join(work, "prepared.arrow"))
+        start = time.perf_counter()
+        add_velocity_features(df)
+        return time.perf_counter() - start, df.height
+
+    df = pl.read_ipc(os.path.join(work, "time.arrow"))
+    if stage.startswith("family_"):
+        key = stage[len("family_") :]
+        exprs, _ = keyed_aggregations(spec, key)
+        start = time.perf_counter()
+        df.select([expr.over(key) for expr in exprs])
+        return time.perf_counter() - start, df.height
+
+    if stage.startswith("segments_"):
+        key = stage[len("segments_") :]
+        start = time.perf_counter()
+        index = SegmentIndex.build(df[key])
+        segment_features(df, [f for f in spec if f.key == key], index)
+        return time.perf_counter() - start, df.height
+
+    if stage == "features":
+        start = time.perf_counter()
+        df = add_features(df, spec)
+        seconds = time.perf_counter() - start
+        df.write_ipc(os.path.join(work, "features.arrow"))
+        return seconds, df.height
+
+    if stage == "drop_columns":
+        df = pl.read_ipc(os.path.join(work, "features.arrow"))
+        start = time.perf_counter()
+        df = drop_columns(df, args.threshold)
+        seconds = time.perf_counter() - start
+        # The inputs of train.py and inference.py
+        write_splits(df, args.data)
+        return seconds, df.height
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def measure(stage: str, args):
+    """Run a stage in a new process, return its time, peak RSS and rows."""
+    if stage in ["train", "inference"]:
+        script = os.path.join(root, "Model", f"{stage}.py")
+        stage_args = args.train_args if stage == "train" else args.inference_args
+        command = [sys.executable, script] + shlex.split(stage_args)
+        cwd = args.data
+    else:
+        command = [sys.executable, os.path.abspath(__file__), "--run-stage", stage]
+        command += ["--data", args.data, "--threshold", str(args.threshold)]
+        command += ["--prev-loctm", args.prev_loctm]
+        cwd = None
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, text=True)
+    output = process.stdout.read()
+    # The resource usage of the process, with the children it waited for
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError(f"{stage} failed:\n{output}")
+
+    if stage in ["train", "inference"]:
+        splits = ["train", "valid"] if stage == "train" else ["valid", "test"]
+        paths = [os.path.join(args.data, f"real_{s}.arrow") for s in splits]
+        rows = sum(pl.read_ipc(path, memory_map=True).height for path in paths)
+    else:
+        # The time of the stage itself, without the start of Python and the I/O
+        seconds, rows = json.loads(output.strip().splitlines()[-1])
+    return {
+        "seconds": seconds,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "rows": rows,
+        "rows_per_s": rows / seconds,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """Print the ratios to the baseline, return the regressed stages."""
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        base = baseline[stage]
+        if base["rows"] != result["rows"]:
+            print(f"{stage}: {result['rows']} rows, the baseline has {base['rows']}")
+        time_ratio = result["seconds"] / base["seconds"]
+        rss_ratio = result["peak_rss_mb"] / base["peak_rss_mb"]
+        regressed = max(time_ratio, rss_ratio) > 1 + tolerance
+        print(
+            f"{stage:24} time x{time_ratio:.2f}  peak RSS x{rss_ratio:.2f}"
+            + ("  REGRESSION" if regressed else "")
+        )
+        if regressed:
+            regressions.append(stage)
+    return regressions
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.run_stage is not None:
+        print(json.dumps(run_stage(args.run_stage, args)))
+        sys.exit()
+
+    os.makedirs(os.path.join(args.data, "benchmark"), exist_ok=True)
+    results = {}
+    print(f"{'stage':24} {'seconds':>9} {'peak RSS MB':>12} {'rows/s':>12}")
+    for stage in args.stages or stages:
+        result = results[stage] = measure(stage, args)
+        print(
+            f"{stage:24} {result['seconds']:9.2f} {result['peak_rss_mb']:12.0f} "
+            f"{result['rows_per_s']:12,.0f}"
+        )
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
@@ -0,0 +1,191 @@
+"""
+Generate synthetic raw data in the schema of the competition data
+
+Write dataset_1st/training.csv, dataset_2nd/public.csv,
+dataset_2nd/private_1.csv, private_2_processed.csv and 31_範例繳交檔案.csv
+under --output, so every script runs on them like on the private data. The
+rows are generated in chunks of --chunk-size with vectorized NumPy, from 10^5
+to 10^8 rows, and the same --seed and --rows always give the same files.
+
+The ids are hashed strings of skewed cardinalities (a few chids and merchants
+have most transactions, a chid has one to three cards), most transactions are
+domestic and the null rates follow the raw data (stscd is mostly null).
+"""
+import argparse
+import os
+
+import numpy as np
+import polars as pl
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--rows", type=int, default=1_000_000, help="Rows of training.csv"
+)
+parser.add_argument(
+    "--test-fraction",
+    type=float,
+    default=0.125,
+    help="Rows of public.csv, private_1.csv and private_2_processed.csv each, as "
+    "a fraction of --rows",
+)
+parser.add_argument(
+    "--days", type=int, default=56, help="Days (locdt) of training.csv"
+)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--chunk-size", type=int, default=1_000_000)
+parser.add_argument("--output", default=".")
+
+# Distinct values per training row of the id columns, at least 10 values
+id_ratios = {"chid": 0.07, "mchno": 0.025, "acqic": 0.001}
+# Null rates of the columns with missing values
+null_rates = {
+    "etymd": 0.02,
+    "mcc": 0.01,
+    "stocn": 0.005,
+    "scity": 0.02,
+    "stscd": 0.98,
+    "hcefg": 0.01,
+    "csmcu": 0.01,
+}
+# Rate of the binary flags
+flag_rates = {
+    "ecfg": 0.2,
+    "insfg": 0.02,
+    "bnsfg": 0.01,
+    "ovrlt": 0.01,
+    "flbmk": 0.002,
+    "flg_3dsmk": 0.05,
+}
+
+
+def mix(x: np.ndarray):
+    """SplitMix64 finalizer, a bijection of uint64."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+# The two hex digits of each byte
+hex_digits = np.array([f"{i:02x}".encode() for i in range(256)], dtype="S2")
+
+
+def hashed_ids(index: np.ndarray, salt: int):
+    """Return 64 hex digit strings of the integer ids, like the hashed raw ids."""
+    x = index.astype(np.uint64) + np.uint64(salt << 40)
+    words = [x := mix(x ^ np.uint64(0x9E3779B97F4A7C15)) for _ in range(4)]
+    data = np.stack(words, axis=1).astype(">u8").view(np.uint8)
+    strings = hex_digits[data].view("S64").ravel()
+    return pl.Series(strings.astype("U64"))
+
+
+def skewed(rng: np.random.Generator, n: int, k: int, power: float):
+    """Draw n integers in [0, k), the small ones are drawn much more often."""
+    return np.minimum((k * rng.random(n) ** power).astype(np.int64), k - 1)
+
+
+def with_nulls(rng: np.random.Generator, values: np.ndarray, rate: float):
+    series = pl.Series(values)
+    return series.set(pl.Series(rng.random(len(values)) < rate), None)
+
+
+def chunk(rng: np.random.Generator, start: int, n: int, cards: dict, days: tuple):
+    """Return n transactions, start is the index of the first one."""
+    chid = skewed(rng, n, cards["chid"], 1.5)
+    # One to three cards per chid, the first card is used the most
+    cano = chid * 3 + skewed(rng, n, 3, 4.0)
+    mchno = skewed(rng, n, cards["mchno"], 2.5)
+    # The acquirer follows the merchant
+    acqic = mix(mchno.astype(np.uint64)) % np.uint64(cards["acqic"])
+    domestic = rng.random(n) < 0.85
+    stocn = np.where(domestic, 0, skewed(rng, n, 140, 1.5) + 1)
+    scity = np.where(domestic, skewed(rng, n, 30, 2.0), rng.integers(30, 12_000, n))
+    csmcu = np.where(domestic, 0, skewed(rng, n, 80, 1.5) + 1)
+    conam = np.round(rng.lognormal(6.5, 1.3, n), 2)
+    flags = {c: (rng.random(n) < p).astype(np.int8) for c, p in flag_rates.items()}
+    iterm = np.where(flags["insfg"] == 1, rng.choice([3, 6, 12, 24], n), 0)
+    seconds = rng.integers(0, 24 * 60 * 60, n)
+    df = pl.DataFrame(
+        {
+            "txkey": hashed_ids(np.arange(start, start + n), 1),
+            "locdt": rng.integers(days[0], days[1], n),
+            # hhmmss as an integer, without leading zeros like the raw data
+            "loctm": seconds // 3600 * 10000 + seconds // 60 % 60 * 100 + seconds % 60,
+            "chid": hashed_ids(chid, 2),
+            "cano": hashed_ids(cano, 3),
+            "contp": skewed(rng, n, 7, 3.0),
+            "etymd": with_nulls(rng, skewed(rng, n, 11, 2.0), null_rates["etymd"]),
+            "mchno": hashed_ids(mchno, 4),
+            "acqic": hashed_ids(acqic, 5),
+            "mcc": with_nulls(rng, skewed(rng, n, 500, 2.0), null_rates["mcc"]),
+            "conam": conam,
+            "ecfg": flags["ecfg"],
+            "insfg": flags["insfg"],
+            "iterm": iterm,
+            "bnsfg": flags["bnsfg"],
+            # The amount in the currency of the transaction
+            "flam1": np.round(conam * np.where(domestic, 1, rng.uniform(0.1, 40, n)))
+            .astype(np.int64),
+            "stocn": with_nulls(rng, stocn, null_rates["stocn"]),
+            "scity": with_nulls(rng, scity, null_rates["scity"]),
+            "stscd": with_nulls(rng, rng.integers(0, 3, n), null_rates["stscd"]),
+            "ovrlt": flags["ovrlt"],
+            "flbmk": flags["flbmk"],
+            "hcefg": with_nulls(rng, skewed(rng, n, 10, 2.0), null_rates["hcefg"]),
+            "csmcu": with_nulls(rng, csmcu, null_rates["csmcu"]),
+            "flg_3dsmk": flags["flg_3dsmk"],
+        }
+    )
+    # About 0.4% frauds, more likely abroad, online and for large amounts
+    logit = -7 + 2.5 * ~domestic + 1.5 * flags["ecfg"] + 1.0 * (conam > 3000)
+    label = rng.random(n) < 1 / (1 + np.exp(-logit))
+    return df.with_columns(label=pl.Series(label.astype(np.int8)))
+
+
+def write_split(
+    path: str, rows: int, offset: int, split: int, days: tuple, keys, args
+):
+    """
+    Write a split in chunks, the last split without label. The txkeys of the
+    splits to predict are written to keys, the sample submission.
+    """
+    cards = {c: max(10, int(r * args.rows)) for c, r in id_ratios.items()}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        for i, start in enumerate(range(0, rows, args.chunk_size)):
+            # One generator per chunk, a chunk does not depend on the others
+            rng = np.random.default_rng([args.seed, split, i])
+            n = min(args.chunk_size, rows - start)
+            df = chunk(rng, offset + start, n, cards, days)
+            if split == len(splits) - 1:
+                df = df.drop("label")
+            if keys is not None:
+                submission = df.select("txkey", pred=pl.lit(0))
+                keys.write(submission.write_csv(include_header=keys.tell() == 0))
+            f.write(df.write_csv(include_header=i == 0))
+    print(f"{path}: {rows} rows")
+
+
+# Split files, their days and rows as fractions of --days and --rows, and if
+# they are predicted by inference.py. Each later split covers the next days
+# like the competition data
+splits = [
+    ("dataset_1st/training.csv", (0, 1), 1, False),
+    ("dataset_2nd/public.csv", (1, 1 + 1 / 14), None, True),
+    ("dataset_2nd/private_1.csv", (1 + 1 / 14, 1 + 2 / 14), None, False),
+    ("private_2_processed.csv", (1 + 2 / 14, 1 + 3 / 14), None, True),
+]
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    os.makedirs(args.output, exist_ok=True)
+    offset = 0
+    # The sample submission lists the txkeys to predict
+    with open(os.path.join(args.output, "31_範例繳交檔案.csv"), "w") as keys:
+        for split, (path, (first, last), fraction, predicted) in enumerate(splits):
+            rows = int(args.rows * (fraction or args.test_fraction))
+            days = (round(first * args.days), max(round(last * args.days), 1))
+            path = os.path.join(args.output, path)
+            write_split(
+                path, rows, offset, split, days, keys if predicted else None, args
+            )
+            offset += rows
@@ -0,0 +1,97 @@
+"""
+Benchmark the latency of the model predictions by batch size
+
+Predict batches of real_test.arrow with every xgb_fold*.json of --data, once
+with XGBoost (a DMatrix and Booster.predict, like model_utils.predict) and once
+with the NumPy evaluator of Model/tree_ensemble.py, and print the median time
+of a batch and the rows per second of each batch size. The rows are repeated
+when the data has fewer rows than a batch. The largest difference between the
+probabilities of the two is printed first, the exit code is 1 above
+--tolerance.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(root, "Model"))
+from model_utils import load_arrow, load_model, predict, to_numpy
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--data", default=".", help="Directory of the models and data")
+parser.add_argument(
+    "--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 10_000, 100_000]
+)
+parser.add_argument(
+    "--seconds", type=float, default=1.0, help="Time spent on each batch size"
+)
+parser.add_argument(
+    "--threads", type=int, default=1, help="nthread of the XGBoost models"
+)
+parser.add_argument("--tolerance", type=float, default=1e-5)
+
+
+def median_seconds(function, seconds: float):
+    """Run function until seconds have passed (at least 3 times), return the median."""
+    times = []
+    start = time.perf_counter()
+    while len(times) < 3 or time.perf_counter() - start < seconds:
+        begin = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - begin)
+    return float(np.median(times))
+
+
+def evaluate(ensembles: list, X: np.ndarray):
+    """Predict X with every evaluator, the matrix is shared by the folds."""
+    return [ensemble.predict(X) for ensemble in ensembles]
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    paths = sorted(glob.glob(os.path.join(args.data, "xgb_fold*.json")))
+    if not paths:
+        raise FileNotFoundError(f"No xgb_fold*.json in {args.data}")
+    df = load_arrow([os.path.join(args.data, "real_test.arrow")])
+    boosters, ensembles = [], []
+    for path in paths:
+        booster = load_model(path)
+        booster.set_param({"nthread": args.threads})
+        boosters.append(booster)
+        ensembles.append(load_model(path, "numpy"))
+    columns = boosters[0].feature_names
+    # Repeat the rows up to the largest batch
+    rows = np.arange(max(args.batch_sizes)) % df.height
+    df = df[rows]
+    X = to_numpy(df, columns)
+
+    difference = max(
+        np.abs(ensemble.predict(X) - predict(booster, df, columns)).max()
+        for booster, ensemble in zip(boosters, ensembles)
+    )
+    print(f"{len(paths)} models, largest difference of probabilities {difference:.2e}")
+    print(
+        f"{'batch':>8} {'xgboost ms':>11} {'numpy ms':>10} {'xgboost rows/s':>15} "
+        f"{'numpy rows/s':>13}"
+    )
+    for size in args.batch_sizes:
+        batch = df.slice(0, size)
+        # Both from the rows of the batch, the conversion to NumPy included:
+        # model_utils.predict converts for every model, the evaluators share
+        # one conversion
+        xgboost = median_seconds(
+            lambda: [predict(b, batch, columns) for b in boosters], args.seconds
+        )
+        numpy = median_seconds(
+            lambda: evaluate(ensembles, to_numpy(batch, columns)), args.seconds
+        )
+        print(
+            f"{size:8} {xgboost * 1000:11.3f} {numpy * 1000:10.3f} "
+            f"{size / xgboost:15,.0f} {size / numpy:13,.0f}"
+        )
+    if difference > args.tolerance:
+        sys.exit(1)
@@ -1,48 +1,123 @@
 """
 Inference and save csv to submit
+
+The validation/test data is predicted batch by batch: each memory-mapped batch
+is joined with the submit keys, predicted by every fold model and appended to
+submit.csv, so the memory does not grow with the size of the test data.
 """
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import os
+
 import numpy as np
 import polars as pl
-import xgboost as xgb
-
-df_valid = pl.read_csv("valid.csv", ignore_errors=True)
-# Drop the validation label to align with test data
-df_valid = df_valid.drop("label")
+from model_utils import (
+    decision_threshold,
+    feature_columns,
+    load_arrow,
+    load_model,
+    predict,
+)
+from categories import Categories
+import profiling
 
-df_test = pl.read_csv("test.csv", ignore_errors=True)
-df = pl.concat([df_valid, df_test])
-df = df.with_columns(
-    pl.col("stscd").cast(pl.Categorical),
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--batch-size", type=int, default=100_000, help="Rows predicted per batch"
 )
-# Load submit example data
-df_keys = pl.read_csv("31_範例繳交檔案.csv", ignore_errors=True)
-print(df.shape)
-# Map validation/test data to submit example data
-df = df.filter(pl.col("txkey").is_in(df_keys["txkey"]))
-print(df.shape)
-print(df_keys.shape)
-# Drop the keys of transactions
-x_test = df.drop("txkey").to_pandas()
-
-# Load the best iteration model for validation/test data prediction
-y_preds = []
-for i in range(1):
-    model2 = xgb.XGBClassifier()
-    model2.load_model(f"xgb_fold{i}.json")
-    y_preds.append(
-        model2.predict(x_test, iteration_range=(0, model2.best_iteration + 1))
-    )
-
-# Aggregate the predictions as a matrix
-y_preds = np.vstack(y_preds)
-# Take the mean of predictions and round to 0 or 1
-y_pred = np.mean(y_preds, axis=0)
-y_pred = np.round(y_pred)
-
-# Save predictions as submit.csv
-submit_df = pl.DataFrame({"txkey": df["txkey"], "pred": y_pred})
-submit_df = submit_df.with_columns(
-    pl.col("pred").cast(int),
+parser.add_argument(
+    "--threads",
+    type=int,
+    default=os.cpu_count(),
+    help="Batches predicted at the same time",
+)
+parser.add_argument(
+    "--engine",
+    choices=["xgboost", "numpy"],
+    default="xgboost",
+    help="Predict with XGBoost or with the NumPy evaluator of tree_ensemble.py",
 )
-print(submit_df["pred"].value_counts())
-submit_df.write_csv("submit.csv")
+parser.add_argument(
+    "--profile",
+    default=None,
+    help="Write the time, CPU time, peak memory and shapes of every batch to this "
+    "Chrome trace JSON",
+)
+args = parser.parse_args()
+if args.profile is not None:
+    profiling.enable(args.profile)
+
+# Memory-map the preprocessed data, the dtypes and categoricals are kept. Only
+# the pages of the batches being predicted are read from disk
+df_valid = load_arrow(["real_valid.arrow"])
+df_test = load_arrow(["real_test.arrow"])
+# Load submit example data, the semi joins build a hash table of its keys
+df_keys = pl.read_csv("31_範例繳交檔案.csv", columns=["txkey"])
+print(df_keys.shape)
+# The model input columns, without the keys of transactions
+columns = feature_columns(df_test)
+
+# The codes of the categorical columns of real_*.arrow
+categories = Categories.load()
+
+# Load the best iteration model of every fold for validation/test data prediction
+models = []
+for path in sorted(glob.glob("xgb_fold*.json")):
+    model2 = load_model(path, args.engine)
+    # The model reads the codes it was trained on
+    categories.check(model2.attr("categories_version"))
+    if args.engine == "xgboost":
+        # The batches run in parallel, one thread per batch
+        model2.set_param({"nthread": 1})
+    models.append(model2)
+
+# The threshold of the best out-of-fold F1-score, saved by train.py
+threshold = decision_threshold(models)
+print(f"{len(models)} models, threshold {threshold:.4f}")
+
+
+def batches():
+    for mode, df in [("valid", df_valid), ("test", df_test)]:
+        for offset in range(0, df.height, args.batch_size):
+            # Slicing a DataFrame is zero-copy
+            yield f"{mode}_{offset // args.batch_size}", df.slice(
+                offset, args.batch_size
+            )
+
+
+def predict_batch(name: str, batch: pl.DataFrame):
+    with profiling.step(f"batch_{name}", batch) as s:
+        # Map the batch to submit example data
+        batch = batch.join(df_keys, on="txkey", how="semi")
+        y_probs = [predict(model2, batch, columns) for model2 in models]
+        # Take the mean probability of the folds and apply the threshold
+        y_pred = np.mean(np.vstack(y_probs), axis=0) >= threshold
+        submit_df = pl.DataFrame({"txkey": batch["txkey"], "pred": y_pred.astype(int)})
+        s.output(submit_df)
+    return submit_df
+
+
+counts = {0: 0, 1: 0}
+
+
+def write(f, submit_df: pl.DataFrame):
+    f.write(submit_df.write_csv(include_header=False))
+    for pred in counts:
+        counts[pred] += (submit_df["pred"] == pred).sum()
+
+
+# Save predictions as submit.csv, the batches are appended in order and at most
+# 2 x threads batches are in flight
+with ThreadPoolExecutor(args.threads) as pool, open("submit.csv", "w") as f:
+    f.write("txkey,pred\n")
+    pending = deque()
+    for name, batch in batches():
+        pending.append(pool.submit(predict_batch, name, batch))
+        while pending and (len(pending) > 2 * args.threads or pending[0].done()):
+            write(f, pending.popleft().result())
+    for future in pending:
+        write(f, future.result())
+print(counts)
+profiling.save()
@@ -0,0 +1,53 @@
+"""
+Load generator of serve.py
+
+Send transactions of a raw csv one per request from concurrent clients, then
+print the latency and throughput seen by the clients and by the service.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+import urllib.request
+
+import numpy as np
+import polars as pl
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--url", default="http://127.0.0.1:8000")
+parser.add_argument(
+    "--data",
+    default="dataset_2nd/private_1.csv",
+    help="Raw csv in the training.csv schema, the label is not sent",
+)
+parser.add_argument("--requests", type=int, default=1000)
+parser.add_argument("--concurrency", type=int, default=16)
+args = parser.parse_args()
+
+df = pl.read_csv(args.data, n_rows=args.requests)
+records = df.drop([c for c in ["label"] if c in df.columns]).to_dicts()
+
+
+def score(record: dict):
+    request = urllib.request.Request(
+        f"{args.url}/score",
+        data=json.dumps(record).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+start = time.perf_counter()
+with ThreadPoolExecutor(args.concurrency) as pool:
+    latencies = np.array(list(pool.map(score, records)))
+seconds = time.perf_counter() - start
+
+print(f"{len(records)} requests from {args.concurrency} clients in {seconds:.2f}s")
+print(f"Client p50: {np.percentile(latencies, 50) * 1000:.1f} ms")
+print(f"Client p99: {np.percentile(latencies, 99) * 1000:.1f} ms")
+print(f"Client throughput: {len(records) / seconds:.1f} requests/s")
+with urllib.request.urlopen(f"{args.url}/stats") as response:
+    print("Service:", json.loads(response.read()))
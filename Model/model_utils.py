@@ -0,0 +1,327 @@
+import os
+import sys
+import time
+
+import numpy as np
+import polars as pl
+from sklearn.model_selection import StratifiedKFold
+import xgboost as xgb
+
+# The profiling hooks are shared with the preprocessing
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Preprocess")
+)
+import profiling
+from keyed_splits import read_split
+from preprocess_utils import categorical_cols
+from tree_ensemble import TreeEnsemble
+
+# Columns that are not model inputs: keys, label, and the string ids (their
+# information is carried by the count/mean/std features)
+non_feature_cols = ["txkey", "label", "chid", "cano", "mchno", "acqic"]
+# Rows per external memory page. The missing values make the pages of XGBoost
+# 1.7 sparse and every tree level reads all of them, a round over 50,000 rows
+# measured 2.5 s with 5,000-row pages and 7 s with one 50,000-row page
+external_page_rows = 5_000
+
+
+def load_arrow(paths: list):
+    """
+    Memory-map the preprocessed Arrow IPC files as one DataFrame, no copy. The
+    features of real_keyed of a preprocess.py --store run are joined in.
+    """
+    return pl.concat([read_split(p) for p in paths], rechunk=False)
+
+
+def feature_columns(df: pl.DataFrame):
+    """Return the model input columns of the preprocessed data."""
+    return [c for c in df.columns if c not in non_feature_cols]
+
+
+def feature_types(columns: list):
+    """Return the XGBoost feature types, "c" for categorical and "q" otherwise."""
+    return ["c" if c in categorical_cols else "q" for c in columns]
+
+
+def to_numpy(df: pl.DataFrame, columns: list):
+    """
+    Return the columns as a float32 matrix, nulls are NaN. The categorical
+    columns hold the codes of categories.json, used as the categories.
+    """
+    return df.select([pl.col(c).cast(pl.Float32) for c in columns]).to_numpy()
+
+
+class BatchIter(xgb.DataIter):
+    """
+    Feed a DataFrame to XGBoost in batches, only one batch is converted to
+    NumPy at a time. With rows, only these row indices are fed and each batch
+    gathers its own rows. With a cache_prefix, XGBoost writes each batch to a
+    page on disk and streams the pages while training (external memory).
+    """
+
+    def __init__(
+        self,
+        df: pl.DataFrame,
+        columns: list,
+        batch_size: int = 100_000,
+        cache_prefix: str = None,
+        rows: np.ndarray = None,
+    ):
+        self.df = df
+        self.columns = columns
+        self.rows = rows
+        self.types = feature_types(columns)
+        if cache_prefix is not None:
+            # XGBoost 1.7 mislearns categorical splits from external memory
+            # pages (eval logloss 0.063 against 0.039 in memory after 10
+            # rounds), the categories are integer codes so split them as
+            # numbers, which matches the in-memory quality
+            self.types = ["q"] * len(columns)
+        self.batch_size = batch_size
+        self.offset = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        height = self.df.height if self.rows is None else len(self.rows)
+        if self.offset >= height:
+            return 0
+        if self.rows is None:
+            # Slicing a DataFrame is zero-copy
+            batch = self.df.slice(self.offset, self.batch_size)
+        else:
+            batch = self.df[self.rows[self.offset : self.offset + self.batch_size]]
+        input_data(
+            data=to_numpy(batch, self.columns),
+            label=batch["label"].to_numpy() if "label" in batch.columns else None,
+            feature_names=self.columns,
+            feature_types=self.types,
+        )
+        self.offset += self.batch_size
+        return 1
+
+    def reset(self):
+        self.offset = 0
+
+
+def quantile_dmatrix(
+    df: pl.DataFrame,
+    columns: list,
+    ref: xgb.QuantileDMatrix = None,
+    batch_size: int = 100_000,
+    max_bin: int = 256,
+    rows: np.ndarray = None,
+):
+    """
+    Build a QuantileDMatrix batch by batch, an evaluation matrix should pass the
+    training matrix as ref to share its quantile cuts.
+    """
+    return xgb.QuantileDMatrix(
+        BatchIter(df, columns, batch_size, rows=rows),
+        ref=ref,
+        max_bin=max_bin,
+        enable_categorical=True,
+    )
+
+
+def external_dmatrix(
+    df: pl.DataFrame,
+    columns: list,
+    cache_prefix: str,
+    batch_size: int = external_page_rows,
+    rows: np.ndarray = None,
+):
+    """
+    Build a DMatrix in external memory, the batches are written as pages under
+    cache_prefix and only one page is kept in memory at a time, so batch_size
+    bounds the memory of the page cache. Train it with tree_method "hist". The
+    categorical columns are numeric features of the pages (see BatchIter).
+    """
+    return xgb.DMatrix(BatchIter(df, columns, batch_size, cache_prefix, rows))
+
+
+def fold_rows(df: pl.DataFrame, k: int, split: str = "stratified", seed: int = 0):
+    """
+    Return the (fit rows, eval rows) index arrays of k folds.
+
+    split="stratified": shuffled folds with the same fraud ratio.
+    split="time": the days (locdt) are cut into k consecutive blocks, each fold
+    holds out one block so the transactions of a day stay together.
+    """
+    if split == "stratified":
+        skf = StratifiedKFold(n_splits=k, shuffle=True, random_state=seed)
+        y = df["label"].to_numpy()
+        return list(skf.split(np.zeros(len(y)), y))
+    if split == "time":
+        locdt = df["locdt"].to_numpy()
+        days = np.unique(locdt)
+        if len(days) < k:
+            raise ValueError(f"{len(days)} days cannot be split into {k} folds")
+        # Consecutive days share a block, a row is held out with its day
+        block = np.arange(len(days)) * k // len(days)
+        fold = block[np.searchsorted(days, locdt)]
+        return [
+            (np.flatnonzero(fold != i), np.flatnonzero(fold == i)) for i in range(k)
+        ]
+    raise ValueError(f"Unknown split: {split}")
+
+
+def train_fold(
+    i: int,
+    paths: list,
+    fit_rows: np.ndarray,
+    eval_rows: np.ndarray,
+    params: dict,
+    num_boost_round: int,
+    early_stopping_rounds: int,
+    batch_size: int = 100_000,
+    cache_dir: str = None,
+    categories_version: int = None,
+    model_path: str = None,
+):
+    """
+    Train the model of fold i and save it as xgb_fold{i}.json (or model_path),
+    the best iteration and the version of categories.json are stored in the
+    model. With a cache_dir the data is streamed from external memory pages of
+    batch_size rows, otherwise from in-memory batches of batch_size rows. Run
+    in a worker process: the data is memory-mapped again from paths and only
+    the fold rows are gathered, batch by batch. Return the best iteration, the
+    probabilities of the eval rows and the training rows/s.
+    """
+    df = load_arrow(paths)
+    columns = feature_columns(df)
+    rows = len(fit_rows) + len(eval_rows)
+    with profiling.step(f"fold_{i}", rows=rows, columns=len(columns)) as fold:
+        with profiling.step("dmatrix", rows=rows, columns=len(columns)):
+            if cache_dir is not None:
+                prefix = os.path.join(cache_dir, f"fold{i}")
+                dtrain = external_dmatrix(
+                    df, columns, prefix + "_train", batch_size, fit_rows
+                )
+                dvalid = external_dmatrix(
+                    df, columns, prefix + "_valid", batch_size, eval_rows
+                )
+            else:
+                # The evaluation matrix shares the quantile cuts of the training
+                # matrix
+                dtrain = quantile_dmatrix(
+                    df, columns, batch_size=batch_size, rows=fit_rows
+                )
+                dvalid = quantile_dmatrix(
+                    df, columns, ref=dtrain, batch_size=batch_size, rows=eval_rows
+                )
+
+        with profiling.step("train", rows=len(fit_rows), columns=len(columns)):
+            start = time.perf_counter()
+            booster = xgb.train(
+                params,
+                dtrain,
+                num_boost_round=num_boost_round,
+                evals=[(dvalid, "validation_0")],
+                early_stopping_rounds=early_stopping_rounds,
+                verbose_eval=False,
+            )
+            seconds = time.perf_counter() - start
+        # The codes of the categorical columns the model was trained on
+        booster.set_attr(categories_version=str(categories_version))
+        # Save model into JSON format, best_iteration is saved as an attribute
+        booster.save_model(model_path or f"xgb_fold{i}.json")
+        # Throughput as training rows processed per second over all rounds
+        rows_per_second = dtrain.num_row() * booster.num_boosted_rounds() / seconds
+        with profiling.step("predict", rows=len(eval_rows), columns=len(columns)):
+            y_prob = predict(booster, df[eval_rows], columns)
+        fold.output(rows=len(eval_rows), columns=1)
+    return booster.best_iteration, y_prob, rows_per_second
+
+
+def load_model(path: str, engine: str = "xgboost"):
+    """
+    Load a saved xgb_fold{i}.json as an XGBoost Booster, or with engine="numpy"
+    as the NumPy evaluator of tree_ensemble.py. Both predict up to the best
+    iteration with predict() and have feature_names and attr().
+    """
+    if engine == "numpy":
+        return TreeEnsemble.load(path)
+    if engine == "xgboost":
+        booster = xgb.Booster()
+        booster.load_model(path)
+        return booster
+    raise ValueError(f"Unknown engine: {engine}")
+
+
+def predict(booster, df: pl.DataFrame, columns: list):
+    """Predict the probabilities up to the best iteration of the model."""
+    if isinstance(booster, TreeEnsemble):
+        return booster.predict(to_numpy(df, columns))
+    dtest = xgb.DMatrix(
+        to_numpy(df, columns),
+        feature_names=columns,
+        # Use the types the model was trained with (see BatchIter)
+        feature_types=booster.feature_types or feature_types(columns),
+        enable_categorical=True,
+    )
+    return booster.predict(dtest, iteration_range=(0, best_iteration(booster) + 1))
+
+
+def best_iteration(booster: xgb.Booster):
+    """
+    Return the best iteration saved in the attributes of a loaded model, like
+    TreeEnsemble, or its last round if it was trained without early stopping.
+    """
+    best = booster.attr("best_iteration")
+    if best is None:
+        return booster.num_boosted_rounds() - 1
+    return int(best)
+
+
+def f1_curve(y_true: np.ndarray, y_prob: np.ndarray):
+    """
+    Return the F1-scores of the predictions y_prob >= t for every distinct
+    probability t, and the thresholds t in decreasing order. One sort and the
+    cumulative sums of the labels give the true positives of every threshold,
+    so the whole curve costs about one evaluation.
+    """
+    order = np.argsort(-y_prob, kind="stable")
+    y_prob, y_true = y_prob[order], y_true[order]
+    # The last row of each distinct probability: the rows predicted positive
+    # at that threshold are the rows before it
+    last = np.flatnonzero(np.append(y_prob[1:] != y_prob[:-1], True))
+    true_positives = np.cumsum(y_true)[last]
+    # 2 TP / (2 TP + FP + FN), the predicted positives are TP + FP
+    f1 = 2 * true_positives / (last + 1 + y_true.sum())
+    return f1, y_prob[last]
+
+
+def best_threshold(y_true: np.ndarray, y_prob: np.ndarray):
+    """
+    Return the threshold of the best F1-score of y_prob >= threshold and the
+    score. The threshold is halfway to the next lower probability, the
+    probabilities of new data between the two are predicted like the lower one.
+    """
+    if len(y_true) == 0 or y_true.sum() == 0:
+        return 0.5, 0.0
+    f1, thresholds = f1_curve(y_true, y_prob)
+    i = int(np.argmax(f1))
+    threshold = float(thresholds[i])
+    if i + 1 < len(thresholds):
+        threshold = (threshold + float(thresholds[i + 1])) / 2
+    return threshold, float(f1[i])
+
+
+def save_threshold(path: str, threshold: float):
+    """Store the decision threshold in a saved model, read by decision_threshold."""
+    booster = xgb.Booster()
+    booster.load_model(path)
+    booster.set_attr(threshold=repr(threshold))
+    booster.save_model(path)
+
+
+def decision_threshold(models: list):
+    """
+    Return the threshold of the mean probability of the fold models, saved in
+    the models by train.py, 0.5 for the models saved without one.
+    """
+    thresholds = {model.attr("threshold") for model in models}
+    if len(thresholds) > 1:
+        raise ValueError("The models have different thresholds, train them again")
+    threshold = thresholds.pop() if thresholds else None
+    return 0.5 if threshold is None else float(threshold)
@@ -0,0 +1,294 @@
+"""
+Search the XGBoost parameters of train.py
+
+The training and evaluation QuantileDMatrix of one fold (the first of the
+--folds of train.py) are built once and shared by every trial: the trials run
+in threads of this process, --parallel at a time, and --cores are shared among
+them. The first trial has the parameters of train.py, the others are drawn at
+random from search_space. Every trial stops early after --early-stopping-rounds
+rounds without improvement, and is pruned when its best eval metric so far is
+worse than the median of the finished trials at the same round. The history of
+every trial (parameters, state, eval curve, best iteration, F1-score of the
+best threshold, seconds) is written to --output after each trial, train.py
+--params trains with the best parameters.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import xgboost as xgb
+from model_utils import (
+    best_threshold,
+    feature_columns,
+    fold_rows,
+    load_arrow,
+    quantile_dmatrix,
+)
+import profiling
+from train import params as train_params
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--trials", type=int, default=20)
+parser.add_argument(
+    "--parallel", type=int, default=4, help="Trials trained at the same time"
+)
+parser.add_argument(
+    "--cores",
+    type=int,
+    default=os.cpu_count(),
+    help="Cores shared by the parallel trials",
+)
+parser.add_argument("--folds", type=int, default=5, help="The folds of train.py")
+parser.add_argument(
+    "--split", default="stratified", choices=["stratified", "time"]
+)
+parser.add_argument("--num-boost-round", type=int, default=200)
+parser.add_argument("--early-stopping-rounds", type=int, default=20)
+parser.add_argument(
+    "--metric",
+    default="logloss",
+    choices=["logloss", "error", "auc", "aucpr"],
+    help="Eval metric of the early stopping and the pruning",
+)
+parser.add_argument(
+    "--prune-warmup",
+    type=int,
+    default=10,
+    help="Rounds before a trial can be pruned",
+)
+parser.add_argument(
+    "--prune-startup",
+    type=int,
+    default=3,
+    help="Finished trials before any trial is pruned",
+)
+parser.add_argument("--batch-size", type=int, default=100_000)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--output", default="search_history.json")
+parser.add_argument(
+    "--profile",
+    default=None,
+    help="Write the time, CPU time and peak memory of every trial to this Chrome "
+    "trace JSON",
+)
+
+# The parameters searched: (distribution, low, high)
+search_space = {
+    "learning_rate": ("log", 0.02, 0.3),
+    "max_depth": ("int", 4, 12),
+    "min_child_weight": ("log", 1, 100),
+    "subsample": ("uniform", 0.5, 1),
+    "colsample_bytree": ("uniform", 0.5, 1),
+    "reg_lambda": ("log", 0.1, 10),
+}
+# The metrics the larger the better
+maximized_metrics = ["auc", "aucpr"]
+
+
+def sample_params(rng: np.random.Generator):
+    """Draw parameters from search_space."""
+    sampled = {}
+    for name, (distribution, low, high) in search_space.items():
+        if distribution == "int":
+            sampled[name] = int(rng.integers(low, high + 1))
+        elif distribution == "log":
+            sampled[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        else:
+            sampled[name] = float(rng.uniform(low, high))
+    return sampled
+
+
+class MedianPruner:
+    """
+    The best eval metric so far of the finished trials at every round: a trial
+    whose best so far is worse than their median at the same round is pruned.
+    """
+
+    def __init__(self, maximize: bool, warmup: int, startup: int):
+        self.maximize = maximize
+        self.warmup = warmup
+        self.startup = startup
+        self.curves = []
+        self.lock = threading.Lock()
+
+    def best_so_far(self, scores: list):
+        best = np.maximum if self.maximize else np.minimum
+        return best.accumulate(np.asarray(scores, np.float64))
+
+    def add(self, scores: list):
+        """Add the eval metric of every round of a finished trial."""
+        if scores:
+            with self.lock:
+                self.curves.append(self.best_so_far(scores))
+
+    def prune(self, scores: list):
+        """Return True if a running trial with these scores should stop."""
+        i = len(scores) - 1
+        if i < self.warmup:
+            return False
+        with self.lock:
+            if len(self.curves) < self.startup:
+                return False
+            # A trial that stopped early keeps its best score afterwards
+            median = np.median([curve[min(i, len(curve) - 1)] for curve in self.curves])
+        best = self.best_so_far(scores)[-1]
+        return best < median if self.maximize else best > median
+
+
+class Pruning(xgb.callback.TrainingCallback):
+    """Stop the training of a trial when the pruner says so."""
+
+    def __init__(self, pruner: MedianPruner, data: str, metric: str):
+        self.pruner = pruner
+        self.data = data
+        self.metric = metric
+        self.pruned = False
+        super().__init__()
+
+    def after_iteration(self, model, epoch: int, evals_log: dict):
+        self.pruned = self.pruner.prune(evals_log[self.data][self.metric])
+        return self.pruned
+
+
+def run_trial(
+    i: int,
+    trial_params: dict,
+    dtrain: xgb.QuantileDMatrix,
+    dvalid: xgb.QuantileDMatrix,
+    pruner: MedianPruner,
+    args,
+):
+    """Train a trial on the shared matrices, return its history entry."""
+    trial_params = {
+        **trial_params,
+        "eval_metric": args.metric,
+        "nthread": max(1, args.cores // args.parallel),
+    }
+    pruning = Pruning(pruner, "validation_0", args.metric)
+    evals_result = {}
+    start = time.perf_counter()
+    with profiling.step(f"trial_{i}", rows=dtrain.num_row(), columns=dtrain.num_col()):
+        booster = xgb.train(
+            trial_params,
+            dtrain,
+            num_boost_round=args.num_boost_round,
+            evals=[(dvalid, "validation_0")],
+            evals_result=evals_result,
+            early_stopping_rounds=args.early_stopping_rounds,
+            callbacks=[pruning],
+            verbose_eval=False,
+        )
+    seconds = time.perf_counter() - start
+    scores = evals_result["validation_0"][args.metric]
+    trial = {
+        "trial": i,
+        "params": trial_params,
+        "state": "pruned" if pruning.pruned else "complete",
+        "rounds": len(scores),
+        "best_iteration": booster.best_iteration,
+        "best_score": booster.best_score,
+        "seconds": seconds,
+        "rounds_per_s": len(scores) / seconds,
+        "scores": scores,
+    }
+    if not pruning.pruned:
+        pruner.add(scores)
+        # The F1-score of the best threshold on the eval rows
+        y_prob = booster.predict(
+            dvalid, iteration_range=(0, booster.best_iteration + 1)
+        )
+        trial["threshold"], trial["f1"] = best_threshold(dvalid.get_label(), y_prob)
+    return trial
+
+
+def best_trial(trials: list, maximize: bool):
+    """Return the complete trial with the best eval metric."""
+    complete = [t for t in trials if t["state"] == "complete"]
+    if not complete:
+        return None
+    scores = [t["best_score"] for t in complete]
+    return complete[int(np.argmax(scores) if maximize else np.argmin(scores))]
+
+
+def save_history(path: str, history: dict):
+    # Write then rename, the history of the finished trials is never lost
+    with open(path + ".tmp", "w") as f:
+        json.dump(history, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.profile is not None:
+        profiling.enable(args.profile)
+    args.parallel = max(1, min(args.parallel, args.cores, args.trials))
+    os.environ["POLARS_MAX_THREADS"] = str(args.cores)
+
+    # The matrices are quantized once, every trial reuses them
+    df = load_arrow(["real_train.arrow", "real_valid.arrow"])
+    columns = feature_columns(df)
+    fit_rows, eval_rows = fold_rows(df, args.folds, args.split)[0]
+    start = time.perf_counter()
+    with profiling.step("dmatrix", df):
+        dtrain = quantile_dmatrix(
+            df, columns, batch_size=args.batch_size, rows=fit_rows
+        )
+        dvalid = quantile_dmatrix(
+            df, columns, ref=dtrain, batch_size=args.batch_size, rows=eval_rows
+        )
+    dmatrix_seconds = time.perf_counter() - start
+    print(
+        f"DMatrix of {len(fit_rows)} + {len(eval_rows)} rows in "
+        f"{dmatrix_seconds:.1f}s, {args.trials} trials, {args.parallel} parallel x "
+        f"{max(1, args.cores // args.parallel)} threads"
+    )
+
+    rng = np.random.default_rng(args.seed)
+    # The first trial is the parameters of train.py
+    candidates = [dict(train_params)] + [
+        {**train_params, **sample_params(rng)} for _ in range(args.trials - 1)
+    ]
+    maximize = args.metric in maximized_metrics
+    pruner = MedianPruner(maximize, args.prune_warmup, args.prune_startup)
+    history = {
+        "metric": args.metric,
+        "num_boost_round": args.num_boost_round,
+        "rows": {"train": len(fit_rows), "eval": len(eval_rows)},
+        "dmatrix_seconds": dmatrix_seconds,
+        "trials": [],
+        "best": None,
+    }
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.parallel) as pool:
+        futures = [
+            pool.submit(run_trial, i, p, dtrain, dvalid, pruner, args)
+            for i, p in enumerate(candidates)
+        ]
+        for future in as_completed(futures):
+            trial = future.result()
+            print(
+                f"Trial {trial['trial']}: {trial['state']}, {trial['rounds']} "
+                f"rounds, best {args.metric} {trial['best_score']:.5f}, "
+                f"{trial['seconds']:.1f}s"
+            )
+            history["trials"].append(trial)
+            history["trials"].sort(key=lambda t: t["trial"])
+            history["best"] = best_trial(history["trials"], maximize)
+            history["search_seconds"] = time.perf_counter() - start
+            save_history(args.output, history)
+
+    best = history["best"]
+    pruned = sum(t["state"] == "pruned" for t in history["trials"])
+    print(f"{pruned} of {args.trials} trials pruned")
+    profiling.save()
+    if best is None:
+        # train.py --params refuses this history too
+        print(f"No trial completed, history written to {args.output}")
+        sys.exit(1)
+    print(f"Best trial {best['trial']}: {args.metric} {best['best_score']:.5f}")
+    print(f"Parameters: {best['params']}, history written to {args.output}")
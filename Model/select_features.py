@@ -0,0 +1,309 @@
+"""
+Select the features of the model
+
+Rank the features of the feature spec in real_*.arrow by the importance of
+the trained xgb_fold*.json models (the mean of their shares of the total gain
+and of the total cover), drop the features the trees never split on, and
+cluster the others by their pairwise |Spearman correlation|: a feature
+correlated above --corr-threshold with a more important feature joins its
+cluster and is redundant, only the most important feature of a cluster is
+kept. The representatives of the clusters are then
+added in order of importance, and the smallest number of them whose F1-score
+(at the best threshold, on the first fold of train.py) is within
+--target-f1-loss of the F1-score of every column is found by a binary search.
+The raw columns and the time features are always kept.
+
+The removed features are written to feature_selection.json in the working
+directory. preprocess.py, pipeline.py and serve.py run with
+--selection feature_selection.json add them to excluded_columns of
+preprocess_utils.py and no longer compute them, without --selection every
+feature is computed. The training, inference and preprocessing (add_features of the raw
+splits) times of every column and of the selected columns are reported.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import polars as pl
+import xgboost as xgb
+from model_utils import (
+    best_threshold,
+    feature_columns,
+    fold_rows,
+    load_arrow,
+    predict,
+    quantile_dmatrix,
+)
+from train import params as train_params
+
+# The features are built by the code of the preprocessing
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Preprocess")
+)
+from categories import Categories
+from feature_spec import add_features, build_feature_spec, prune_spec, required_columns
+from preprocess_utils import (
+    excluded_columns,
+    load_data,
+    prepare,
+    raw_splits,
+)
+from time_features import add_time_features
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--target-f1-loss",
+    type=float,
+    default=0.005,
+    help="Largest decrease of the F1-score of the selected features",
+)
+parser.add_argument(
+    "--corr-threshold",
+    type=float,
+    default=0.95,
+    help="|Spearman correlation| of the redundant features of a cluster",
+)
+parser.add_argument(
+    "--sample-rows",
+    type=int,
+    default=200_000,
+    help="Rows sampled for the correlations",
+)
+parser.add_argument("--folds", type=int, default=5, help="The folds of train.py")
+parser.add_argument(
+    "--split", default="stratified", choices=["stratified", "time"]
+)
+parser.add_argument("--num-boost-round", type=int, default=200)
+parser.add_argument("--early-stopping-rounds", type=int, default=20)
+parser.add_argument(
+    "--threshold",
+    type=float,
+    default=0.02,
+    help="The --threshold of preprocess.py, for the preprocessing times",
+)
+parser.add_argument(
+    "--skip-preprocess",
+    action="store_true",
+    help="Do not time the preprocessing of the raw splits",
+)
+parser.add_argument("--output", default="feature_selection.json")
+
+
+def importances(paths: list):
+    """
+    Return the importance of every feature split on by the models: the mean of
+    its shares of the total gain and of the total cover of every fold.
+    """
+    gain, cover = {}, {}
+    for path in paths:
+        booster = xgb.Booster()
+        booster.load_model(path)
+        for scores, kind in [(gain, "total_gain"), (cover, "total_cover")]:
+            for feature, score in booster.get_score(importance_type=kind).items():
+                scores[feature] = scores.get(feature, 0) + score
+    total_gain, total_cover = sum(gain.values()), sum(cover.values())
+    return {
+        feature: (gain[feature] / total_gain + cover[feature] / total_cover) / 2
+        for feature in gain
+    }
+
+
+def rank_correlations(df: pl.DataFrame, columns: list, sample_rows: int):
+    """
+    Return the |Spearman correlation| matrix of the columns over sampled rows,
+    the missing values have the mean rank and a constant column is
+    uncorrelated.
+    """
+    if df.height > sample_rows:
+        df = df.sample(sample_rows, seed=0)
+    exprs = []
+    for c in columns:
+        expr = pl.col(c)
+        if df.schema[c] in [pl.Float32, pl.Float64]:
+            expr = expr.fill_nan(None)
+        exprs.append(expr.rank().fill_null(strategy="mean"))
+    ranks = df.select(exprs).to_numpy()
+    ranks = np.nan_to_num(ranks.astype(np.float64))
+    ranks -= ranks.mean(axis=0)
+    norms = np.sqrt((ranks**2).sum(axis=0))
+    norms[norms == 0] = np.inf
+    ranks /= norms
+    return np.abs(ranks.T @ ranks)
+
+
+def cluster(columns: list, correlations: np.ndarray, threshold: float):
+    """
+    Group the columns (in decreasing importance) with the first more important
+    column they are correlated with above threshold, return the clusters keyed
+    by their most important column.
+    """
+    clusters = {}
+    representatives = []
+    for i, column in enumerate(columns):
+        leaders = [j for j in representatives if correlations[i, j] >= threshold]
+        if not leaders:
+            representatives.append(i)
+            clusters[column] = [column]
+        else:
+            clusters[columns[leaders[0]]].append(column)
+    return clusters
+
+
+def evaluate(df: pl.DataFrame, columns: list, fit_rows, eval_rows, args):
+    """
+    Train on the fit rows with the parameters of train.py, return the F1-score
+    of the best threshold on the eval rows and the seconds of training and of
+    the prediction of the eval rows.
+    """
+    dtrain = quantile_dmatrix(df, columns, rows=fit_rows)
+    dvalid = quantile_dmatrix(df, columns, ref=dtrain, rows=eval_rows)
+    start = time.perf_counter()
+    booster = xgb.train(
+        {**train_params, "nthread": os.cpu_count()},
+        dtrain,
+        num_boost_round=args.num_boost_round,
+        evals=[(dvalid, "validation_0")],
+        early_stopping_rounds=args.early_stopping_rounds,
+        verbose_eval=False,
+    )
+    train_seconds = time.perf_counter() - start
+    eval_df = df[eval_rows]
+    start = time.perf_counter()
+    # The prediction of the eval rows, the conversion to NumPy included
+    y_prob = predict(booster, eval_df, columns)
+    predict_seconds = time.perf_counter() - start
+    threshold, f1 = best_threshold(eval_df["label"].to_numpy(), y_prob)
+    return {
+        "columns": len(columns),
+        "f1": f1,
+        "threshold": threshold,
+        "rounds": booster.num_boosted_rounds(),
+        "train_seconds": train_seconds,
+        "train_seconds_per_round": train_seconds / booster.num_boosted_rounds(),
+        "predict_seconds": predict_seconds,
+    }
+
+
+def preprocess_seconds(spec: list, exclude: set):
+    """Return the seconds of the preprocessing of the raw splits, like preprocess.py."""
+    columns = required_columns(prune_spec(spec, exclude))
+    start = time.perf_counter()
+    df = pl.concat(
+        [
+            load_data(path=path, mode=mode, lazy=True, columns=columns)
+            for mode, path in raw_splits.items()
+        ],
+        how="diagonal",
+    )
+    df = prepare(df, Categories.load())
+    df = add_time_features(df, prev_loctm="broadcast")
+    add_features(df, spec, exclude).collect()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    paths = sorted(glob.glob("xgb_fold*.json"))
+    if not paths:
+        raise FileNotFoundError("No xgb_fold*.json, run train.py first")
+
+    df = load_arrow(["real_train.arrow", "real_valid.arrow"])
+    columns = feature_columns(df)
+    spec = build_feature_spec()
+    names = {f.name for f in spec}
+    # The features of the spec are selected, the raw columns and the time
+    # features are kept
+    candidates = [c for c in columns if c in names]
+    kept = [c for c in columns if c not in names]
+
+    importance = importances(paths)
+    candidates.sort(key=lambda c: importance.get(c, 0), reverse=True)
+    unused = [c for c in candidates if importance.get(c, 0) == 0]
+    used = [c for c in candidates if importance.get(c, 0) > 0]
+    correlations = rank_correlations(df, used, args.sample_rows)
+    clusters = cluster(used, correlations, args.corr_threshold)
+    representatives = list(clusters)
+    print(
+        f"{len(candidates)} features: {len(unused)} never split on, "
+        f"{len(used) - len(representatives)} redundant in {len(clusters)} clusters"
+    )
+
+    fit_rows, eval_rows = fold_rows(df, args.folds, args.split)[0]
+    baseline = evaluate(df, columns, fit_rows, eval_rows, args)
+    target = baseline["f1"] - args.target_f1_loss
+    print(f"Every column: {len(columns)} columns, F1-score {baseline['f1']:.4f}")
+
+    # The smallest number of representatives within the target F1-score, the
+    # F1-score is assumed to increase with the number of representatives
+    results = {}
+
+    def result(k: int):
+        if k not in results:
+            results[k] = evaluate(
+                df, kept + representatives[:k], fit_rows, eval_rows, args
+            )
+            print(
+                f"{k} features: {results[k]['columns']} columns, F1-score "
+                f"{results[k]['f1']:.4f}"
+            )
+        return results[k]
+
+    low, high = 0, len(representatives)
+    if result(high)["f1"] < target:
+        # The redundant features are needed, every feature is kept
+        selected, chosen = candidates, baseline
+    else:
+        while low < high:
+            middle = (low + high) // 2
+            if result(middle)["f1"] >= target:
+                high = middle
+            else:
+                low = middle + 1
+        selected, chosen = representatives[:high], result(high)
+    dropped = [f.name for f in spec if f.name not in selected]
+
+    seconds = {
+        "train": [baseline["train_seconds"], chosen["train_seconds"]],
+        "train_per_round": [
+            baseline["train_seconds_per_round"],
+            chosen["train_seconds_per_round"],
+        ],
+        "inference": [baseline["predict_seconds"], chosen["predict_seconds"]],
+    }
+    if not args.skip_preprocess:
+        exclude = set(excluded_columns(args.threshold))
+        seconds["preprocess"] = [
+            preprocess_seconds(spec, exclude),
+            preprocess_seconds(spec, exclude | set(dropped)),
+        ]
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "dropped": dropped,
+                "selected": selected,
+                "target_f1_loss": args.target_f1_loss,
+                "baseline": baseline,
+                "result": chosen,
+                "evaluations": {k: results[k] for k in sorted(results)},
+                "importance": {c: importance.get(c, 0) for c in candidates},
+                "clusters": clusters,
+                "seconds": seconds,
+            },
+            f,
+            indent=2,
+        )
+    print(
+        f"Selected {len(selected)} of {len(candidates)} features, {chosen['columns']} "
+        f"columns, F1-score {chosen['f1']:.4f} (every column {baseline['f1']:.4f})"
+    )
+    for stage, (before, after) in seconds.items():
+        print(
+            f"{stage:16} {before:8.2f}s -> {after:8.2f}s "
+            f"({1 - after / before:.0%} saved)"
+        )
+    print(f"The removed features are written to {args.output}")
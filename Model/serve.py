@@ -0,0 +1,372 @@
+"""
+Online scoring service
+
+Load the fold models once and score single transactions in the raw
+training.csv schema over HTTP:
+    POST /score  a transaction (or a list of transactions) as JSON
+    GET  /stats  latency percentiles and throughput
+The concurrent requests are grouped into micro-batches, a batch is scored when
+it has --max-batch transactions or its first transaction waited --max-wait-ms.
+Every transaction is checked and cast to the raw schema before it is queued, an
+invalid one fails alone with a 400 (an entry {"error": ...} in a list), the
+others of its batch and of its request are scored.
+"""
+import argparse
+from collections import deque
+from concurrent.futures import Future
+import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+import numpy as np
+import polars as pl
+from model_utils import decision_threshold, load_model, predict
+
+# The features are built by the code of the preprocessing
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Preprocess")
+)
+from categories import Categories
+from feature_spec import build_feature_spec, prune_spec, raw_schema, required_columns
+from feature_store import FeatureStore
+from preprocess_utils import cast_raw, excluded_columns, load_data, prepare, raw_splits
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument(
+    "--max-batch", type=int, default=256, help="Transactions per micro-batch"
+)
+parser.add_argument(
+    "--max-wait-ms",
+    type=float,
+    default=5,
+    help="Longest wait of a transaction for its micro-batch to fill",
+)
+parser.add_argument(
+    "--store",
+    default=None,
+    help="Directory of the feature store, built from the raw data if missing "
+    "and saved on exit",
+)
+parser.add_argument(
+    "--engine",
+    choices=["xgboost", "numpy"],
+    default="xgboost",
+    help="Predict with XGBoost or with the NumPy evaluator of tree_ensemble.py",
+)
+parser.add_argument(
+    "--threshold",
+    type=float,
+    default=0.02,
+    help="The --threshold of preprocess.py the models were trained with",
+)
+parser.add_argument(
+    "--selection",
+    default=None,
+    help="The --selection of preprocess.py the models were trained with",
+)
+
+# The fields without which a transaction has no time features
+required_fields = ["txkey", "chid", "locdt", "loctm"]
+
+
+class FeaturesError(RuntimeError):
+    """The features failed after the transactions were added to the store."""
+
+
+class OnlineFeatures:
+    """
+    Build the features of new transactions from the statistics of the feature
+    store, the same features as preprocess.py over the history and the new
+    transactions. The new transactions are added to the store.
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        categories: Categories,
+        path: str = None,
+        selection: str = None,
+    ):
+        spec = build_feature_spec()
+        exclude = set(excluded_columns(threshold, selection))
+        self.columns = [
+            c for c in required_columns(prune_spec(spec, exclude)) if c != "label"
+        ]
+        self.path = path
+        # Read only, the unseen values of new transactions are in the unseen bucket
+        self.categories = categories
+        self.lock = threading.Lock()
+        self.store = FeatureStore(spec, exclude)
+        if path is not None and os.path.exists(path):
+            self.store.load(path)
+            return
+        # Build the store from the raw data preprocess.py was run on
+        history = [
+            load_data(path=path, mode=mode, lazy=True, columns=self.columns)
+            for mode, path in raw_splits.items()
+        ]
+        history = prepare(pl.concat(history, how="diagonal"), categories)
+        self.store.build(history.select(self.columns).collect())
+        self.save()
+
+    def validate(self, record):
+        """
+        Return a transaction as a one row frame of the raw schema, raise
+        ValueError if a required field is missing or a value is not of its type.
+        """
+        if not isinstance(record, dict):
+            raise ValueError("A transaction is a JSON object")
+        missing = [c for c in required_fields if record.get(c) is None]
+        if missing:
+            raise ValueError(f"Missing fields: {', '.join(missing)}")
+        # Missing columns are null, e.g. an unknown stscd
+        row = {c: record.get(c) for c in self.columns}
+        for c, value in row.items():
+            if value is not None and not isinstance(value, (str, int, float)):
+                raise ValueError(f"{c} is not a {raw_schema[c]}: {value!r}")
+        try:
+            df = cast_raw(pl.DataFrame({c: [value] for c, value in row.items()}))
+        except (pl.ComputeError, pl.InvalidOperationError) as e:
+            raise ValueError(f"A value is not of its type: {e}")
+        loctm = df["loctm"][0]
+        if not (0 <= loctm <= 235959 and loctm // 100 % 100 < 60 and loctm % 100 < 60):
+            raise ValueError(f"loctm is not a time HHMMSS: {loctm}")
+        return df
+
+    def __call__(self, rows: list):
+        """Return the features of the frames of validate, added to the store."""
+        df = prepare(pl.concat(rows), self.categories)
+        with self.lock:
+            # All or nothing, a failed update leaves the store unchanged
+            self.store.update(df)
+            try:
+                return self.store.features(df)
+            except Exception as e:
+                # The transactions are in the store, they must not be retried
+                raise FeaturesError(f"Features of added transactions: {e}") from e
+
+    def save(self):
+        if self.path is not None:
+            with self.lock:
+                self.store.save(self.path)
+
+
+class Stats:
+    """Latency and throughput counters of the recent requests."""
+
+    def __init__(self, window: int = 10_000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.batches = 0
+        # (finish time, latency) of the recent requests
+        self.recent = deque(maxlen=window)
+
+    def add_batch(self, latencies: list):
+        now = time.time()
+        with self.lock:
+            self.requests += len(latencies)
+            self.batches += 1
+            self.recent.extend((now, latency) for latency in latencies)
+
+    def snapshot(self):
+        with self.lock:
+            recent = np.array(self.recent).reshape(-1, 2)
+            requests, batches = self.requests, self.batches
+        stats = {
+            "requests": requests,
+            "batches": batches,
+            "mean_batch_size": requests / batches if batches else 0,
+            "uptime_s": time.time() - self.start,
+        }
+        if len(recent) > 1:
+            seconds = recent[-1, 0] - recent[0, 0]
+            stats["p50_ms"] = np.percentile(recent[:, 1], 50) * 1000
+            stats["p99_ms"] = np.percentile(recent[:, 1], 99) * 1000
+            stats["throughput_per_s"] = len(recent) / seconds if seconds > 0 else None
+        return stats
+
+
+class Scorer:
+    """Group the queued transactions into micro-batches and score them."""
+
+    def __init__(self, models: list, features: OnlineFeatures, args):
+        self.models = models
+        # The model input columns in the order of training
+        self.columns = models[0].feature_names
+        # The threshold of the mean probability, saved by train.py
+        self.threshold = decision_threshold(models)
+        self.features = features
+        self.max_batch = args.max_batch
+        self.max_wait = args.max_wait_ms / 1000
+        self.stats = Stats()
+        self.queue = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, record: dict):
+        """Queue a transaction, an invalid one fails at once and is not queued."""
+        future = Future()
+        try:
+            row = self.features.validate(record)
+        except ValueError as e:
+            future.set_exception(e)
+            return future
+        self.queue.put((row, future, time.perf_counter()))
+        return future
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(items) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                results = self.score([row for row, _, _ in items])
+            except Exception as e:
+                results = [e] * len(items)
+            now = time.perf_counter()
+            latencies = []
+            for (_, future, start), result in zip(items, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+                    latencies.append(now - start)
+            if latencies:
+                self.stats.add_batch(latencies)
+
+    def score(self, rows: list):
+        """Return the result of every transaction, or the exception it raised."""
+        try:
+            frames = [self.features(rows)]
+        except FeaturesError:
+            # The batch is already counted in the store, it fails as a whole
+            raise
+        except Exception:
+            # A failed update leaves the store unchanged, the transactions are
+            # added one at a time so only the failing one fails
+            frames = []
+            for row in rows:
+                try:
+                    frames.append(self.features([row]))
+                except Exception as e:
+                    frames.append(e)
+        scored = [df for df in frames if isinstance(df, pl.DataFrame)]
+        if not scored:
+            return frames
+        df = pl.concat(scored)
+        y_probs = np.vstack(
+            [predict(model, df, self.columns) for model in self.models]
+        )
+        # The same ensemble as inference.py: the mean probability of the folds
+        # and the threshold
+        y_prob = np.mean(y_probs, axis=0)
+        y_pred = y_prob >= self.threshold
+        results = iter(
+            {"txkey": txkey, "probability": float(prob), "pred": int(pred)}
+            for txkey, prob, pred in zip(df["txkey"], y_prob, y_pred)
+        )
+        if len(frames) == 1:
+            return list(results)
+        return [next(results) if isinstance(df, pl.DataFrame) else df for df in frames]
+
+
+class Handler(BaseHTTPRequestHandler):
+    scorer: Scorer = None
+
+    def reply(self, code: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.reply(200, self.scorer.stats.snapshot())
+        else:
+            self.reply(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self.reply(404, {"error": f"Unknown path: {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+            self.reply(400, {"error": f"Invalid request: {e}"})
+            return
+        records = body if isinstance(body, list) else [body]
+        if not all(isinstance(record, dict) for record in records):
+            self.reply(400, {"error": "The body is a transaction or a list of them"})
+            return
+        futures = [self.scorer.submit(record) for record in records]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({"error": str(e)})
+        if isinstance(body, list):
+            # The valid transactions are scored (and added to the store) even
+            # with an invalid one, each entry is a result or an error
+            self.reply(200, results)
+        else:
+            self.reply(400 if "error" in results[0] else 200, results[0])
+
+    def log_message(self, format, *args):
+        # Do not log every request
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    # Queue the connections of many concurrent clients
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    # The codes of the categorical columns written by preprocess.py
+    categories = Categories.load()
+
+    # Load the best iteration model of every fold once
+    paths = sorted(glob.glob("xgb_fold*.json"))
+    if not paths:
+        raise FileNotFoundError("No xgb_fold*.json, run train.py first")
+    models = []
+    for path in paths:
+        model = load_model(path, args.engine)
+        categories.check(model.attr("categories_version"))
+        models.append(model)
+
+    features = OnlineFeatures(args.threshold, categories, args.store, args.selection)
+    print(f"{len(models)} models, {len(features.store.time.values)} chids")
+
+    Handler.scorer = Scorer(models, features, args)
+    server = Server((args.host, args.port), Handler)
+    print(f"Listening on http://{args.host}:{args.port}")
+    # Stop serving on Ctrl-C or kill, serve_forever returns after shutdown
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(
+            signum, lambda *_: threading.Thread(target=server.shutdown).start()
+        )
+    server.serve_forever()
+    server.server_close()
+    # Keep the transactions scored by the service
+    features.save()
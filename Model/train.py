@@ -1,65 +1,190 @@
 """
 Train XGBoost model
 """
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import json
+import multiprocessing
+import os
+import tempfile
+
 import numpy as np
-import polars as pl
-from sklearn.metrics import f1_score
-import xgboost as xgb
+from sklearn.metrics import f1_score, log_loss
+from model_utils import (
+    best_threshold,
+    external_page_rows,
+    fold_rows,
+    load_arrow,
+    save_threshold,
+    train_fold,
+)
+from categories import Categories
+import profiling
 
-# Add this to avoid error while concatenate string columns
-pl.enable_string_cache()
-df_train = pl.read_csv("train.csv", ignore_errors=True)
-# Add some validation data to training data
-df_valid = pl.read_csv("valid.csv", ignore_errors=True)
-df = pl.concat([df_train, df_valid])
-df = df.with_columns(
-    pl.col("stscd").cast(pl.Categorical),
+parser = argparse.ArgumentParser()
+parser.add_argument("--folds", type=int, default=5, help="Number of folds")
+parser.add_argument(
+    "--split",
+    default="stratified",
+    choices=["stratified", "time"],
+    help="Stratified folds, or folds of consecutive days (locdt)",
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=None,
+    help="Folds trained at the same time, the cores are shared among them",
+)
+parser.add_argument(
+    "--external-memory",
+    action="store_true",
+    help="Stream the training data from pages on disk instead of holding it in "
+    "memory. XGBoost 1.7 mislearns categorical splits from the pages, so the "
+    "categorical columns are split as numbers (their codes) in this mode. Every "
+    "tree level reads all the pages, training is several times slower than in "
+    "memory, see --compare",
+)
+parser.add_argument(
+    "--compare",
+    action="store_true",
+    help="With --external-memory, also train every fold in memory and print its "
+    "eval logloss, F1-score and rows/s next to the external memory ones",
+)
+parser.add_argument(
+    "--cache-dir",
+    default=None,
+    help="Directory of the external memory pages, a temporary directory by default",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=None,
+    help="Rows per batch, 100,000 by default, or per external memory page, "
+    f"{external_page_rows:,} by default (smaller pages train faster)",
+)
+parser.add_argument(
+    "--params",
+    default=None,
+    help="Train with the parameters of the best trial of this search.py history",
+)
+parser.add_argument(
+    "--profile",
+    default=None,
+    help="Write the time, CPU time, peak memory and shapes of every fold to this "
+    "Chrome trace JSON",
 )
-#
-x = df.drop(["txkey", "label"]).to_pandas()
-# Assign label column as "y"
-y = df["label"].to_pandas()
-# Keep some validation data for evaluation
-idx = -100_000
-x_train = x[:idx]
-y_train = y[:idx]
 
-x_valid = x[idx:]
-y_valid = y[idx:]
+# XGBoost parameters
+params = {
+    "learning_rate": 0.3,
+    "max_depth": 12,
+    "tree_method": "hist",
+    "objective": "binary:logistic",
+}
+num_boost_round = 200
 
-# Initial XGBoost classifier
-clf = xgb.XGBClassifier(
-    n_estimators=200,
-    learning_rate=0.3,
-    max_depth=12,
-    tree_method="hist",
-    enable_categorical=True,
-    objective="binary:logistic",
-)
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.compare and not args.external_memory:
+        parser.error("--compare needs --external-memory")
+    if args.batch_size is None:
+        args.batch_size = external_page_rows if args.external_memory else 100_000
+    if args.profile is not None:
+        # Before the workers are spawned, they record their folds too
+        profiling.enable(args.profile)
+    if args.params is not None:
+        with open(args.params) as f:
+            history = json.load(f)
+        if history["best"] is None:
+            raise ValueError(f"{args.params} has no complete trial")
+        # The threads are set below from the cores and jobs of this run
+        params.update(history["best"]["params"])
+        params.pop("nthread")
+        num_boost_round = history["num_boost_round"]
+        print(f"Parameters of trial {history['best']['trial']}: {params}")
+    # Train on training data and validation data, the data is memory-mapped
+    # again in each worker
+    paths = ["real_train.arrow", "real_valid.arrow"]
+    df = load_arrow(paths)
+    folds = fold_rows(df, args.folds, args.split)
+    # The version of the codes of real_*.arrow, recorded in the models
+    categories = Categories.load()
+
+    # Share the cores among the workers, e.g. 16 cores run 4 folds x 4 threads
+    cores = os.cpu_count()
+    jobs = args.jobs or min(args.folds, cores)
+    params["nthread"] = max(1, cores // jobs)
+    os.environ["POLARS_MAX_THREADS"] = str(params["nthread"])
+    print(f"{args.folds} folds, {jobs} jobs x {params['nthread']} threads")
+
+    # Remove the models of a previous run, inference.py ensembles every fold
+    for path in glob.glob("xgb_fold*.json"):
+        os.remove(path)
+
+    cache = None
+    if args.external_memory:
+        # The pages are written once and streamed from disk every iteration,
+        # only one page of batch_size rows is in memory at a time
+        cache = tempfile.TemporaryDirectory(dir=args.cache_dir)
+    # The in-memory models of --compare are only evaluated, not saved
+    baseline = tempfile.TemporaryDirectory() if args.compare else None
+
+    def submit(pool, i, fit_rows, eval_rows, in_memory=False):
+        return pool.submit(
+            train_fold,
+            i,
+            paths,
+            fit_rows,
+            eval_rows,
+            params,
+            num_boost_round=num_boost_round,
+            early_stopping_rounds=20,
+            batch_size=100_000 if in_memory else args.batch_size,
+            cache_dir=None if in_memory else cache and cache.name,
+            categories_version=categories.version,
+            model_path=os.path.join(baseline.name, f"xgb_fold{i}.json")
+            if in_memory
+            else None,
+        )
+
+    def report(name, y_true, result):
+        best_iteration, y_prob, rows_per_second = result
+        # The F1-score at the best threshold of the fold
+        _, f1 = best_threshold(y_true, y_prob)
+        print(
+            f"{name}: best_iteration {best_iteration}, "
+            f"eval logloss {log_loss(y_true, y_prob, labels=[0, 1]):.4f}, "
+            f"F1-score {f1:.4f}, {rows_per_second:,.0f} rows/s"
+        )
 
-# Fit XGBoost model
-for i in range(1):
-    print(i)
-    clf.fit(
-        x_train,
-        y_train,
-        eval_set=[(x_valid, y_valid)],
-    )
-    # Save model into JSON format.
-    clf.save_model(f"xgb_fold{i}.json")
+    # Fit XGBoost model of each fold, spawn the workers instead of forking
+    # the threads of polars
+    y_true = df["label"].to_numpy()
+    with ProcessPoolExecutor(jobs, multiprocessing.get_context("spawn")) as pool:
+        futures = [submit(pool, i, *fold) for i, fold in enumerate(folds)]
+        baselines = [
+            submit(pool, i, *fold, in_memory=True)
+            for i, fold in enumerate(folds)
+            if args.compare
+        ]
+        # Out-of-fold probabilities, each row is predicted by the model that
+        # did not see it
+        y_prob = np.zeros(df.height)
+        for i, (future, (_, eval_rows)) in enumerate(zip(futures, folds)):
+            result = future.result()
+            y_prob[eval_rows] = result[1]
+            report(f"Fold {i}", y_true[eval_rows], result)
+            if args.compare:
+                report("  in memory", y_true[eval_rows], baselines[i].result())
 
-# Load the best iteration model for validation data prediction
-y_preds = []
-for i in range(1):
-    model2 = xgb.XGBClassifier()
-    model2.load_model(f"xgb_fold{i}.json")
-    y_preds.append(
-        model2.predict(x_valid, iteration_range=(0, model2.best_iteration + 1))
-    )
-# Aggregate the predictions as a matrix
-y_preds = np.vstack(y_preds)
-# Take the mean of predictions and round to 0 or 1
-y_pred = np.mean(y_preds, axis=0)
-y_pred = np.round(y_pred)
-# Compute F1-score
-print(f1_score(y_true=y_valid, y_pred=y_pred))
+    # F1-score of the probabilities rounded to 0 or 1, and of the threshold
+    # with the best F1-score over the out-of-fold probabilities
+    print(f"F1-score at 0.5: {f1_score(y_true=y_true, y_pred=y_prob >= 0.5):.4f}")
+    threshold, f1 = best_threshold(y_true, y_prob)
+    print(f"F1-score at {threshold:.4f}: {f1:.4f}")
+    # Saved in every model, inference.py and serve.py predict the mean
+    # probability of the folds with it
+    for i in range(args.folds):
+        save_threshold(f"xgb_fold{i}.json", threshold)
+    profiling.save()
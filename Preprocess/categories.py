@@ -0,0 +1,98 @@
+"""
+Persisted dictionaries of the categorical columns
+
+The categorical columns are encoded as stable integer codes instead of polars
+Categorical, whose codes depend on the order the values are met and need a
+global string cache. The values of a column are numbered in the order they are
+added (sorted within one update): value i has the code i + 1, code 0 is the
+bucket of the values not in the dictionary and null stays null. Values are
+only appended, so a code never changes and a model trained with a version of
+the dictionary reads the codes of every later version. preprocess.py saves the
+dictionary as categories.json next to real_*.arrow, train.py, inference.py and
+serve.py load it.
+"""
+import json
+import os
+
+import polars as pl
+
+# Saved in the data directory, next to real_*.arrow
+categories_path = "categories.json"
+# Code of the values not in the dictionary
+unseen = 0
+
+
+class Categories:
+    """The values of each categorical column, in the order of their codes."""
+
+    def __init__(self, columns: list, version: int = 0):
+        self.values = {c: [] for c in columns}
+        # Incremented by every update that adds a value
+        self.version = version
+
+    def update(self, df):
+        """Append the values of df (DataFrame or LazyFrame) not in the dictionary."""
+        columns = [c for c in self.values if c in df.columns]
+        # The distinct values of every column in one pass
+        new = df.select(
+            [pl.col(c).drop_nulls().unique().sort().implode() for c in columns]
+        )
+        if isinstance(new, pl.LazyFrame):
+            new = new.collect()
+        added = False
+        for c, values in zip(columns, new.row(0)):
+            known = set(self.values[c])
+            values = [v for v in values if v not in known]
+            self.values[c] += values
+            added = added or len(values) > 0
+        self.version += added
+        return self
+
+    def dtype(self, column: str):
+        """Return the type of the codes of a column, code 0 included."""
+        return pl.UInt16 if len(self.values[column]) < 2**16 else pl.UInt32
+
+    def encode(self, df):
+        """Replace the values of the categorical columns by their codes."""
+        return df.with_columns(
+            [
+                # A vectorized lookup (a hash join on the values), null stays null
+                pl.when(pl.col(c).is_not_null())
+                .then(
+                    pl.col(c).replace(
+                        {v: i + 1 for i, v in enumerate(values)},
+                        default=unseen,
+                        return_dtype=self.dtype(c),
+                    )
+                )
+                .alias(c)
+                for c, values in self.values.items()
+                if c in df.columns
+            ]
+        )
+
+    def check(self, version):
+        """Raise unless the codes of a version (e.g. of a model) are codes of self."""
+        if version is None:
+            raise ValueError(
+                "The model was trained without a categories dictionary, train it again"
+            )
+        if int(version) > self.version:
+            raise ValueError(
+                f"The model was trained with version {version} of the categories, "
+                f"{categories_path} is version {self.version}"
+            )
+
+    def save(self, path: str = categories_path):
+        # Write then rename, a reader never sees a partial dictionary
+        with open(path + ".tmp", "w") as f:
+            json.dump({"version": self.version, "columns": self.values}, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str = categories_path):
+        with open(path) as f:
+            data = json.load(f)
+        categories = cls(list(data["columns"]), data["version"])
+        categories.values = data["columns"]
+        return categories
@@ -0,0 +1,74 @@
+"""
+Check preprocess.py --workers against the single-process features
+
+Load the raw data like preprocess.py, set every grouping key to null in a
+--null-rate of the rows (the null keys are their own group), then compare the
+features of distributed_features with --workers processes to the ones of
+add_time_features and add_features in this process, value by value.
+"""
+import argparse
+import sys
+
+import numpy as np
+import polars as pl
+from categories import Categories
+from distributed import distributed_features
+from feature_spec import add_features, build_feature_spec, prune_spec, required_columns
+from preprocess_utils import (
+    categorical_cols,
+    excluded_columns,
+    load_data,
+    prepare,
+    raw_splits,
+)
+from time_features import add_time_features
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--threshold", type=float, default=0.02)
+parser.add_argument("--keep-all", action="store_true")
+parser.add_argument("--workers", type=int, default=2)
+parser.add_argument(
+    "--null-rate", type=float, default=0.01, help="Rows of each key set to null"
+)
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+spec = build_feature_spec()
+exclude = set() if args.keep_all else set(excluded_columns(args.threshold))
+columns = required_columns(prune_spec(spec, exclude))
+df = [
+    load_data(path=path, mode=mode, lazy=True, columns=columns)
+    for mode, path in raw_splits.items()
+]
+df = pl.concat(df, how="diagonal")
+categories = Categories(categorical_cols).update(df)
+df = prepare(df, categories).collect()
+
+keys = list(dict.fromkeys(f.key for f in prune_spec(spec, exclude) if f.key))
+rng = np.random.default_rng(args.seed)
+df = df.with_columns(
+    [
+        pl.when(pl.Series(rng.random(df.height) < args.null_rate))
+        .then(None)
+        .otherwise(pl.col(key))
+        .alias(key)
+        for key in keys
+    ]
+)
+
+expected = add_features(add_time_features(df), spec, exclude)
+features = distributed_features(df, spec, exclude, args.workers)
+failed = []
+if features.columns != expected.columns:
+    failed.append(f"columns {features.columns} != {expected.columns}")
+for c in expected.columns:
+    a, b = features[c], expected[c]
+    if a.dtype != b.dtype:
+        failed.append(f"{c}: dtype {a.dtype} != {b.dtype}")
+    elif not a.eq_missing(b).all():
+        failed.append(f"{c}: {(~a.eq_missing(b)).sum()} different values")
+
+print(f"{features.height} transactions, {len(features.columns)} columns")
+for message in failed:
+    print(message)
+sys.exit(1 if failed else 0)
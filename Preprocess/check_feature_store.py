@@ -0,0 +1,81 @@
+"""
+Check the feature store against preprocess.py
+
+Build the store from the raw data without its last --stream transactions, save
+and load it, add the last transactions one by one (or merge them at once with
+--bulk), then compare the features of every transaction with real_*.arrow of
+preprocess.py run with the same --threshold.
+"""
+import argparse
+import sys
+import tempfile
+import time
+
+import numpy as np
+import polars as pl
+from categories import Categories
+from feature_spec import build_feature_spec, prune_spec, required_columns
+from feature_store import FeatureStore
+from keyed_splits import read_split
+from preprocess_utils import excluded_columns, load_data, prepare, raw_splits
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--threshold", type=float, default=0.02)
+parser.add_argument(
+    "--keep-all", action="store_true", help="preprocess.py was run with --keep-all"
+)
+parser.add_argument(
+    "--stream", type=int, default=1000, help="Transactions added one by one"
+)
+parser.add_argument(
+    "--bulk", action="store_true", help="Merge the last transactions at once instead"
+)
+args = parser.parse_args()
+
+spec = build_feature_spec()
+exclude = set() if args.keep_all else set(excluded_columns(args.threshold))
+columns = [c for c in required_columns(prune_spec(spec, exclude)) if c != "label"]
+df = [
+    load_data(path=path, mode=mode, lazy=True, columns=columns)
+    for mode, path in raw_splits.items()
+]
+# The codes of the categorical columns in real_*.arrow
+categories = Categories.load()
+df = prepare(pl.concat(df, how="diagonal"), categories).select(columns).collect()
+
+store = FeatureStore(spec, exclude).build(df.head(-args.stream))
+with tempfile.TemporaryDirectory() as path:
+    store.save(path)
+    store = FeatureStore(spec, exclude).load(path)
+start = time.perf_counter()
+if args.bulk:
+    store.merge(df.tail(args.stream))
+else:
+    for i in range(df.height - args.stream, df.height):
+        store.update(df[i : i + 1])
+seconds = time.perf_counter() - start
+print(f"{args.stream} updates, {seconds / args.stream * 1e6:.0f} us per transaction")
+features = store.features(df)
+
+expected = pl.concat(
+    [read_split(f"real_{mode}.arrow") for mode in raw_splits], how="diagonal"
+)
+failed = []
+for c in features.columns:
+    a, b = features[c], expected[c]
+    if a.dtype != b.dtype:
+        failed.append(f"{c}: dtype {a.dtype} != {b.dtype}")
+    elif a.dtype in [pl.Float32, pl.Float64]:
+        # The running means and variances differ in the last bits
+        same = (a.is_null() == b.is_null()).all() and np.allclose(
+            a.drop_nulls().to_numpy(), b.drop_nulls().to_numpy(), rtol=1e-5, atol=1e-6
+        )
+        if not same:
+            failed.append(f"{c}: max difference {(a - b).abs().max()}")
+    elif not a.eq_missing(b).all():
+        failed.append(f"{c}: {(~a.eq_missing(b)).sum()} different values")
+
+print(f"{features.height} transactions, {len(features.columns)} columns")
+for message in failed:
+    print(message)
+sys.exit(1 if failed else 0)
@@ -0,0 +1,75 @@
+"""
+Check the precision of the narrowed feature types
+
+Load the raw data like preprocess.py and compare every feature of add_features,
+in the output types of the feature spec, to a recompute in Float64: the same
+spec without output types, from a Float64 loctm_span. A Float32 feature must be
+the Float64 value rounded, within --rtol (relative) or --atol (absolute), the
+other features must be equal.
+"""
+import argparse
+import sys
+
+import numpy as np
+import polars as pl
+from categories import Categories
+from feature_spec import add_features, build_feature_spec, prune_spec, required_columns
+from preprocess_utils import (
+    categorical_cols,
+    excluded_columns,
+    load_data,
+    prepare,
+    raw_splits,
+)
+from time_features import add_time_features
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--threshold", type=float, default=0.02)
+parser.add_argument("--keep-all", action="store_true")
+parser.add_argument("--rtol", type=float, default=1e-5)
+parser.add_argument("--atol", type=float, default=1e-6)
+args = parser.parse_args()
+
+spec = build_feature_spec()
+exclude = set() if args.keep_all else set(excluded_columns(args.threshold))
+columns = required_columns(prune_spec(spec, exclude))
+df = [
+    load_data(path=path, mode=mode, lazy=True, columns=columns)
+    for mode, path in raw_splits.items()
+]
+df = pl.concat(df, how="diagonal")
+categories = Categories(categorical_cols).update(df)
+df = add_time_features(prepare(df, categories).collect())
+
+features = add_features(df, spec, exclude)
+# The mean period between the transactions of the chid before its Float32 cast,
+# the relative loctm has the same periods
+df = df.with_columns(
+    pl.col("loctm").diff().mean().over("chid").fill_null(0).alias("loctm_span")
+)
+expected = add_features(df, [f._replace(dtype=None) for f in spec], exclude)
+
+failed = []
+for f in prune_spec(spec, exclude):
+    if f.name not in features.columns:
+        continue
+    a, b = features[f.name], expected[f.name]
+    if a.dtype == pl.Float32:
+        a, b = a.cast(pl.Float64), b.cast(pl.Float64)
+        same = (a.is_null() == b.is_null()).all() and np.allclose(
+            a.drop_nulls().to_numpy(),
+            b.drop_nulls().to_numpy(),
+            rtol=args.rtol,
+            atol=args.atol,
+            equal_nan=True,
+        )
+        if not same:
+            error = ((a - b).abs() / b.abs()).max()
+            failed.append(f"{f.name}: max relative error {error:.2e}")
+    elif not a.eq_missing(b.cast(a.dtype)).all():
+        failed.append(f"{f.name}: {(~a.eq_missing(b.cast(a.dtype))).sum()} different")
+
+print(f"{features.height} transactions, {len(features.columns)} columns")
+for message in failed:
+    print(message)
+sys.exit(1 if failed else 0)
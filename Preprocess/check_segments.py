@@ -0,0 +1,86 @@
+"""
+Check preprocess.py --segments against the windows of add_features
+
+Load the raw data like preprocess.py, set the segment keys to null in a
+--null-rate of the rows (the null keys are their own group), then compare the
+features of add_features over the segment indexes of chid, cano and mchno to
+the ones of its windows: the float features within --rtol/--atol (the Float64
+sums add the rows in another order), the others equal.
+"""
+import argparse
+import sys
+
+import numpy as np
+import polars as pl
+from categories import Categories
+from feature_spec import add_features, build_feature_spec, prune_spec, required_columns
+from preprocess_utils import (
+    categorical_cols,
+    excluded_columns,
+    load_data,
+    prepare,
+    raw_splits,
+)
+from segments import segment_indexes, segment_keys
+from time_features import add_time_features
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--threshold", type=float, default=0.02)
+parser.add_argument("--keep-all", action="store_true")
+parser.add_argument(
+    "--null-rate", type=float, default=0.01, help="Rows of each key set to null"
+)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--rtol", type=float, default=1e-5)
+parser.add_argument("--atol", type=float, default=1e-6)
+args = parser.parse_args()
+
+spec = build_feature_spec()
+exclude = set() if args.keep_all else set(excluded_columns(args.threshold))
+columns = required_columns(prune_spec(spec, exclude))
+df = [
+    load_data(path=path, mode=mode, lazy=True, columns=columns)
+    for mode, path in raw_splits.items()
+]
+df = pl.concat(df, how="diagonal")
+categories = Categories(categorical_cols).update(df)
+df = prepare(df, categories).collect()
+
+keys = {f.key for f in prune_spec(spec, exclude)}
+keys = [k for k in segment_keys if k in keys]
+rng = np.random.default_rng(args.seed)
+df = df.with_columns(
+    [
+        pl.when(pl.Series(rng.random(df.height) < args.null_rate))
+        .then(None)
+        .otherwise(pl.col(key))
+        .alias(key)
+        for key in keys
+    ]
+)
+df = add_time_features(df)
+
+expected = add_features(df, spec, exclude)
+features = add_features(df, spec, exclude, segment_indexes(df, keys))
+failed = []
+for c in expected.columns:
+    a, b = features[c], expected[c]
+    if a.dtype != b.dtype:
+        failed.append(f"{c}: dtype {a.dtype} != {b.dtype}")
+    elif a.dtype in [pl.Float32, pl.Float64]:
+        same = (a.is_null() == b.is_null()).all() and np.allclose(
+            a.drop_nulls().to_numpy(),
+            b.drop_nulls().to_numpy(),
+            rtol=args.rtol,
+            atol=args.atol,
+            equal_nan=True,
+        )
+        if not same:
+            failed.append(f"{c}: max difference {(a - b).abs().max()}")
+    elif not a.eq_missing(b).all():
+        failed.append(f"{c}: {(~a.eq_missing(b)).sum()} different values")
+
+print(f"{features.height} transactions, {len(keys)} keys over segment indexes")
+for message in failed:
+    print(message)
+sys.exit(1 if failed else 0)
@@ -0,0 +1,72 @@
+"""
+Check the velocity features against a direct computation
+
+Generate --rows random transactions of a few chids and cards over a few days,
+with many transactions in the same second, and compare add_velocity_features
+to the windows computed row by row: the transactions of the key in
+(loctm - period, loctm], those of the same second up to the row in file order.
+Then check that a transaction added after a row in the same second changes
+none of the features of the rows up to that second.
+"""
+import argparse
+import sys
+
+import numpy as np
+import polars as pl
+from velocity_features import add_velocity_features, velocity_keys, velocity_windows
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--rows", type=int, default=2000)
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+df = pl.DataFrame(
+    {
+        "chid": rng.integers(0, 20, args.rows).astype(str),
+        "cano": rng.integers(0, 30, args.rows).astype(str),
+        "mchno": rng.integers(0, 10, args.rows).astype(str),
+        # Few distinct seconds, many transactions share one
+        "loctm": rng.integers(0, 3 * 24 * 60, args.rows).astype(np.int32) * 60,
+        "conam": rng.random(args.rows) * 1000,
+    }
+)
+features = add_velocity_features(df)
+
+failed = []
+rows = df.rows(named=True)
+for key in velocity_keys:
+    for name, period in velocity_windows.items():
+        expected = {"count": [], "conam_sum": [], "mchno_distinct": []}
+        for i, row in enumerate(rows):
+            window = [
+                r
+                for j, r in enumerate(rows)
+                if r[key] == row[key]
+                and row["loctm"] - period < r["loctm"]
+                and (r["loctm"] < row["loctm"] or r["loctm"] == row["loctm"] and j <= i)
+            ]
+            expected["count"].append(len(window))
+            expected["conam_sum"].append(sum(r["conam"] for r in window))
+            expected["mchno_distinct"].append(len({r["mchno"] for r in window}))
+        for stat, values in expected.items():
+            column = f"{key}_{stat}_{name}"
+            if not np.allclose(features[column].to_numpy(), values, rtol=1e-6):
+                failed.append(f"{column}: different from the row by row windows")
+
+# A later transaction in the same second as a row, of the same keys and
+# merchant, is in no window of the rows up to that second
+for i in rng.choice(df.height, 20, replace=False):
+    extended = add_velocity_features(pl.concat([df, df[int(i)]]))
+    before = (df["loctm"] <= df["loctm"][int(i)]).to_numpy()
+    for column in features.columns:
+        if not np.array_equal(
+            features[column].to_numpy()[before],
+            extended[column].head(df.height).to_numpy()[before],
+        ):
+            failed.append(f"{column}: changed by a later transaction of row {i}")
+
+print(f"{df.height} transactions, {len(features.columns)} columns")
+for message in failed:
+    print(message)
+sys.exit(1 if failed else 0)
@@ -0,0 +1,199 @@
+"""
+Shard-and-merge preprocessing across worker processes
+
+preprocess.py --workers writes the prepared transactions to a work directory
+and one task file per (key, shard). A worker claims a task by renaming its
+file, reads the rows of its shard (the hash of the key modulo the number of
+shards) and writes the aggregates of the key values of the shard. Every value
+of a key falls in one shard, so the aggregates of a shard are the aggregates
+of its values over all the rows: the coordinator concatenates the shards and
+joins them back to the rows (the null key included, with join_keyed),
+bit-identical to add_time_features and
+add_features in one process.
+
+The chid time features are one stage, the keyed features another one as the
+span features aggregate loctm_span. Workers of other nodes sharing the work
+directory (with the same polars version, the shards depend on its hash) join
+a running coordinator with:
+    python Preprocess/distributed.py WORK_DIR
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import polars as pl
+import profiling
+from feature_spec import (
+    add_row_features,
+    build_feature_spec,
+    join_keyed,
+    keyed_aggregations,
+    prune_spec,
+)
+from time_features import chid_time_exprs, relative_time_features
+
+
+def shard_mask(key: str, shard: int, shards: int):
+    """Return the mask of the rows of a shard, the null key is in one shard."""
+    return pl.col(key).cast(pl.Utf8).hash(seed=0) % shards == shard
+
+
+def task_exprs(task: dict):
+    """Return the aggregations of a task and the types of their outputs."""
+    if task["stage"] == "time":
+        return chid_time_exprs(), {}
+    spec = prune_spec(build_feature_spec(), set(task["exclude"]))
+    return keyed_aggregations(spec, task["key"])
+
+
+def run_task(work_dir: str, task: dict):
+    """Aggregate the features of the task over the key values of its shard."""
+    exprs, dtypes = task_exprs(task)
+    key = task["key"]
+    columns = {key}.union(*(expr.meta.root_names() for expr in exprs))
+    df = pl.read_ipc(
+        os.path.join(work_dir, task["rows"]), columns=list(columns), memory_map=True
+    )
+    df = df.filter(shard_mask(key, task["shard"], task["shards"]))
+    with profiling.step(f"{task['stage']}_{key}_{task['shard']}", df) as s:
+        df = df.group_by(key).agg(exprs)
+        df = df.with_columns([pl.col(c).cast(t) for c, t in dtypes.items()])
+        s.output(df)
+    # Write then rename, the coordinator only sees complete files
+    output = os.path.join(work_dir, task["output"])
+    df.write_ipc(output + ".tmp")
+    os.replace(output + ".tmp", output)
+
+
+def work(work_dir: str, poll: float = 0.05):
+    """Run the tasks of work_dir until the coordinator is finished."""
+    tasks = os.path.join(work_dir, "tasks")
+    while not os.path.exists(os.path.join(work_dir, "finished")):
+        claimed = None
+        for name in sorted(os.listdir(tasks)) if os.path.isdir(tasks) else []:
+            if name.endswith(".json"):
+                try:
+                    # Only one worker renames the task file
+                    os.rename(
+                        os.path.join(tasks, name), os.path.join(tasks, name[:-5])
+                    )
+                except FileNotFoundError:
+                    continue
+                claimed = name[:-5]
+                break
+        if claimed is None:
+            time.sleep(poll)
+            continue
+        with open(os.path.join(tasks, claimed)) as f:
+            task = json.load(f)
+        try:
+            run_task(work_dir, task)
+        except Exception:
+            with open(os.path.join(work_dir, task["output"] + ".error"), "w") as f:
+                f.write(traceback.format_exc())
+
+
+def run_stage(
+    work_dir: str,
+    df: pl.DataFrame,
+    stage: str,
+    keys: list,
+    shards: int,
+    exclude: set,
+    workers: list,
+):
+    """Run the tasks of the keys of a stage, return the aggregates of each key."""
+    rows = f"rows_{stage}.arrow"
+    df.write_ipc(os.path.join(work_dir, rows))
+    outputs = {}
+    for key in keys:
+        for shard in range(shards):
+            name = f"{stage}_{key}_{shard}"
+            task = {
+                "stage": stage,
+                "key": key,
+                "shard": shard,
+                "shards": shards,
+                "exclude": sorted(exclude),
+                "rows": rows,
+                "output": f"{name}.arrow",
+            }
+            output = os.path.join(work_dir, task["output"])
+            # The outputs of a former run in the same work directory
+            for stale in [output, output + ".error"]:
+                if os.path.exists(stale):
+                    os.remove(stale)
+            outputs.setdefault(key, []).append(output)
+            path = os.path.join(work_dir, "tasks", name)
+            with open(path + ".tmp", "w") as f:
+                json.dump(task, f)
+            os.replace(path + ".tmp", path + ".json")
+
+    pending = [path for paths in outputs.values() for path in paths]
+    while pending:
+        for path in pending:
+            if os.path.exists(path + ".error"):
+                with open(path + ".error") as f:
+                    raise RuntimeError(f"{os.path.basename(path)} failed:\n{f.read()}")
+        if all(worker.poll() is not None for worker in workers):
+            raise RuntimeError("Every local worker exited")
+        pending = [path for path in pending if not os.path.exists(path)]
+        time.sleep(0.01)
+    return {
+        key: pl.concat([pl.read_ipc(path) for path in paths])
+        for key, paths in outputs.items()
+    }
+
+
+def distributed_features(
+    df: pl.DataFrame,
+    spec: list,
+    exclude: set = frozenset(),
+    workers: int = 2,
+    work_dir: str = None,
+):
+    """
+    Return add_features(add_time_features(df), spec, exclude) of the prepared
+    transactions of df, aggregated by workers processes in hashed key shards.
+    """
+    spec = prune_spec(spec, exclude)
+    keys = list(dict.fromkeys(f.key for f in spec if f.key is not None))
+    temporary = work_dir is None
+    work_dir = tempfile.mkdtemp() if temporary else work_dir
+    os.makedirs(os.path.join(work_dir, "tasks"), exist_ok=True)
+    finished = os.path.join(work_dir, "finished")
+    if os.path.exists(finished):
+        os.remove(finished)
+
+    # The cores are shared by the local workers
+    env = dict(os.environ)
+    env["POLARS_MAX_THREADS"] = str(max(1, (os.cpu_count() or 1) // workers))
+    local = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), work_dir], env=env)
+        for _ in range(workers)
+    ]
+    try:
+        # Stage 1: the time features of each chid
+        aggregates = run_stage(work_dir, df, "time", ["chid"], workers, exclude, local)
+        df = relative_time_features(join_keyed(df, aggregates["chid"], "chid"))
+        # Stage 2: the keyed features, the span features need loctm_span
+        columns = df.columns
+        aggregates = run_stage(work_dir, df, "keyed", keys, workers, exclude, local)
+        for key in keys:
+            df = join_keyed(df, aggregates[key], key)
+        return add_row_features(df, spec, columns, exclude)
+    finally:
+        open(finished, "w").close()
+        for worker in local:
+            worker.wait()
+        if temporary:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    work(sys.argv[1])
@@ -1,40 +1,120 @@
 """
-Use EDA tools to recognize low correlation columns
+Recognize low correlation columns
+
+Compute the Spearman correlation of every engineered column of real_train.arrow
+(preprocess.py --keep-all) with the label in one columnar pass, each column is
+ranked once and the columns are ranked in parallel by polars. Write the
+correlations to spearman.csv and the drop list of each threshold to
+drop_lists.json, read by excluded_columns/drop_columns of preprocess_utils.py.
 """
-from dataprep import eda as dpeda
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
 import polars as pl
+from feature_spec import raw_cols
+from keyed_splits import read_split, remove_keyed
+from preprocess_utils import drop_columns, drop_lists_path
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--thresholds",
+    type=float,
+    nargs="+",
+    default=[0, 0.01, 0.02],
+    help="Write a drop list of the columns with |correlation| <= each threshold",
+)
+parser.add_argument("--output", default=drop_lists_path)
+parser.add_argument(
+    "--apply",
+    type=float,
+    default=None,
+    metavar="THRESHOLD",
+    help="Drop the columns of this threshold from every real_*.arrow instead of "
+    "running preprocess.py again",
+)
+
+
+def valid(df: pl.DataFrame, column: str):
+    """Return the mask of the rows with a value, neither null nor NaN."""
+    mask = pl.col(column).is_not_null()
+    if df.schema[column] in [pl.Float32, pl.Float64]:
+        mask = mask & pl.col(column).is_not_nan()
+    return mask
+
+
+def spearman(df: pl.DataFrame, columns: list, target: str = "label"):
+    """
+    Return the Spearman correlation of each column with target, the rows
+    without a value of the column are left out like pandas does.
+    """
+    missing = df.select([(~valid(df, c)).sum().alias(c) for c in columns]).row(0)
+    # The average ranks of the target, shared by the columns without missing
+    # values: an eager select has no common subexpression elimination, so the
+    # rank is computed once as a column
+    df = df.with_columns(pl.col(target).rank().alias("_target_rank"))
+    target_rank = pl.col("_target_rank")
+    exprs = []
+    for c, n in zip(columns, missing):
+        if n == 0:
+            exprs.append(pl.corr(pl.col(c).rank(), target_rank).alias(c))
+        else:
+            # Rank the column and the target over the rows with a value
+            mask = valid(df, c)
+            exprs.append(
+                pl.corr(
+                    pl.col(c).filter(mask).rank(), pl.col(target).filter(mask).rank()
+                ).alias(c)
+            )
+    # The expressions of one select run in the polars thread pool
+    correlations = df.select(exprs).row(0)
+    return pl.DataFrame(
+        {"column": columns, "spearman": np.array(correlations, np.float64)}
+    )
+
+
+def threshold_lists(correlations: pl.DataFrame, thresholds: list):
+    """
+    Return the columns of each threshold, |correlation| in (the previous
+    threshold, threshold], like drop_lists. The correlations are rounded to 2
+    decimals as they were read from the reports, a constant column is 0.
+    """
+    strength = correlations["spearman"].fill_nan(0).fill_null(0).abs().round(2)
+    lists, lower = {}, -np.inf
+    for t in sorted(thresholds):
+        mask = (strength > lower) & (strength <= t)
+        lists[t] = correlations["column"].filter(mask).to_list()
+        lower = t
+    return lists
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    # Training data preprocessed with --keep-all
+    df = read_split("real_train.arrow")
+    # The engineered columns, the time features included
+    columns = [c for c in df.columns if c not in raw_cols + ["label"]]
+    correlations = spearman(df, columns)
+    correlations.with_columns(abs=pl.col("spearman").abs()).sort(
+        "abs", descending=True
+    ).write_csv("spearman.csv")
+
+    lists = threshold_lists(correlations, args.thresholds)
+    with open(args.output, "w") as f:
+        json.dump({str(t): cols for t, cols in lists.items()}, f, indent=2)
+    for t, cols in lists.items():
+        print(f"|correlation| <= {t}: {len(cols)} columns")
 
-df = pl.read_csv("train.csv", ignore_errors=True)
-
-# EDA for added numerical columns
-count_cols = "^.*count$"
-mean_cols = "^.*mean$"
-std_cols = "^.*std$"
-dev_cols = "^.*dev$"
-
-cols_list = [count_cols, mean_cols, std_cols, dev_cols]
-filenames = ["count", "mean", "std", "dev"]
-for cols, filename in zip(cols_list, filenames):
-    out = df.select(pl.col(cols), pl.col("label")).to_pandas()
-    report = dpeda.create_report(out, title=f"ESun {cols} Data")
-    report.save(f"esun2023_{filename}_eda")
-
-# EDA for added NA counting (group by another coumn) column
-NA_cols = ["etymd", "mcc", "stocn", "scity", "stscd", "hcefg", "csmcu"]
-cols_list = [f"^{nc}.*NAs$" for nc in NA_cols]
-for nc, cols in zip(NA_cols, cols_list):
-    out = df.select(pl.col(cols), pl.col("label")).to_pandas()
-    report = dpeda.create_report(out, title=f"ESun {cols} Data")
-    report.save(f"esun2023_{nc}_NAs_eda")
-
-# EDA for added binary summing (group by another coumn) column
-bin_cols = ["ecfg", "insfg", "bnsfg", "ovrlt", "flbmk", "flg_3dsmk"]
-cols_list = [f"^{bc}.*1$" for bc in bin_cols]
-for bc, cols in zip(bin_cols, cols_list):
-    out = df.select(pl.col(cols), pl.col("label")).to_pandas()
-    report = dpeda.create_report(out, title=f"ESun {cols} Data")
-    report.save(f"esun2023_{bc}_sum_eda")
-
-out = df.select(pl.col(f"^.*span.*$"), pl.col("label")).to_pandas()
-report = dpeda.create_report(out, title=f"ESun Time Span Data")
-report.save(f"esun2023_time_span_eda")
+    if args.apply is not None:
+        for path in sorted(glob.glob("real_*.arrow")):
+            # Memory-mapped (with real_keyed joined in), the new file is
+            # written beside it and replaces it
+            out = drop_columns(read_split(path), args.apply)
+            out.write_ipc(path + ".tmp")
+            os.replace(path + ".tmp", path)
+            print(path, out.shape)
+        # The splits are written whole
+        remove_keyed()
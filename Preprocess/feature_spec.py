@@ -0,0 +1,273 @@
+"""
+Feature spec of the preprocessing pipeline
+
+Every engineered column is declared once as a Feature. Features with a grouping
+key are aggregated together in one window context per key, features without a
+key are computed row-wise afterwards.
+"""
+from typing import NamedTuple, Optional, Tuple
+
+import polars as pl
+import profiling
+from segments import segment_features
+
+# Schema of the raw data, the narrowest type that holds each column
+raw_schema = {
+    "txkey": pl.Utf8,
+    "locdt": pl.Int16,
+    "loctm": pl.Int32,
+    "chid": pl.Utf8,
+    "cano": pl.Utf8,
+    "contp": pl.Int8,
+    "etymd": pl.Int8,
+    "mchno": pl.Utf8,
+    "acqic": pl.Utf8,
+    "mcc": pl.Int16,
+    "conam": pl.Float64,
+    "ecfg": pl.Int8,
+    "insfg": pl.Int8,
+    "iterm": pl.Int8,
+    "bnsfg": pl.Int8,
+    "flam1": pl.Int32,
+    "stocn": pl.Int16,
+    "scity": pl.Int32,
+    # Read as strings, encoded by categories.py like the other categoricals
+    "stscd": pl.Utf8,
+    "ovrlt": pl.Int8,
+    "flbmk": pl.Int8,
+    "hcefg": pl.Int8,
+    "csmcu": pl.Int16,
+    "flg_3dsmk": pl.Int8,
+    "label": pl.Int8,
+}
+# Columns of the raw data, kept as model inputs
+raw_cols = [c for c in raw_schema if c != "label"]
+# Columns with missing values
+NA_cols = ["etymd", "mcc", "stocn", "scity", "stscd", "hcefg", "csmcu"]
+# Binary class columns
+bin_cols = ["ecfg", "insfg", "bnsfg", "ovrlt", "flbmk", "flg_3dsmk"]
+# Group by these columns to compute the statistics of the time span
+span_cols = ["cano", "mchno", "acqic", "stocn", "scity"]
+# Group by these columns to count the transactions
+count_cols = ["chid", "cano", "mchno", "acqic", "stocn", "scity"]
+# id columns
+id_class = ["chid", "cano", "mchno", "acqic"]
+# multiclass columns, "scity" is ignored
+multiclass = ["contp", "etymd", "mcc", "stocn", "csmcu"]
+# binary class columns, "bnsfg" is ignored
+binary_class = ["ecfg", "insfg", "stscd", "ovrlt", "flbmk", "flg_3dsmk"]
+
+
+class Feature(NamedTuple):
+    # Name of the output column
+    name: str
+    # Grouping key of an aggregation, None for a row-wise expression
+    key: Optional[str]
+    # Aggregation (key is not None) or row-wise (key is None) expression
+    expr: pl.Expr
+    # Output type, None keeps the type of the expression
+    dtype: Optional[pl.PolarsDataType] = None
+    # (statistic, column) of an aggregation, the statistics can be merged and
+    # updated incrementally, see feature_store.py
+    agg: Optional[Tuple[str, Optional[str]]] = None
+
+
+# Expressions of the aggregations, in polars 0.19 count(column) also counts the
+# nulls like count()
+agg_exprs = {
+    "count": lambda col: pl.count() if col is None else pl.count(col),
+    # Accumulate the mean in Float64, e.g. of the Float32 loctm_span
+    "mean": lambda col: pl.col(col).cast(pl.Float64).mean(),
+    "std": lambda col: pl.col(col).std(),
+    "null_count": lambda col: pl.col(col).null_count(),
+    "sum": lambda col: pl.col(col).sum(),
+}
+
+
+def keyed(name: str, key: str, stat: str, col: str = None, dtype=pl.UInt32):
+    """Return the feature of a statistic of col aggregated over key."""
+    return Feature(name, key, agg_exprs[stat](col), dtype, (stat, col))
+
+
+def _conam_features(cols: list):
+    spec = []
+    # Compute the mean of conam
+    for col in cols:
+        spec.append(keyed(f"{col}_conam_mean", col, "mean", "conam", pl.Float32))
+    # Compute the std of conam
+    for col in cols:
+        spec.append(keyed(f"{col}_conam_std", col, "std", "conam", pl.Float32))
+    # Compute the deviation of conam
+    for col in cols:
+        spec.append(
+            Feature(
+                f"{col}_conam_dev",
+                None,
+                (pl.col("conam") - pl.col(f"{col}_conam_mean"))
+                / pl.col(f"{col}_conam_std"),
+                pl.Float32,
+            )
+        )
+    # Compute the number of NA in NA existed columns
+    for col in cols:
+        for nc in NA_cols:
+            spec.append(keyed(f"{nc}_in_{col}_NAs", col, "null_count", nc))
+    # Compute the number of "1" in binary class columns
+    for col in cols:
+        for bc in bin_cols:
+            spec.append(keyed(f"{bc}_in_{col}_1", col, "sum", bc))
+    return spec
+
+
+def build_feature_spec():
+    """Return the features after the chid time features, in output column order."""
+    spec = []
+    for col in span_cols:
+        spec.append(keyed(f"{col}_span_mean", col, "mean", "loctm_span", pl.Float32))
+        # Kept as the mean of loctm_span to reproduce the published features
+        spec.append(keyed(f"{col}_span_std", col, "mean", "loctm_span", pl.Float32))
+        spec.append(
+            Feature(
+                f"{col}_span_dev",
+                None,
+                (pl.col("loctm_span") - pl.col(f"{col}_span_mean"))
+                / pl.col(f"{col}_span_std"),
+                pl.Float32,
+            )
+        )
+
+    # Compute the difference between real pay and conam
+    spec.append(Feature("pay_diff", None, pl.col("conam") - pl.col("flam1")))
+
+    # Count the times of each categorical column
+    for col in count_cols:
+        spec.append(keyed(f"{col}_count", col, "count"))
+    # Count the number of cities in each country
+    spec.append(keyed("scity_in_stocn_count", "stocn", "count", "scity"))
+
+    # Mark is NA as a column
+    for nc in NA_cols:
+        spec.append(Feature(f"{nc}_is_NAs", None, pl.col(nc).is_null(), pl.Int8))
+
+    spec += _conam_features(id_class)
+    spec += _conam_features(multiclass)
+    spec += _conam_features(binary_class)
+    return spec
+
+
+def required_columns(spec: list, keep: list = raw_cols):
+    """Return the raw columns (and label) to read for the spec and kept columns."""
+    # The time features need chid, locdt and loctm
+    columns = set(keep) | {"label", "chid", "locdt", "loctm"}
+    for f in spec:
+        if f.key is not None:
+            columns.add(f.key)
+        columns.update(f.expr.meta.root_names())
+    return [c for c in raw_cols + ["label"] if c in columns]
+
+
+def aggregate_dtype(dtype: pl.PolarsDataType):
+    """
+    Return the type of a keyed feature of output type dtype until the row
+    features are computed from it, a Float32 mean or std is kept as Float64 and
+    narrowed by add_row_features.
+    """
+    return pl.Float64 if dtype == pl.Float32 else dtype
+
+
+def _output(f: Feature, expr: pl.Expr):
+    if f.dtype is not None:
+        expr = expr.cast(f.dtype)
+    return expr.alias(f.name)
+
+
+def prune_spec(spec: list, exclude: set):
+    """Remove the excluded features unless a kept feature is computed from them."""
+    names = {f.name for f in spec}
+    needed = set()
+    kept = []
+    # A feature only depends on features declared before it
+    for f in reversed(spec):
+        if f.name in exclude and f.name not in needed:
+            continue
+        kept.append(f)
+        needed.update(names & set(f.expr.meta.root_names()))
+    return kept[::-1]
+
+
+def keyed_aggregations(spec: list, key: str):
+    """
+    Return the group_by aggregations of the features of spec over key and their
+    aggregate_dtype, cast after the aggregation like the windows of
+    add_features.
+    """
+    features = [f for f in spec if f.key == key]
+    exprs = [f.expr.alias(f.name) for f in features]
+    return exprs, {
+        f.name: aggregate_dtype(f.dtype) for f in features if f.dtype is not None
+    }
+
+
+def join_keyed(df: pl.DataFrame, aggregates: pl.DataFrame, key: str):
+    """
+    Left join the aggregates of each value of key to the rows of df. The null
+    key gets the aggregates of its own group like in .over(key), whatever the
+    polars version: the join is on the key filled with a placeholder and its
+    null mask, the later polars versions no longer match null keys.
+    """
+    fill = "" if df.schema[key] == pl.Utf8 else 0
+    on = [
+        pl.col(key).fill_null(fill).alias("_join_key"),
+        pl.col(key).is_null().alias("_join_null"),
+    ]
+    df = df.with_columns(on)
+    aggregates = aggregates.with_columns(on).drop(key)
+    df = df.join(aggregates, on=["_join_key", "_join_null"], how="left")
+    return df.drop(["_join_key", "_join_null"])
+
+
+def add_features(
+    df: pl.DataFrame, spec: list, exclude: set = frozenset(), indexes: dict = None
+):
+    """
+    Compute the features of spec with one window context per key, the excluded
+    columns are not computed (unless needed by another feature) nor returned.
+    The keys of indexes (SegmentIndex of segments.py, df collected) are
+    aggregated over their sorted segments instead.
+    """
+    spec = prune_spec(spec, exclude)
+    indexes = indexes or {}
+    if indexes and isinstance(df, pl.LazyFrame):
+        raise ValueError("The segment indexes need the collected rows")
+    columns = df.columns
+    keys = list(dict.fromkeys(f.key for f in spec if f.key is not None))
+    for key in keys:
+        # The row features are computed from the Float64 aggregates
+        features = [
+            f._replace(dtype=aggregate_dtype(f.dtype)) for f in spec if f.key == key
+        ]
+        with profiling.step(f"family_{key}", df) as s:
+            if key in indexes:
+                df = df.with_columns(segment_features(df, features, indexes[key]))
+            else:
+                # The windows over the same key share one grouping, null keys are
+                # aggregated as their own group like the per-feature joins did
+                df = df.with_columns([_output(f, f.expr.over(key)) for f in features])
+            s.output(df)
+    with profiling.step("row_features", df) as s:
+        df = add_row_features(df, spec, columns, exclude)
+        s.output(df)
+    return df
+
+
+def add_row_features(df: pl.DataFrame, spec: list, columns: list, exclude: set):
+    """
+    Compute the row-wise features of a pruned spec once its keyed features are
+    columns of df, narrow the keyed features to their output types and select
+    the columns and the features in spec order.
+    """
+    df = df.with_columns([_output(f, f.expr) for f in spec if f.key is None])
+    df = df.with_columns(
+        [pl.col(f.name).cast(f.dtype) for f in spec if f.key and f.dtype is not None]
+    )
+    return df.select([c for c in columns + [f.name for f in spec] if c not in exclude])
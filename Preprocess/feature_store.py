@@ -0,0 +1,529 @@
+"""
+Incremental feature store
+
+Keep mergeable statistics (count, mean and M2 of Welford, null counts, sums)
+of every value of the grouping keys, so the features of a new transaction are
+computed without reading the history again. A transaction updates the
+statistics of its key values in O(1), but its new loctm_span changes the span
+means of every value its chid was paired with before: the update also walks
+the (key, value) pairs of its chid, a cost that grows with the distinct
+cano/mchno/acqic/stocn/scity of the cardholder, not with the whole history.
+The features are the same as add_time_features and add_features over the
+history and the new transactions.
+"""
+import os
+
+import numpy as np
+import polars as pl
+from feature_spec import add_row_features, aggregate_dtype, prune_spec
+from time_features import relative_time_features
+
+# Statistics of each chid for the time features, first/prev/last in file order
+time_stats = ["n", "first", "prev", "last", "min", "max"]
+
+
+def stat_names(agg: tuple):
+    """Return the statistics to keep for the aggregation (stat, col) of a Feature."""
+    stat, col = agg
+    if stat == "count":
+        # count(col) also counts the nulls
+        return ["n"]
+    if stat == "mean" and col == "loctm_span":
+        # loctm_span of a transaction changes with every new transaction of its
+        # chid, the sum is updated through the transactions of each chid
+        return ["n", "span_sum"]
+    if stat in ["mean", "std"]:
+        return [f"{col}_n", f"{col}_mean", f"{col}_m2"]
+    if stat == "null_count":
+        return [f"{col}_nulls"]
+    if stat == "sum":
+        return [f"{col}_sum"]
+    raise ValueError(f"Unknown statistic: {stat}")
+
+
+def partial_exprs(stats: list):
+    """Return the expressions of the statistics over a group of transactions."""
+    exprs = []
+    for s in stats:
+        col = s.rsplit("_", 1)[0]
+        if s == "n":
+            expr = pl.count()
+        elif s == "span_sum":
+            expr = pl.col("loctm_span").cast(pl.Float64).sum()
+        elif s.endswith("_n"):
+            expr = pl.col(col).is_not_null().sum()
+        elif s.endswith("_mean"):
+            expr = pl.col(col).mean()
+        elif s.endswith("_m2"):
+            expr = pl.col(col).var(ddof=0) * pl.col(col).is_not_null().sum()
+        elif s.endswith("_nulls"):
+            expr = pl.col(col).null_count()
+        elif s.endswith("_sum"):
+            expr = pl.col(col).sum()
+        exprs.append(expr.cast(pl.Float64).fill_null(0).alias(s))
+    return exprs
+
+
+def stat_values(agg: tuple, table, rows: np.ndarray):
+    """Return the feature values of the aggregation at rows of table, NaN is null."""
+    stat, col = agg
+    data = table.data[rows]
+    c = table.col
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if stat == "count":
+            return data[:, c["n"]]
+        if stat == "mean" and col == "loctm_span":
+            return data[:, c["span_sum"]] / data[:, c["n"]]
+        n = data[:, c.get(f"{col}_n", 0)]
+        if stat == "mean":
+            return np.where(n > 0, data[:, c[f"{col}_mean"]], np.nan)
+        if stat == "std":
+            std = np.sqrt(data[:, c[f"{col}_m2"]] / (n - 1))
+            return np.where(n > 1, std, np.nan)
+        if stat == "null_count":
+            return data[:, c[f"{col}_nulls"]]
+        return data[:, c[f"{col}_sum"]]
+
+
+def merge_stats(stats: list, a: np.ndarray, b: np.ndarray):
+    """
+    Merge the statistics b of some transactions into the statistics a of other
+    transactions of the same values, the counts and sums are added and the
+    means and M2 are merged with the formula of Chan et al.
+    """
+    out = a + b
+    col = {s: i for i, s in enumerate(stats)}
+    for s in stats:
+        if s.endswith("_n"):
+            c = s[: -len("_n")]
+            i, m, m2 = col[s], col[f"{c}_mean"], col[f"{c}_m2"]
+            na, nb, n = a[:, i], b[:, i], out[:, i]
+            delta = b[:, m] - a[:, m]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                # Keep the exact mean of one side if the other one is empty
+                mean = np.where(nb == 0, a[:, m], a[:, m] + delta * nb / n)
+                out[:, m] = np.where(na == 0, b[:, m], mean)
+                out[:, m2] = np.where(
+                    (na == 0) | (nb == 0),
+                    a[:, m2] + b[:, m2],
+                    a[:, m2] + b[:, m2] + delta**2 * na * nb / n,
+                )
+    return out
+
+
+def merge_time(a: np.ndarray, b: np.ndarray):
+    """Merge the time statistics b of later transactions into a, by chid."""
+    new = a[:, 0] == 0
+    n = a[:, 0] + b[:, 0]
+    first = np.where(new, b[:, 1], a[:, 1])
+    # The row above the last one is the last former one if b has one row
+    prev = np.where(b[:, 0] > 1, b[:, 2], a[:, 3])
+    lo = np.where(new, b[:, 4], np.minimum(a[:, 4], b[:, 4]))
+    hi = np.where(new, b[:, 5], np.maximum(a[:, 5], b[:, 5]))
+    return np.stack([n, first, prev, b[:, 3], lo, hi], axis=1)
+
+
+def span(n, first, last):
+    """loctm_span of a chid: the mean period between its transactions, as Float32."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(n > 1, (last - first) / (n - 1), 0).astype(np.float32)
+
+
+class KeyTable:
+    """
+    Float64 statistics of each value of a key, the values are indexed by a dict.
+    The last row of data is always zeros, the row -1 of a missing value.
+    """
+
+    def __init__(self, stats: list, values: list = (), data: np.ndarray = None):
+        self.stats = stats
+        self.col = {s: i for i, s in enumerate(stats)}
+        self.values = list(values)
+        self.index = {v: i for i, v in enumerate(self.values)}
+        self.data = np.zeros((len(self.values) + 1, len(stats)))
+        if data is not None:
+            self.data[: len(self.values)] = data
+
+    def row(self, value):
+        """Return the row of value, a new value gets a row of zeros."""
+        i = self.index.get(value)
+        if i is None:
+            i = len(self.values)
+            self.index[value] = i
+            self.values.append(value)
+            if i + 1 == len(self.data):
+                # Double the capacity, the new rows are zeros
+                self.data = np.vstack([self.data, np.zeros_like(self.data)])
+        return i
+
+    def add_rows(self, values: list):
+        """Return the rows of values, the new values are added."""
+        return np.fromiter((self.row(v) for v in values), np.int64)
+
+    def rows(self, values: list):
+        """Return the rows of values, -1 for a missing value."""
+        return np.fromiter((self.index.get(v, -1) for v in values), np.int64)
+
+    def to_frame(self):
+        data = self.data[: len(self.values)]
+        return pl.DataFrame(
+            [pl.Series("value", self.values, pl.Utf8)]
+            + [pl.Series(s, data[:, i]) for s, i in self.col.items()]
+        )
+
+    @classmethod
+    def from_frame(cls, df: pl.DataFrame, stats: list):
+        return cls(stats, df["value"].to_list(), df.select(stats).to_numpy())
+
+
+class FeatureStore:
+    """
+    Statistics of every key of the (pruned) feature spec, built from the
+    history with build() and updated with update(). features() returns the
+    features of transactions from the statistics.
+    """
+
+    def __init__(self, spec: list, exclude: set = frozenset()):
+        self.spec = prune_spec(spec, exclude)
+        self.exclude = exclude
+        # The statistics of each key
+        self.stats = {}
+        for f in self.spec:
+            if f.key is not None:
+                stats = self.stats.setdefault(f.key, [])
+                stats += [s for s in stat_names(f.agg) if s not in stats]
+        self.tables = {key: KeyTable(stats) for key, stats in self.stats.items()}
+        self.time = KeyTable(time_stats)
+        # The keys of the span features, the number of transactions of each
+        # (chid, key, value) is kept to update the span sums of a chid
+        self.span_keys = [k for k in self.stats if "span_sum" in self.stats[k]]
+        # The pairs of each chid are pair_key[i], pair_row[i], pair_n[i] for i
+        # in pair_offsets[chid row]:pair_offsets[chid row + 1], the pairs of
+        # the new chids or new values are in pair_extra
+        self.pair_offsets = np.zeros(1, np.int64)
+        self.pair_key = np.zeros(0, np.int64)
+        self.pair_row = np.zeros(0, np.int64)
+        self.pair_n = np.zeros(0)
+        self.pair_extra = {}
+
+    def _key_values(self, df: pl.DataFrame):
+        # The values of the keys as strings, the codes of the categorical columns too
+        keys = ["chid"] + list(self.stats)
+        return df.select([pl.col(k).cast(pl.Utf8) for k in dict.fromkeys(keys)])
+
+    def build(self, df: pl.DataFrame):
+        """Build the statistics from the prepared history in file order."""
+        self.__init__(self.spec, self.exclude)
+        return self.merge(df)
+
+    def merge(self, df: pl.DataFrame):
+        """
+        Add the prepared transactions of df in file order in bulk: the
+        statistics of df are computed with group_by and merged into the store,
+        only the rows of the values in df are touched.
+        """
+        time = df.group_by("chid", maintain_order=True).agg(
+            n=pl.count(),
+            first=pl.col("loctm").first(),
+            # The row above the last one, tail(2).first() is wrong in group_by
+            prev=pl.col("loctm").shift().last(),
+            last=pl.col("loctm").last(),
+            min=pl.col("loctm").min(),
+            max=pl.col("loctm").max(),
+        )
+        time = time.with_columns(pl.all().exclude("chid").cast(pl.Float64))
+        chid_rows = self.time.add_rows(time["chid"].to_list())
+        old = self.time.data[chid_rows]
+        new = merge_time(old, time.select(time_stats).to_numpy())
+        self.time.data[chid_rows] = new
+        s_old = span(old[:, 0], old[:, 1], old[:, 3])
+        s_new = span(new[:, 0], new[:, 1], new[:, 3])
+        # Every former transaction of the chids changes from s_old to s_new
+        self._shift_spans(chid_rows, s_new.astype(np.float64) - s_old)
+
+        # loctm_span of each new transaction is the new span of its chid
+        df = df.join(
+            time.select(
+                "chid", loctm_span=pl.Series(s_new), chid_row=pl.Series(chid_rows)
+            ),
+            on="chid",
+        )
+        pairs = []
+        for i, (key, stats) in enumerate(self.stats.items()):
+            # Group by the values as strings, the key itself may be aggregated
+            value = pl.col(key).cast(pl.Utf8).alias("value")
+            partial = df.group_by(value, maintain_order=True).agg(partial_exprs(stats))
+            table = self.tables[key]
+            rows = table.add_rows(partial["value"].to_list())
+            table.data[rows] = merge_stats(
+                stats, table.data[rows], partial.select(stats).to_numpy()
+            )
+            if key in self.span_keys:
+                rows = partial.select("value", row=pl.Series(rows))
+                pairs.append(
+                    df.group_by(["chid_row", value])
+                    .agg(n=pl.count().cast(pl.Float64))
+                    .join(rows, on="value")
+                    .select("chid_row", key=pl.lit(i, pl.Int64), row="row", n="n")
+                )
+        if pairs:
+            self._add_pairs(pl.concat(pairs))
+        return self
+
+    def _shift_spans(self, chid_rows: np.ndarray, delta: np.ndarray):
+        # Add n x delta of each pair of the chids to the span sums
+        self._add_pairs()
+        keep = chid_rows + 1 < len(self.pair_offsets)
+        chid_rows, delta = chid_rows[keep], delta[keep]
+        index, length = self._pair_index(chid_rows)
+        shift = self.pair_n[index] * np.repeat(delta, length)
+        for k, key in enumerate(self.stats):
+            if key in self.span_keys:
+                table = self.tables[key]
+                mask = self.pair_key[index] == k
+                np.add.at(
+                    table.data[:, table.col["span_sum"]],
+                    self.pair_row[index][mask],
+                    shift[mask],
+                )
+
+    def _pair_index(self, chid_rows: np.ndarray):
+        # The indices of the pairs of the chids, one range per chid
+        start = self.pair_offsets[chid_rows]
+        length = self.pair_offsets[chid_rows + 1] - start
+        index = np.repeat(start - np.cumsum(length) + length, length) + np.arange(
+            length.sum()
+        )
+        return index, length
+
+    def touched(self, df: pl.DataFrame):
+        """
+        Return the values of each key (chid included) whose features changed
+        when the transactions of df were merged: the values in df and, for
+        the span sums, every value paired with a chid of df.
+        """
+        self._add_pairs()
+        key_values = self._key_values(df)
+        touched = {k: set(key_values[k].unique()) for k in key_values.columns}
+        chid_rows = self.time.rows(list(touched["chid"]))
+        index, _ = self._pair_index(chid_rows[chid_rows >= 0])
+        for k, key in enumerate(self.stats):
+            if key in self.span_keys:
+                values = self.tables[key].values
+                rows = np.unique(self.pair_row[index][self.pair_key[index] == k])
+                touched[key].update(values[r] for r in rows)
+        return touched
+
+    def _add_pairs(self, pairs: pl.DataFrame = None):
+        # Sort the pairs, pair_extra and the new pairs by chid
+        chid_rows = np.repeat(
+            np.arange(len(self.pair_offsets) - 1), np.diff(self.pair_offsets)
+        )
+        extra = [
+            (c, k, r, n)
+            for c, pairs_of_chid in self.pair_extra.items()
+            for (k, r), n in pairs_of_chid.items()
+        ]
+        extra = np.array(extra, np.float64).reshape(-1, 4)
+        if pairs is None:
+            pairs = np.zeros((0, 4))
+        else:
+            pairs = pairs.select(["chid_row", "key", "row", "n"]).to_numpy()
+        chid_rows = np.concatenate([chid_rows, extra[:, 0], pairs[:, 0]])
+        order = np.argsort(chid_rows, kind="stable")
+        self.pair_offsets = np.searchsorted(
+            chid_rows[order], np.arange(self.time.data.shape[0])
+        )
+        self.pair_key = np.concatenate(
+            [self.pair_key, extra[:, 1], pairs[:, 1]]
+        ).astype(np.int64)[order]
+        self.pair_row = np.concatenate(
+            [self.pair_row, extra[:, 2], pairs[:, 2]]
+        ).astype(np.int64)[order]
+        self.pair_n = np.concatenate([self.pair_n, extra[:, 3], pairs[:, 3]])[order]
+        self.pair_extra = {}
+
+    def update(self, df: pl.DataFrame):
+        """
+        Add the prepared transactions of df in file order. A transaction costs
+        O(1) per key plus O(pairs of its chid) for the span sums.
+        """
+        # The columns of the statistics, e.g. conam of conam_mean
+        columns = {
+            s.rsplit("_", 1)[0]
+            for stats in self.stats.values()
+            for s in stats
+            if s not in ["n", "span_sum"]
+        }
+        keys = list(self.tables)
+        # The whole frame is checked and read before any statistic changes, a
+        # bad transaction leaves the store as it was
+        missing = [c for c in ["chid", "loctm"] + keys if c not in df.columns]
+        missing += [c for c in sorted(columns) if c not in df.columns]
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(missing)}")
+        values = df.select(["loctm"] + sorted(columns))
+        not_numeric = [
+            c for c, t in values.schema.items() if t not in pl.NUMERIC_DTYPES
+        ]
+        if not_numeric:
+            raise ValueError(f"Not numeric columns: {', '.join(not_numeric)}")
+        if values["loctm"].null_count():
+            raise ValueError("Transactions without loctm")
+        rows = list(zip(self._key_values(df).iter_rows(), values.iter_rows(named=True)))
+        for key_values, row in rows:
+            chid = key_values[0]
+            key_values = dict(zip(dict.fromkeys(["chid"] + keys), key_values))
+            s_old, s_new, chid_row = self._update_time(chid, row["loctm"])
+            for key in keys:
+                table = self.tables[key]
+                self._update_stats(table, table.row(key_values[key]), row)
+            if self.span_keys:
+                self._update_span(chid_row, key_values, s_old, s_new)
+
+    def _update_time(self, chid, loctm: int):
+        t = self.time
+        i = t.row(chid)
+        n, first, prev, last, lo, hi = t.data[i]
+        s_old = span(n, first, last)
+        if n == 0:
+            first, lo, hi = loctm, loctm, loctm
+        t.data[i] = [n + 1, first, last, loctm, min(lo, loctm), max(hi, loctm)]
+        return s_old, span(n + 1, first, loctm), i
+
+    def _update_stats(self, table: KeyTable, i: int, row: dict):
+        d = table.data[i]
+        for s, j in table.col.items():
+            if s == "n":
+                d[j] += 1
+                continue
+            if s == "span_sum":
+                # Updated with the pairs of the chid
+                continue
+            col, stat = s.rsplit("_", 1)
+            if stat == "n":
+                # Welford update of the count, mean and M2 of col
+                value = row[col]
+                if value is not None:
+                    n = d[j] + 1
+                    delta = value - d[table.col[f"{col}_mean"]]
+                    d[table.col[f"{col}_mean"]] += delta / n
+                    d[table.col[f"{col}_m2"]] += delta * (
+                        value - d[table.col[f"{col}_mean"]]
+                    )
+                    d[j] = n
+            elif stat == "nulls":
+                d[j] += row[col] is None
+            elif stat == "sum":
+                d[j] += row[col] or 0
+
+    def _update_span(self, chid_row: int, key_values: dict, s_old, s_new):
+        # Every transaction of the chid changes from s_old to s_new, linear in
+        # the pairs of the chid
+        delta = float(s_new) - float(s_old)
+        start, end = self._pair_range(chid_row)
+        extra = self.pair_extra.setdefault(chid_row, {})
+        pairs = [
+            (self.pair_key[p], self.pair_row[p], self.pair_n[p])
+            for p in range(start, end)
+        ] + [(k, r, n) for (k, r), n in extra.items()]
+        keys = list(self.stats)
+        for k, r, n in pairs:
+            table = self.tables[keys[k]]
+            table.data[r, table.col["span_sum"]] += n * delta
+        # Add the pairs of the new transaction
+        for key in self.span_keys:
+            k = keys.index(key)
+            table = self.tables[key]
+            r = table.row(key_values[key])
+            table.data[r, table.col["span_sum"]] += float(s_new)
+            p = np.flatnonzero(
+                (self.pair_key[start:end] == k) & (self.pair_row[start:end] == r)
+            )
+            if len(p):
+                self.pair_n[start + p[0]] += 1
+            else:
+                extra[(k, r)] = extra.get((k, r), 0) + 1
+
+    def _pair_range(self, chid_row: int):
+        if chid_row + 1 < len(self.pair_offsets):
+            return self.pair_offsets[chid_row], self.pair_offsets[chid_row + 1]
+        # A new chid, its pairs are in pair_extra
+        return 0, 0
+
+    def features(self, df: pl.DataFrame):
+        """
+        Return the features of the prepared transactions in df from the
+        statistics, with the columns and types of add_features.
+        """
+        key_values = self._key_values(df)
+        rows = self.time.rows(key_values["chid"].to_list())
+        n, first, prev, last, lo, hi = self.time.data[rows].T
+        df = df.with_columns(
+            last_time=pl.Series(hi),
+            first_time=pl.Series(lo),
+            prev_loctm=pl.Series(np.where(n > 1, last - prev, 0)),
+            loctm_span=pl.Series(span(n, first, last)),
+        )
+        df = relative_time_features(df)
+        columns = df.columns
+
+        keyed = []
+        for key, table in self.tables.items():
+            rows = table.rows(key_values[key].to_list())
+            for f in self.spec:
+                if f.key == key:
+                    values = pl.Series(f.name, stat_values(f.agg, table, rows))
+                    keyed.append(values.fill_nan(None).cast(aggregate_dtype(f.dtype)))
+        df = df.with_columns(keyed)
+        return add_row_features(df, self.spec, columns, self.exclude)
+
+    def aggregates(self, key: str):
+        """
+        Return the keyed features of key for each of its values (as strings)
+        from the statistics, in their aggregate_dtype before the row features.
+        """
+        table = self.tables[key]
+        rows = np.arange(len(table.values))
+        columns = [pl.Series(key, table.values, pl.Utf8)]
+        for f in self.spec:
+            if f.key == key:
+                values = pl.Series(f.name, stat_values(f.agg, table, rows))
+                columns.append(values.fill_nan(None).cast(aggregate_dtype(f.dtype)))
+        return pl.DataFrame(columns)
+
+    def save(self, path: str):
+        """Save the statistics as Arrow IPC files in the directory path."""
+        os.makedirs(path, exist_ok=True)
+        for key, table in self.tables.items():
+            table.to_frame().write_ipc(os.path.join(path, f"{key}.arrow"))
+        self.time.to_frame().write_ipc(os.path.join(path, "chid_time.arrow"))
+        self._add_pairs()
+        pairs = pl.DataFrame(
+            {
+                "chid_row": np.repeat(
+                    np.arange(len(self.pair_offsets) - 1), np.diff(self.pair_offsets)
+                ),
+                "key": self.pair_key,
+                "row": self.pair_row,
+                "n": self.pair_n,
+            }
+        )
+        pairs.write_ipc(os.path.join(path, "span_pairs.arrow"))
+
+    def load(self, path: str):
+        """Load the statistics saved by save(), the files are memory-mapped."""
+        for key, stats in self.stats.items():
+            df = pl.read_ipc(os.path.join(path, f"{key}.arrow"), memory_map=True)
+            self.tables[key] = KeyTable.from_frame(df, stats)
+        df = pl.read_ipc(os.path.join(path, "chid_time.arrow"), memory_map=True)
+        self.time = KeyTable.from_frame(df, time_stats)
+        pairs = pl.read_ipc(os.path.join(path, "span_pairs.arrow"), memory_map=True)
+        self.pair_offsets = np.searchsorted(
+            pairs["chid_row"].to_numpy(), np.arange(self.time.data.shape[0])
+        )
+        self.pair_key = pairs["key"].to_numpy().copy()
+        self.pair_row = pairs["row"].to_numpy().copy()
+        self.pair_n = pairs["n"].to_numpy().copy()
+        self.pair_extra = {}
+        return self
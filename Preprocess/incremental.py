@@ -0,0 +1,167 @@
+"""
+Incremental preprocessing of a new split
+
+preprocess.py --store keeps the statistics of every key in a feature store.
+preprocess.py --append folds only the transactions of a new raw file into the
+store, writes the features of the new split and rewrites only the rows of the
+former real_*.arrow whose chid, cano or mchno the new transactions touch. The
+aggregates of the other keys (ecfg, stscd, etymd, ...) have a touched value in
+almost every row, they are kept once per value in real_keyed (see
+keyed_splits.py) and rewritten whole from the store, a cost of their distinct
+values and not of the history. With the segment indexes of preprocess.py
+--segments, the touched rows are read from the indexes instead of scanning the
+keys of every former row, a split without any touched row is not read, and the
+indexes are extended with the new split.
+"""
+import glob
+import os
+import time
+
+import numpy as np
+import polars as pl
+from categories import Categories, categories_path
+from feature_store import FeatureStore
+from keyed_splits import load_layout, row_keys, split_exclude, split_rows, write_keyed
+from preprocess_utils import load_data, prepare
+from segments import file_stats, load_indexes, save_indexes
+
+
+def restore_prepared(df: pl.DataFrame, columns: list):
+    """
+    Return the prepared transactions of preprocessed rows, the input of
+    FeatureStore: the raw columns in file order with the absolute "loctm".
+    """
+    df = df.with_columns((pl.col("loctm") + pl.col("first_time")).cast(pl.Int32))
+    return df.select([c for c in df.columns if c in columns and c != "label"])
+
+
+def touched_rows(df: pl.DataFrame, touched: dict, found: np.ndarray = None):
+    """
+    Return the mask of the rows with a touched value of any key, or found (the
+    mask of the rows of the indexed keys).
+    """
+    mask = pl.lit(False) if found is None else pl.lit(pl.Series(found))
+    for key, values in touched.items():
+        value = pl.col(key).cast(pl.Utf8)
+        mask = mask | value.is_in([v for v in values if v is not None])
+        if None in values:
+            mask = mask | value.is_null()
+    return df.select(mask).to_series()
+
+
+def append_split(
+    path: str,
+    mode: str,
+    store_path: str,
+    spec: list,
+    exclude: set,
+    columns: list,
+    compression: str = "uncompressed",
+    segments: str = None,
+):
+    """
+    Add the raw file path as the split real_{mode}.arrow to the outputs of the
+    previous run in the working directory and to the store in store_path, and
+    to the segment indexes in the directory segments.
+    """
+    output = f"real_{mode}.arrow"
+    if os.path.exists(output):
+        raise ValueError(f"{output} exists, the split was already added")
+    layout = load_layout()
+    if layout is None:
+        raise ValueError("No real_keyed of a preprocess.py --store run, run it again")
+    start = time.perf_counter()
+    store = FeatureStore(spec, split_exclude(spec, exclude)).load(store_path)
+    raw = load_data(path=path, mode=mode, lazy=True, columns=columns)
+    # The new values get new codes, the codes of the former splits are kept
+    categories = Categories.load(categories_path).update(raw)
+    df = prepare(raw, categories)
+    df = df.drop("set").collect()
+    label = df.select("label") if "label" in df.columns else None
+    df = df.select(pl.exclude("label"))
+    store.merge(df)
+    # The features of the other keys are read from real_keyed
+    touched = {k: v for k, v in store.touched(df).items() if k in row_keys}
+    indexes, splits, sources, found = _indexed_rows(segments, touched)
+
+    # Rewrite the touched rows of the former splits
+    order = None
+    unindexed = {k: v for k, v in touched.items() if k not in indexes}
+    for former in sorted(glob.glob("real_*.arrow")):
+        # The column order of the previous run
+        order = [c for c in pl.read_ipc_schema(former) if c != "label"]
+        mask = found.get(former)
+        if unindexed:
+            # Only the key columns are read to find the rows
+            keys = pl.read_ipc(former, columns=list(unindexed), memory_map=True)
+            mask = touched_rows(keys, unindexed, mask)
+        elif mask is not None:
+            # The indexes give the rows, a split without any is not read
+            mask = pl.Series(mask)
+        if mask is None or not mask.any():
+            print(f"{former}: no rows rewritten")
+            continue
+        print(f"{former}: {mask.sum()} of {len(mask)} rows rewritten")
+        # Memory-mapped, the rewritten split is written beside it and replaces it
+        old = pl.read_ipc(former, memory_map=True)
+        rows = old.filter(mask)
+        new = store.features(restore_prepared(rows, columns))
+        if "label" in old.columns:
+            new = new.with_columns(rows["label"])
+        new = new.select(old.columns).with_columns(row_nr=mask.arg_true())
+        old = (
+            pl.concat([old.with_row_count().filter(~mask), new], how="diagonal")
+            .sort("row_nr")
+            .drop("row_nr")
+        )
+        old.write_ipc(former + ".tmp", compression=compression)
+        os.replace(former + ".tmp", former)
+
+    keys = df.select(list(indexes))
+    df = split_rows(store.features(df), spec, exclude)
+    if order is not None and set(order) == set(df.columns):
+        df = df.select(order)
+    if label is not None:
+        df = df.with_columns(label)
+    print(df.shape)
+    df.write_ipc(output, compression=compression)
+    store.save(store_path)
+    write_keyed(store, layout["columns"], exclude)
+    if indexes:
+        for key, index in indexes.items():
+            index.extend(keys[key])
+        splits = splits + [(output, df.height)]
+        save_indexes(segments, indexes, splits, sources + file_stats([path]))
+    categories.save(categories_path)
+    print(f"{mode} added in {time.perf_counter() - start:.1f}s")
+
+
+def _indexed_rows(segments: str, touched: dict):
+    """
+    Return the saved segment indexes, their splits, the file_stats of their raw
+    files and the mask of the rows of the touched values of their keys in each
+    split, no index if they are not the indexes of the former splits.
+    """
+    if segments is None:
+        return {}, [], [], {}
+    indexes, splits, sources = load_indexes(segments)
+    formers = sorted(glob.glob("real_*.arrow"))
+    heights = {f: pl.read_ipc(f, memory_map=True).height for f in formers}
+    if not indexes or dict(splits) != heights:
+        print(f"No segment indexes of the former splits in {segments}")
+        return {}, [], [], {}
+    rows = np.concatenate(
+        [
+            index.rows(pl.Series(list(touched[key]), dtype=pl.Utf8))
+            for key, index in indexes.items()
+            if key in touched
+        ]
+        + [np.zeros(0, np.int64)]
+    )
+    found, start = {}, 0
+    for split, height in splits:
+        mask = np.zeros(height, bool)
+        mask[rows[(rows >= start) & (rows < start + height)] - start] = True
+        found[split] = mask
+        start += height
+    return indexes, splits, sources, found
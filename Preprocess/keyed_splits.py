@@ -0,0 +1,119 @@
+"""
+Splits with the aggregates of the low-cardinality keys kept apart
+
+preprocess.py --store writes real_*.arrow with the features of chid, cano and
+mchno in each row, and keeps the aggregates of the other keys (acqic, stocn,
+scity, the multiclass and the binary class columns) once per value in
+real_keyed/{key}.arrow. A value of these keys is shared by a large part of
+the rows, so a new split changes the few rows of real_keyed instead of almost
+every former row (see incremental.py). read_split joins the aggregates to the
+rows and computes the row features of them, e.g. stocn_conam_dev, with the
+columns and types of add_features. A split without real_keyed is read as is.
+"""
+import json
+import os
+import shutil
+
+import polars as pl
+from feature_spec import add_row_features, build_feature_spec, join_keyed, prune_spec
+
+# Keys aggregated in the rows of real_*.arrow
+row_keys = ["chid", "cano", "mchno"]
+# Directory of the aggregates of the other keys, beside real_*.arrow
+keyed_dir = "real_keyed"
+
+
+def deferred_features(spec: list):
+    """
+    Return the features of a pruned spec computed when the splits are read: the
+    aggregations of the keys not in row_keys and the row features of them.
+    """
+    deferred = []
+    names = set()
+    # A feature only depends on features declared before it
+    for f in spec:
+        if f.key is None:
+            if names & set(f.expr.meta.root_names()):
+                deferred.append(f)
+                names.add(f.name)
+        elif f.key not in row_keys:
+            deferred.append(f)
+            names.add(f.name)
+    return deferred
+
+
+def split_exclude(spec: list, exclude: set):
+    """
+    Return the excluded columns of the rows of real_*.arrow: the inputs of the
+    deferred row features, e.g. loctm_span, are kept until they are read.
+    """
+    deferred = deferred_features(prune_spec(spec, exclude))
+    names = {f.name for f in deferred}
+    inputs = {
+        c for f in deferred if f.key is None for c in f.expr.meta.root_names()
+    }
+    return set(exclude) - (inputs - names)
+
+
+def split_rows(df: pl.DataFrame, spec: list, exclude: set):
+    """Return the columns of the features of df kept in the rows of real_*.arrow."""
+    names = {f.name for f in deferred_features(prune_spec(spec, exclude))}
+    return df.select([c for c in df.columns if c not in names])
+
+
+def write_keyed(store, columns: list, exclude: set, path: str = "."):
+    """
+    Write the aggregates of every value of the deferred keys from the feature
+    store, and the columns (in the order of add_features, label excluded) and
+    excluded features the splits are read with, to real_keyed in path.
+    """
+    directory = os.path.join(path, keyed_dir)
+    os.makedirs(directory, exist_ok=True)
+    keys = {f.key for f in deferred_features(store.spec) if f.key is not None}
+    for key in sorted(keys):
+        # Written beside it and replaced, a reader never sees half a table
+        output = os.path.join(directory, f"{key}.arrow")
+        store.aggregates(key).write_ipc(output + ".tmp")
+        os.replace(output + ".tmp", output)
+    layout = {"columns": columns, "exclude": sorted(exclude)}
+    with open(os.path.join(directory, "layout.json"), "w") as f:
+        json.dump(layout, f, indent=2)
+
+
+def remove_keyed(path: str = "."):
+    """Remove the real_keyed in path, once the splits are written whole."""
+    shutil.rmtree(os.path.join(path, keyed_dir), ignore_errors=True)
+
+
+def load_layout(path: str = "."):
+    """Return the layout written by write_keyed in path, None without real_keyed."""
+    layout = os.path.join(path, keyed_dir, "layout.json")
+    if not os.path.exists(layout):
+        return None
+    with open(layout) as f:
+        return json.load(f)
+
+
+def read_split(path: str):
+    """
+    Memory-map the split real_*.arrow path, with the deferred features of its
+    real_keyed joined in. Only the joined and computed columns are allocated.
+    """
+    df = pl.read_ipc(path, memory_map=True)
+    directory = os.path.join(os.path.dirname(path), keyed_dir)
+    layout = load_layout(os.path.dirname(path))
+    if layout is None:
+        return df
+    exclude = set(layout["exclude"])
+    deferred = deferred_features(prune_spec(build_feature_spec(), exclude))
+    columns = df.columns
+    for key in dict.fromkeys(f.key for f in deferred if f.key is not None):
+        aggregates = pl.read_ipc(os.path.join(directory, f"{key}.arrow"))
+        # The values are kept as strings like in the store, the codes too
+        aggregates = aggregates.with_columns(pl.col(key).cast(df.schema[key]))
+        # The left join keeps the order of the rows
+        joined = join_keyed(df.select(key), aggregates, key)
+        df = df.with_columns(joined.drop(key).get_columns())
+    df = add_row_features(df, deferred, columns, exclude)
+    label = ["label"] if "label" in df.columns else []
+    return df.select(layout["columns"] + label)
@@ -3,226 +3,257 @@
 training, public 前處理包含 x 和 y
 private_1_processed 前處理只包含 x
 """
-import polars as pl
-from preprocess_utils import load_data
+import argparse
+import os
+import sys
 
-# Add this to avoid error while concatenate string columns
-pl.enable_string_cache()
-# Preprocess training data
-df_train, train_label = load_data(
-    path="dataset_1st/training.csv", mode="train", limit=None
+import polars as pl
+import profiling
+from categories import Categories, categories_path
+from preprocess_utils import (
+    categorical_cols,
+    excluded_columns,
+    load_data,
+    memory_report,
+    prepare,
+    raw_splits,
 )
-
-# Preprocess validation data
-df_valid, valid_label = load_data(
-    path="dataset_2nd/public.csv", mode="valid", limit=None
+from feature_spec import add_features, build_feature_spec, prune_spec, required_columns
+from distributed import distributed_features
+from feature_store import FeatureStore
+from incremental import append_split, restore_prepared
+from keyed_splits import remove_keyed, split_exclude, split_rows, write_keyed
+from segments import file_stats, save_indexes, segment_indexes, segment_keys
+from time_features import add_time_features
+from velocity_features import add_velocity_features
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--explain", action="store_true", help="Print the optimized query plan"
 )
-
-# Preprocess test data
-df_valid2, valid2_label = load_data(
-    path="dataset_2nd/private_1.csv", mode="valid2", limit=None
+parser.add_argument(
+    "--threshold",
+    type=float,
+    default=0.02,
+    help="Do not compute the features that |Spearman correlation| <= threshold",
 )
-
-# Preprocess new test data
-df_test = load_data(path="private_2_processed.csv", mode="test", limit=None)
-
-
-# Concatenate training/validation/test to preprocess them together
-df = pl.concat([df_train, df_valid, df_valid2, df_test])
-
-df = df.with_columns(
-    pl.col("contp").cast(str).cast(pl.Categorical),
-    pl.col("etymd").cast(str).cast(pl.Categorical),
-    pl.col("mcc").cast(str).cast(pl.Categorical),
-    pl.col("stocn").cast(str).cast(pl.Categorical),
-    pl.col("scity").cast(str).cast(pl.Categorical),
-    pl.col("hcefg").cast(str).cast(pl.Categorical),
-    pl.col("csmcu").cast(str).cast(pl.Categorical),
+parser.add_argument(
+    "--keep-all",
+    action="store_true",
+    help="Compute every feature, e.g. to rerun eda.py",
 )
-
-# Transform time column "loctm" to string and pad them to the same length = 6
-df = df.with_columns(
-    pl.col("loctm").cast(str).str.zfill(6),
+parser.add_argument(
+    "--selection",
+    default=None,
+    help="Also skip the features removed by this Model/select_features.py output",
 )
-# Transform the timestamp to seconds
-df = df.with_columns(
-    pl.col("loctm").str.slice(offset=0, length=2).alias("loctm_hh").cast(int) * 60 * 60,
-    pl.col("loctm").str.slice(offset=2, length=2).alias("loctm_mm").cast(int) * 60,
-    pl.col("loctm").str.slice(offset=4, length=2).alias("loctm_ss").cast(int),
+parser.add_argument(
+    "--compression",
+    default="uncompressed",
+    choices=["uncompressed", "lz4", "zstd"],
+    help="Compression of the Arrow IPC outputs, compressed files are not memory-mapped",
 )
-# Sum up the seconds with date as seconds
-df = df.with_columns(
-    (
-        df["locdt"] * 24 * 60 * 60 + df["loctm_hh"] + df["loctm_mm"] + df["loctm_ss"]
-    ).alias("loctm")
+parser.add_argument(
+    "--memory-report",
+    action="store_true",
+    help="Print the memory of each column of the preprocessed data",
 )
-# Drop the hour, minute, second
-df = df.drop(
-    [
-        "loctm_hh",
-        "loctm_mm",
-        "loctm_ss",
-    ]
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=0,
+    help="Aggregate the features in hashed key shards by this many worker "
+    "processes, 0 runs the single lazy query",
 )
-
-# The absolute last timestamp of buying
-last_time = df.group_by("chid").agg(pl.max("loctm").alias("last_time"))
-df = df.join(last_time, on="chid")
-
-# The absolute first timestamp of buying
-first_time = df.group_by("chid").agg(pl.min("loctm").alias("first_time"))
-df = df.join(first_time, on="chid")
-# Transform "loctm" as relative timestamp to the absolute first timestamp
-df = df.with_columns((df["loctm"] - df["first_time"]).alias("loctm"))
-
-# The relative last timestamp to the relative timestamps
-rel_last_time = df.group_by("chid").agg(pl.max("loctm").alias("rel_last_time"))
-df = df.join(rel_last_time, on="chid")
-# The period between relative last timestamp to the relative timestamps
-df = df.with_columns((df["rel_last_time"] - df["loctm"]).alias("neg_loctm"))
-
-# The previous transaction, if not, set as 0
-result_df = df.group_by("chid").agg(pl.col("loctm").diff().alias("prev_loctm"))
-result_df = result_df.with_columns(
-    result_df["prev_loctm"].map_elements(lambda x: x[-1]).fill_null(0)
+parser.add_argument(
+    "--work-dir",
+    default=None,
+    help="Shared directory of the --workers tasks, other nodes can join with "
+    "distributed.py WORK_DIR (a temporary directory by default)",
 )
-df = df.join(result_df, on="chid")
-
-
-# The transaction span, if not, set as 0
-result_df = (
-    df.group_by("chid")
-    .agg(pl.col("loctm").diff().mean().alias("loctm_span"))
-    .fill_null(0)
+parser.add_argument(
+    "--store",
+    default=None,
+    help="Directory of the feature store kept for the incremental runs",
 )
-df = df.join(result_df, on="chid")
-
-for col in ["cano", "mchno", "acqic", "stocn", "scity"]:
-    result_df = df.group_by(col).agg(pl.mean("loctm_span").alias(f"{col}_span_mean"))
-    df = df.join(result_df, on=col)
-    result_df = df.group_by(col).agg(pl.mean("loctm_span").alias(f"{col}_span_std"))
-    df = df.join(result_df, on=col)
-    df = df.with_columns(
-        ((df["loctm_span"] - df[f"{col}_span_mean"]) / df[f"{col}_span_std"]).alias(
-            f"{col}_span_dev"
-        )
-    )
-
-# Compute the difference between real pay and conam
-df = df.with_columns((df["conam"] - df["flam1"]).alias("pay_diff"))
-
-# Count the times of each categorical column
-for col in ["chid", "cano", "mchno", "acqic", "stocn", "scity"]:
-    result_df = df.group_by(col).agg(pl.count().alias(f"{col}_count"))
-    df = df.join(result_df, on=col)
-
-# Count the number of cities in each country
-result_df = df.group_by("stocn").agg(pl.count("scity").alias(f"scity_in_stocn_count"))
-df = df.join(result_df, on="stocn")
-
-# Mark is NA as a column
-NA_cols = ["etymd", "mcc", "stocn", "scity", "stscd", "hcefg", "csmcu"]
-for nc in NA_cols:
-    df = df.with_columns(pl.col(nc).is_null().cast(int).alias(f"{nc}_is_NAs"))
-
-## Preprocess id columns (group by id columns)
-# Compute the mean of conam
-id_class = ["chid", "cano", "mchno", "acqic"]
-for col in id_class:
-    result_df = df.group_by(col).agg(pl.mean("conam").alias(f"{col}_conam_mean"))
-    df = df.join(result_df, on=col)
-# Compute the std of conam
-for col in id_class:
-    result_df = df.group_by(col).agg(pl.std("conam").alias(f"{col}_conam_std"))
-    df = df.join(result_df, on=col)
-# Compute the deviation of conam
-for col in id_class:
-    df = df.with_columns(
-        ((df["conam"] - df[f"{col}_conam_mean"]) / df[f"{col}_conam_std"]).alias(
-            f"{col}_conam_dev"
-        )
-    )
-
-# Compute the number of NA in NA existed columns
-for col in id_class:
-    for nc in NA_cols:
-        result_df = df.group_by(col).agg(
-            pl.col(nc).null_count().alias(f"{nc}_in_{col}_NAs")
+parser.add_argument(
+    "--append",
+    default=None,
+    help="Only add this new raw file to the outputs and the --store of a "
+    "previous run with the same --threshold/--keep-all",
+)
+parser.add_argument(
+    "--name", default="test", help="Split name of --append, saved as real_{name}.arrow"
+)
+parser.add_argument(
+    "--profile",
+    default=None,
+    help="Write the time, CPU time, peak memory and shapes of every step to this "
+    "Chrome trace JSON, the steps are collected one by one instead of as one query",
+)
+parser.add_argument(
+    "--velocity",
+    action="store_true",
+    help="Add the count, conam sum and distinct mchno of each chid/cano over the "
+    "last 1h/24h/7d, not kept by the feature store of --store/--append",
+)
+parser.add_argument(
+    "--prev-loctm",
+    default="broadcast",
+    choices=["broadcast", "per_row"],
+    help="prev_loctm of add_time_features: the period between the last two "
+    "transactions of the chid, or since the previous transaction of each row "
+    "(not kept by the feature store of --store nor by --workers)",
+)
+parser.add_argument(
+    "--segments",
+    default=None,
+    help="Aggregate chid, cano and mchno over sorted segment indexes saved in this "
+    "directory, reused by the next runs and --append",
+)
+args = parser.parse_args()
+if args.segments is not None and args.workers > 0:
+    parser.error("--segments aggregates in this process, not with --workers")
+if args.append is not None and args.store is None:
+    parser.error("--append needs the --store of the previous run")
+if args.prev_loctm != "broadcast" and (args.store is not None or args.workers > 0):
+    parser.error("--store and --workers compute prev_loctm of the broadcast mode")
+if args.velocity and args.store is not None:
+    parser.error("--velocity features are not kept by the feature store of --store")
+if args.profile is not None:
+    if args.explain:
+        parser.error("--explain prints the single lazy query, not run with --profile")
+    profiling.enable(args.profile)
+
+# The whole preprocessing is built as one lazy query, only the columns the
+# feature spec needs are read
+spec = build_feature_spec()
+# The low correlation features are skipped before computing anything
+exclude = (
+    set() if args.keep_all else set(excluded_columns(args.threshold, args.selection))
+)
+columns = required_columns(prune_spec(spec, exclude))
+# The rows of a --store run keep the inputs of the features read from
+# real_keyed (see keyed_splits.py)
+feature_exclude = exclude if args.store is None else split_exclude(spec, exclude)
+
+if args.append is not None:
+    # Fold only the new transactions into the statistics of the previous run
+    with profiling.step(f"append_{args.name}"):
+        append_split(
+            args.append,
+            args.name,
+            args.store,
+            spec,
+            exclude,
+            columns,
+            args.compression,
+            args.segments,
         )
-        df = df.join(result_df, on=col)
+    profiling.save()
+    sys.exit()
 
-# Compute the number of "1" in binary class columns
-bin_cols = ["ecfg", "insfg", "bnsfg", "ovrlt", "flbmk", "flg_3dsmk"]
-for col in id_class:
-    for bc in bin_cols:
-        result_df = df.group_by(col).agg(pl.col(bc).sum().alias(f"{bc}_in_{col}_1"))
-        df = df.join(result_df, on=col)
+# Preprocess training data
+df_train = load_data(
+    path="dataset_1st/training.csv",
+    mode="train",
+    limit=None,
+    lazy=True,
+    columns=columns,
+)
 
-## Preprocess multiclass columns (group by these columns)
-# "scity" is ignored
-multiclass = ["contp", "etymd", "mcc", "stocn", "csmcu"]
-# Compute the mean of conam
-for col in multiclass:
-    result_df = df.group_by(col).agg(pl.mean("conam").alias(f"{col}_conam_mean"))
-    df = df.join(result_df, on=col)
-# Compute the std of conam
-for col in multiclass:
-    result_df = df.group_by(col).agg(pl.std("conam").alias(f"{col}_conam_std"))
-    df = df.join(result_df, on=col)
-# Compute the deviation of conam
-for col in multiclass:
-    df = df.with_columns(
-        ((df["conam"] - df[f"{col}_conam_mean"]) / df[f"{col}_conam_std"]).alias(
-            f"{col}_conam_dev"
-        )
-    )
+# Preprocess validation data
+df_valid = load_data(
+    path="dataset_2nd/public.csv", mode="valid", limit=None, lazy=True, columns=columns
+)
 
-# Compute the number of NA in NA existed columns
-for col in ["contp", "etymd", "mcc", "stocn", "csmcu"]:
-    for nc in NA_cols:
-        result_df = df.group_by(col).agg(
-            pl.col(nc).null_count().alias(f"{nc}_in_{col}_NAs")
-        )
-        df = df.join(result_df, on=col)
+# Preprocess test data
+df_valid2 = load_data(
+    path="dataset_2nd/private_1.csv",
+    mode="valid2",
+    limit=None,
+    lazy=True,
+    columns=columns,
+)
 
-# Compute the number of "1" in binary class columns
-for col in multiclass:
-    for bc in bin_cols:
-        result_df = df.group_by(col).agg(pl.col(bc).sum().alias(f"{bc}_in_{col}_1"))
-        df = df.join(result_df, on=col)
+# Preprocess new test data
+df_test = load_data(
+    path="private_2_processed.csv", mode="test", limit=None, lazy=True, columns=columns
+)
 
-## Preprocess binary class columns (group by these columns)
-# "bnsfg" is ignored
-binary_class = ["ecfg", "insfg", "stscd", "ovrlt", "flbmk", "flg_3dsmk"]
-# Compute the mean of conam
-for col in binary_class:
-    result_df = df.group_by(col).agg(pl.mean("conam").alias(f"{col}_conam_mean"))
-    df = df.join(result_df, on=col)
-# Compute the std of conam
-for col in binary_class:
-    result_df = df.group_by(col).agg(pl.std("conam").alias(f"{col}_conam_std"))
-    df = df.join(result_df, on=col)
-# Compute the deviation of conam
-for col in binary_class:
-    df = df.with_columns(
-        ((df["conam"] - df[f"{col}_conam_mean"]) / df[f"{col}_conam_std"]).alias(
-            f"{col}_conam_dev"
-        )
-    )
 
-# Compute the number of NA in NA existed columns
-for col in binary_class:
-    for nc in NA_cols:
-        result_df = df.group_by(col).agg(
-            pl.col(nc).null_count().alias(f"{nc}_in_{col}_NAs")
+# Concatenate training/validation/test to preprocess them together
+# The test data has no label, it is filled with null
+df = pl.concat([df_train, df_valid, df_valid2, df_test], how="diagonal")
+
+# Number the new values of the categorical columns, the codes of a former run
+# are kept
+with profiling.step("categories"):
+    if os.path.exists(categories_path):
+        categories = Categories.load(categories_path)
+    else:
+        categories = Categories(categorical_cols)
+    categories.update(df).save(categories_path)
+
+# Encode the categorical columns and transform "loctm" to seconds
+df = prepare(df, categories)
+
+# The workers and the segment indexes read the collected rows, and each profiled
+# step is collected on its own to be measured apart
+eager = args.workers > 0 or args.profile is not None or args.segments is not None
+if eager:
+    with profiling.step("load") as s:
+        df = df.collect()
+        s.output(df)
+
+if args.velocity:
+    # The rolling windows of the absolute "loctm", before it is made relative
+    with profiling.step("velocity_features", df) as s:
+        df = add_velocity_features(df)
+        s.output(df)
+
+indexes = None
+if args.workers > 0:
+    # The same features, aggregated by worker processes in key shards
+    with profiling.step("distributed_features", df) as s:
+        df = distributed_features(
+            df, spec, feature_exclude, args.workers, args.work_dir
         )
-        df = df.join(result_df, on=col)
-
-# Compute the number of "1" in binary class columns
-for col in binary_class:
-    for bc in bin_cols:
-        result_df = df.group_by(col).agg(pl.col(bc).sum().alias(f"{bc}_in_{col}_1"))
-        df = df.join(result_df, on=col)
+        s.output(df)
+else:
+    # Add the time features of each chid without any Python callback
+    with profiling.step("time_features", df) as s:
+        df = add_time_features(df, prev_loctm=args.prev_loctm)
+        s.output(df)
+
+    if args.segments is not None:
+        # The rows of the high-cardinality keys sorted by value, built once (or
+        # read from a former run) for all their aggregations
+        keys = {f.key for f in prune_spec(spec, exclude)}
+        with profiling.step("segment_indexes", df):
+            indexes = segment_indexes(
+                df,
+                [k for k in segment_keys if k in keys],
+                args.segments,
+                file_stats(list(raw_splits.values())),
+            )
+
+    # Compute the grouped statistics (span, count, conam, NAs, binary sums) with
+    # one aggregation pass per grouping key
+    df = add_features(df, spec, feature_exclude, indexes)
+
+if not eager:
+    if args.explain:
+        print(df.explain())
+    # Run the query plan once
+    df = df.collect()
+
+if args.memory_report:
+    report = memory_report(df)
+    with pl.Config(tbl_rows=-1):
+        print(report)
+    print(f"Total: {report['MB'].sum():.1f} MB")
+    print(f"Total as 64-bit types: {report['MB_64bit'].sum():.1f} MB")
 
 # city in country
 # df = df.with_columns(
@@ -231,52 +262,80 @@ for col in binary_class:
 #     )
 # )
 
+if args.store is not None:
+    # The columns of add_features, the features of the low-cardinality keys are
+    # written once per value to real_keyed from the store instead of each row
+    layout = [c for c in df.columns if c not in exclude | {"set", "label"}]
+    df = split_rows(df, spec, exclude)
+else:
+    # The splits are whole, the real_keyed of a former --store run is stale
+    remove_keyed()
+
 # Filter training data from preprocessed data
 df_train = df.filter(pl.col("set") == "train")
-# Add the label back to training data
-df_train = df_train.with_columns(label=train_label)
-# Drop the "set" column
-df_train = df_train.drop(["set"])
+# Drop the "set" column and move the label to the last column
+df_train = df_train.select(pl.exclude(["set", "label"]), pl.col("label"))
 # Check the shape
 print(df_train.shape)
 # Check the columns (usually for "label")
 print(df_train.columns)
-# Save training data as .csv
-df_train.write_csv("real_train.csv", separator=",")
+# Save training data as Arrow IPC
+with profiling.step("write_train", df_train):
+    df_train.write_ipc("real_train.arrow", compression=args.compression)
 
 # Filter validation data from preprocessed data
 df_valid = df.filter(pl.col("set") == "valid")
-# Add the label back to validation data
-df_valid = df_valid.with_columns(label=valid_label)
-# Drop the "set" column
-df_valid = df_valid.drop(["set"])
+# Drop the "set" column and move the label to the last column
+df_valid = df_valid.select(pl.exclude(["set", "label"]), pl.col("label"))
 # Check the shape
 print(df_valid.shape)
 # Check the columns (usually for "label")
 print(df_valid.columns)
-# Save validation data as .csv
-df_valid.write_csv("real_valid.csv", separator=",")
+# Save validation data as Arrow IPC
+with profiling.step("write_valid", df_valid):
+    df_valid.write_ipc("real_valid.arrow", compression=args.compression)
 
 # Filter test data from preprocessed data
 df_valid2 = df.filter(pl.col("set") == "valid2")
-# Add the label back to validation data
-df_valid2 = df_valid2.with_columns(label=valid2_label)
-# Drop the "set" column
-df_valid2 = df_valid2.drop(["set"])
+# Drop the "set" column and move the label to the last column
+df_valid2 = df_valid2.select(pl.exclude(["set", "label"]), pl.col("label"))
 # Check the shape (should be -1 with training/validation data)
 print(df_valid2.shape)
 # Check the columns (usually for "label")
 print(df_valid2.columns)
-# Save test data as .csv
-df_valid2.write_csv("real_valid2.csv", separator=",")
+# Save test data as Arrow IPC
+with profiling.step("write_valid2", df_valid2):
+    df_valid2.write_ipc("real_valid2.arrow", compression=args.compression)
 
 # Filter test data from preprocessed data
 df_test = df.filter(pl.col("set") == "test")
-# Drop the "set" column
-df_test = df_test.drop(["set"])
+# Drop the "set" column and the empty label
+df_test = df_test.drop(["set", "label"])
 # Check the shape (should be -1 with training/validation data)
 print(df_test.shape)
 # Check the columns (usually for "label")
 print(df_test.columns)
-# Save test data as .csv
-df_test.write_csv("real_test.csv", separator=",")
+# Save test data as Arrow IPC
+with profiling.step("write_test", df_test):
+    df_test.write_ipc("real_test.arrow", compression=args.compression)
+
+if indexes is not None:
+    # The rows of the indexes are the rows of the splits in this order
+    splits = [
+        ("real_train.arrow", df_train.height),
+        ("real_valid.arrow", df_valid.height),
+        ("real_valid2.arrow", df_valid2.height),
+        ("real_test.arrow", df_test.height),
+    ]
+    sources = file_stats(list(raw_splits.values()))
+    save_indexes(args.segments, indexes, splits, sources)
+
+if args.store is not None:
+    # Keep the statistics of every key for the incremental runs with --append
+    with profiling.step("feature_store", df):
+        store = FeatureStore(spec, feature_exclude)
+        store.build(restore_prepared(df, columns))
+        store.save(args.store)
+        write_keyed(store, layout, exclude)
+
+profiling.save()
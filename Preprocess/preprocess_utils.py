@@ -1,25 +1,111 @@
+import json
+import os
+
 import polars as pl
+from categories import Categories
+from feature_spec import raw_schema
+
+
+# Raw data of each split, preprocessed together
+raw_splits = {
+    "train": "dataset_1st/training.csv",
+    "valid": "dataset_2nd/public.csv",
+    "valid2": "dataset_2nd/private_1.csv",
+    "test": "private_2_processed.csv",
+}
+# Columns encoded as the codes of categories.py, categorical for the model
+categorical_cols = [
+    "contp",
+    "etymd",
+    "mcc",
+    "stocn",
+    "scity",
+    "hcefg",
+    "csmcu",
+    "stscd",
+]
+
+
+def cast_raw(df: pl.DataFrame):
+    """
+    Downcast the columns to the declared schema, the casts are strict so an out
+    of range value raises instead of overflowing.
+    """
+    return df.with_columns(
+        [pl.col(c).cast(t) for c, t in raw_schema.items() if c in df.columns]
+    )
 
 
-def load_data(path: str, mode: str, limit: int = None):
-    df = pl.read_csv(path, ignore_errors=True)
-    # Transform type of the following columns
+def prepare(df: pl.DataFrame, categories: Categories):
+    """
+    Encode the categorical columns with the codes of categories and transform
+    "loctm" to the seconds since the first day, the input of add_time_features
+    and add_features.
+    """
+    df = categories.encode(df)
+
+    # Transform time column "loctm" to string and pad them to the same length = 6
+    df = df.with_columns(
+        pl.col("loctm").cast(str).str.zfill(6),
+    )
+    # Transform the timestamp to seconds
+    df = df.with_columns(
+        pl.col("loctm").str.slice(offset=0, length=2).alias("loctm_hh").cast(int)
+        * 60
+        * 60,
+        pl.col("loctm").str.slice(offset=2, length=2).alias("loctm_mm").cast(int) * 60,
+        pl.col("loctm").str.slice(offset=4, length=2).alias("loctm_ss").cast(int),
+    )
+    # Sum up the seconds with date as seconds, widen "locdt" before multiplying
     df = df.with_columns(
-        pl.col("etymd").cast(int),
-        pl.col("mcc").cast(int),
-        pl.col("stocn").cast(int),
-        pl.col("scity").cast(int),
-        pl.col("stscd").cast(pl.Categorical),
-        pl.col("hcefg").cast(int),
-        pl.col("csmcu").cast(int),
+        (
+            pl.col("locdt").cast(pl.Int32) * 24 * 60 * 60
+            + pl.col("loctm_hh")
+            + pl.col("loctm_mm")
+            + pl.col("loctm_ss")
+        ).alias("loctm")
     )
+    # Drop the hour, minute, second
+    return df.drop(
+        [
+            "loctm_hh",
+            "loctm_mm",
+            "loctm_ss",
+        ]
+    )
+
+
+def load_data(
+    path: str, mode: str, limit: int = None, lazy: bool = False, columns: list = None
+):
+    """
+    Load a split of raw data, only the first `limit` rows and the given
+    `columns` are read.
+
+    lazy=False returns a DataFrame, with the label returned separately for the
+    labelled splits. lazy=True returns a LazyFrame built on scan_csv or
+    scan_parquet that keeps the label as a column.
+    """
+    if lazy:
+        if path.endswith(".parquet"):
+            df = pl.scan_parquet(path, n_rows=limit)
+        else:
+            df = pl.scan_csv(path, ignore_errors=True, n_rows=limit)
+        if columns is not None:
+            df = df.select([c for c in df.columns if c in columns])
+    else:
+        if columns is not None:
+            header = pl.read_csv(path, n_rows=0).columns
+            columns = [c for c in header if c in columns]
+        df = pl.read_csv(path, ignore_errors=True, n_rows=limit, columns=columns)
+    df = cast_raw(df)
     # Add a column "set" for split the training/validation/test data after preprocessing
     df = df.with_columns(set=pl.lit(mode))
 
-    if limit is not None:
-        df = df[:limit]
+    if lazy:
+        return df
 
-    if mode in ["train", "valid"]:
+    if mode in ["train", "valid", "valid2"]:
         # Store the label in another variable
         label = df["label"]
         # Drop the label to align with test data
@@ -29,173 +115,217 @@ def load_data(path: str, mode: str, limit: int = None):
     return df
 
 
-# Remove variables that Spearman correlation <= THRESHOLD
-def drop_columns(df: pl.DataFrame):
-    # Remove variables corr <= 0
-    df = df.drop(
-        [
-            "flbmk_conam_mean",
-            "mcc_conam_std",
-            "flbmk_conam_std",
-            "chid_conam_dev",
-            "cano_conam_dev",
-            "stscd_conam_dev",
-            "etymd_in_contp_NAs",
-            "etymd_in_flbmk_NAs",
-            "mcc_in_chid_NAs",
-            "mcc_in_cano_NAs",
-            "mcc_in_mchno_NAs",
-            "mcc_in_contp_NAs",
-            "mcc_in_mcc_NAs",
-            "mcc_in_flbmk_NAs",
-            "stocn_in_chid_NAs",
-            "stocn_in_cano_NAs",
-            "stocn_in_contp_NAs",
-            "stocn_in_flbmk_NAs",
-            "scity_in_contp_NAs",
-            "scity_in_csmcu_NAs",
-            "scity_in_flbmk_NAs",
-            "stscd_in_contp_NAs",
-            "stscd_in_etymd_NAs",
-            "stscd_in_flbmk_NAs",
-            "hcefg_in_mchno_NAs",
-            "hcefg_in_contp_NAs",
-            "hcefg_in_flbmk_NAs",
-            "csmcu_in_contp_NAs",
-            "csmcu_in_flbmk_NAs",
-            "ecfg_in_contp_1",
-            "ecfg_in_flbmk_1",
-            "insfg_in_contp_1",
-            "insfg_in_flbmk_1",
-            "bnsfg_in_contp_1",
-            "bnsfg_in_flbmk_1",
-            "ovrlt_in_mchno_1",
-            "ovrlt_in_contp_1",
-            "ovrlt_in_etymd_1",
-            "ovrlt_in_flbmk_1",
-            "flbmk_in_chid_1",
-            "flbmk_in_cano_1",
-            "flbmk_in_contp_1",
-            "flbmk_in_etymd_1",
-            "flbmk_in_flbmk_1",
-            "flg_3dsmk_in_contp_1",
-            "flg_3dsmk_in_flbmk_1",
-            "cano_span_dev",
-            "mchno_span_dev",
-        ]
-    )
+def memory_report(df: pl.DataFrame):
+    """Return the estimated memory of each column, largest first."""
+    return pl.DataFrame(
+        {
+            "column": df.columns,
+            "dtype": [str(t) for t in df.dtypes],
+            "MB": [df[c].estimated_size("mb") for c in df.columns],
+            # The memory of the column stored as a 64-bit type
+            "MB_64bit": [
+                df.height * 8 / 2**20 if t.is_numeric() else None for t in df.dtypes
+            ],
+        }
+    ).sort("MB", descending=True)
 
-    # Remove variables |corr| <= 0.01
-    df = df.drop(
-        [
-            "mchno_count",
-            "mchno_conam_mean",
-            "acqic_conam_mean",
-            "contp_conam_mean",
-            "etymd_conam_mean",
-            "mcc_conam_mean",
-            "insfg_conam_mean",
-            "flg_3dsmk_conam_mean",
-            "mchno_conam_std",
-            "contp_conam_std",
-            "etymd_conam_std",
-            "insfg_conam_std",
-            "flg_3dsmk_conam_std",
-            "etymd_in_mchno_NAs",
-            "etymd_in_etymd_NAs",
-            "etymd_in_mcc_NAs",
-            "etymd_in_insfg_NAs",
-            "etymd_in_flg_3dsmk_NAs",
-            "mcc_in_acqic_NAs",
-            "mcc_in_etymd_NAs",
-            "mcc_in_insfg_NAs",
-            "mcc_in_flg_3dsmk_NAs",
-            "stocn_in_stocn_NAs",
-            "stocn_in_insfg_NAs",
-            "stocn_in_flg_3dsmk_NAs",
-            "scity_in_mchno_NAs",
-            "scity_in_acqic_NAs",
-            "scity_in_etymd_NAs",
-            "scity_in_insfg_NAs",
-            "scity_in_flg_3dsmk_NAs",
-            "stscd_in_mchno_NAs",
-            "stscd_in_insfg_NAs",
-            "stscd_in_flg_3dsmk_NAs",
-            "hcefg_in_acqic_NAs",
-            "hcefg_in_insfg_NAs",
-            "hcefg_in_flg_3dsmk_NAs",
-            "csmcu_in_mchno_NAs",
-            "csmcu_in_acqic_NAs",
-            "csmcu_in_etymd_NAs",
-            "csmcu_in_csmcu_NAs",
-            "csmcu_in_insfg_NAs",
-            "csmcu_in_flg_3dsmk_NAs",
-            "ecfg_in_insfg_1",
-            "ecfg_in_flg_3dsmk_1",
-            "insfg_in_mchno_1",
-            "insfg_in_etymd_1",
-            "insfg_in_insfg_1",
-            "insfg_in_flg_3dsmk_1",
-            "bnsfg_in_chid_1",
-            "bnsfg_in_cano_1",
-            "bnsfg_in_mchno_1",
-            "bnsfg_in_insfg_1",
-            "bnsfg_in_flg_3dsmk_1",
-            "ovrlt_in_chid_1",
-            "ovrlt_in_cano_1",
-            "ovrlt_in_insfg_1",
-            "ovrlt_in_flg_3dsmk_1",
-            "flbmk_in_mchno_1",
-            "flbmk_in_insfg_1",
-            "flbmk_in_flg_3dsmk_1",
-            "flg_3dsmk_in_insfg_1",
-            "flg_3dsmk_in_flg_3dsmk_1",
-            "loctm_span",
-            "cano_span_mean",
-            "cano_span_std",
-            "acqic_span_dev",
-            "stocn_span_dev",
-            "scity_span_dev",
-        ]
-    )
 
+# Variables that Spearman correlation with label <= THRESHOLD, keyed by THRESHOLD
+drop_lists = {
+    # Remove variables corr <= 0
+    0: [
+        "flbmk_conam_mean",
+        "mcc_conam_std",
+        "flbmk_conam_std",
+        "chid_conam_dev",
+        "cano_conam_dev",
+        "stscd_conam_dev",
+        "etymd_in_contp_NAs",
+        "etymd_in_flbmk_NAs",
+        "mcc_in_chid_NAs",
+        "mcc_in_cano_NAs",
+        "mcc_in_mchno_NAs",
+        "mcc_in_contp_NAs",
+        "mcc_in_mcc_NAs",
+        "mcc_in_flbmk_NAs",
+        "stocn_in_chid_NAs",
+        "stocn_in_cano_NAs",
+        "stocn_in_contp_NAs",
+        "stocn_in_flbmk_NAs",
+        "scity_in_contp_NAs",
+        "scity_in_csmcu_NAs",
+        "scity_in_flbmk_NAs",
+        "stscd_in_contp_NAs",
+        "stscd_in_etymd_NAs",
+        "stscd_in_flbmk_NAs",
+        "hcefg_in_mchno_NAs",
+        "hcefg_in_contp_NAs",
+        "hcefg_in_flbmk_NAs",
+        "csmcu_in_contp_NAs",
+        "csmcu_in_flbmk_NAs",
+        "ecfg_in_contp_1",
+        "ecfg_in_flbmk_1",
+        "insfg_in_contp_1",
+        "insfg_in_flbmk_1",
+        "bnsfg_in_contp_1",
+        "bnsfg_in_flbmk_1",
+        "ovrlt_in_mchno_1",
+        "ovrlt_in_contp_1",
+        "ovrlt_in_etymd_1",
+        "ovrlt_in_flbmk_1",
+        "flbmk_in_chid_1",
+        "flbmk_in_cano_1",
+        "flbmk_in_contp_1",
+        "flbmk_in_etymd_1",
+        "flbmk_in_flbmk_1",
+        "flg_3dsmk_in_contp_1",
+        "flg_3dsmk_in_flbmk_1",
+        "cano_span_dev",
+        "mchno_span_dev",
+    ],
+    # Remove variables |corr| <= 0.01
+    0.01: [
+        "mchno_count",
+        "mchno_conam_mean",
+        "acqic_conam_mean",
+        "contp_conam_mean",
+        "etymd_conam_mean",
+        "mcc_conam_mean",
+        "insfg_conam_mean",
+        "flg_3dsmk_conam_mean",
+        "mchno_conam_std",
+        "contp_conam_std",
+        "etymd_conam_std",
+        "insfg_conam_std",
+        "flg_3dsmk_conam_std",
+        "etymd_in_mchno_NAs",
+        "etymd_in_etymd_NAs",
+        "etymd_in_mcc_NAs",
+        "etymd_in_insfg_NAs",
+        "etymd_in_flg_3dsmk_NAs",
+        "mcc_in_acqic_NAs",
+        "mcc_in_etymd_NAs",
+        "mcc_in_insfg_NAs",
+        "mcc_in_flg_3dsmk_NAs",
+        "stocn_in_stocn_NAs",
+        "stocn_in_insfg_NAs",
+        "stocn_in_flg_3dsmk_NAs",
+        "scity_in_mchno_NAs",
+        "scity_in_acqic_NAs",
+        "scity_in_etymd_NAs",
+        "scity_in_insfg_NAs",
+        "scity_in_flg_3dsmk_NAs",
+        "stscd_in_mchno_NAs",
+        "stscd_in_insfg_NAs",
+        "stscd_in_flg_3dsmk_NAs",
+        "hcefg_in_acqic_NAs",
+        "hcefg_in_insfg_NAs",
+        "hcefg_in_flg_3dsmk_NAs",
+        "csmcu_in_mchno_NAs",
+        "csmcu_in_acqic_NAs",
+        "csmcu_in_etymd_NAs",
+        "csmcu_in_csmcu_NAs",
+        "csmcu_in_insfg_NAs",
+        "csmcu_in_flg_3dsmk_NAs",
+        "ecfg_in_insfg_1",
+        "ecfg_in_flg_3dsmk_1",
+        "insfg_in_mchno_1",
+        "insfg_in_etymd_1",
+        "insfg_in_insfg_1",
+        "insfg_in_flg_3dsmk_1",
+        "bnsfg_in_chid_1",
+        "bnsfg_in_cano_1",
+        "bnsfg_in_mchno_1",
+        "bnsfg_in_insfg_1",
+        "bnsfg_in_flg_3dsmk_1",
+        "ovrlt_in_chid_1",
+        "ovrlt_in_cano_1",
+        "ovrlt_in_insfg_1",
+        "ovrlt_in_flg_3dsmk_1",
+        "flbmk_in_mchno_1",
+        "flbmk_in_insfg_1",
+        "flbmk_in_flg_3dsmk_1",
+        "flg_3dsmk_in_insfg_1",
+        "flg_3dsmk_in_flg_3dsmk_1",
+        "loctm_span",
+        "cano_span_mean",
+        "cano_span_std",
+        "acqic_span_dev",
+        "stocn_span_dev",
+        "scity_span_dev",
+    ],
     # Remove variables |corr| <= 0.02
-    df = df.drop(
-        [
-            "ovrlt_conam_mean",
-            "chid_conam_std",
-            "cano_conam_std",
-            "acqic_conam_std",
-            "ovrlt_conam_std",
-            "acqic_conam_dev",
-            "ovrlt_conam_dev",
-            "flbmk_conam_dev",
-            "etymd_in_cano_NAs",
-            "etymd_in_acqic_NAs",
-            "etymd_in_ovrlt_NAs",
-            "mcc_in_ovrlt_NAs",
-            "stocn_in_mchno_NAs",
-            "stocn_in_etymd_NAs",
-            "stocn_in_ovrlt_NAs",
-            "scity_in_chid_NAs",
-            "scity_in_cano_NAs",
-            "scity_in_ovrlt_NAs",
-            "stscd_in_ovrlt_NAs",
-            "hcefg_in_chid_NAs",
-            "hcefg_in_cano_NAs",
-            "hcefg_in_ovrlt_NAs",
-            "csmcu_in_ovrlt_NAs",
-            "ecfg_in_mchno_1",
-            "ecfg_in_ovrlt_1",
-            "insfg_in_chid_1",
-            "insfg_in_cano_1",
-            "insfg_in_ovrlt_1",
-            "bnsfg_in_etymd_1",
-            "bnsfg_in_ovrlt_1",
-            "ovrlt_in_ovrlt_1",
-            "flbmk_in_ovrlt_1",
-            "flg_3dsmk_in_mchno_1",
-            "flg_3dsmk_in_ovrlt_1",
-        ]
-    )
-    return df
+    0.02: [
+        "ovrlt_conam_mean",
+        "chid_conam_std",
+        "cano_conam_std",
+        "acqic_conam_std",
+        "ovrlt_conam_std",
+        "acqic_conam_dev",
+        "ovrlt_conam_dev",
+        "flbmk_conam_dev",
+        "etymd_in_cano_NAs",
+        "etymd_in_acqic_NAs",
+        "etymd_in_ovrlt_NAs",
+        "mcc_in_ovrlt_NAs",
+        "stocn_in_mchno_NAs",
+        "stocn_in_etymd_NAs",
+        "stocn_in_ovrlt_NAs",
+        "scity_in_chid_NAs",
+        "scity_in_cano_NAs",
+        "scity_in_ovrlt_NAs",
+        "stscd_in_ovrlt_NAs",
+        "hcefg_in_chid_NAs",
+        "hcefg_in_cano_NAs",
+        "hcefg_in_ovrlt_NAs",
+        "csmcu_in_ovrlt_NAs",
+        "ecfg_in_mchno_1",
+        "ecfg_in_ovrlt_1",
+        "insfg_in_chid_1",
+        "insfg_in_cano_1",
+        "insfg_in_ovrlt_1",
+        "bnsfg_in_etymd_1",
+        "bnsfg_in_ovrlt_1",
+        "ovrlt_in_ovrlt_1",
+        "flbmk_in_ovrlt_1",
+        "flg_3dsmk_in_mchno_1",
+        "flg_3dsmk_in_ovrlt_1",
+    ],
+}
+
+
+# Drop lists written by eda.py, used instead of the lists above when present
+drop_lists_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "drop_lists.json"
+)
+
+
+def load_drop_lists(path: str = drop_lists_path):
+    """Return the drop lists of eda.py, or the published drop_lists."""
+    if not os.path.exists(path):
+        return drop_lists
+    with open(path) as f:
+        return {float(t): cols for t, cols in json.load(f).items()}
+
+
+def load_selection(path: str):
+    """Return the features removed by the select_features.py output path."""
+    with open(path) as f:
+        return json.load(f)["dropped"]
+
+
+def excluded_columns(threshold: float = 0.02, selection: str = None):
+    """
+    Return the columns that Spearman correlation <= threshold, and the features
+    removed by the select_features.py output selection if one is given.
+    """
+    lists = load_drop_lists()
+    columns = [c for t, cols in lists.items() if t <= threshold for c in cols]
+    if selection is not None:
+        columns += load_selection(selection)
+    return list(dict.fromkeys(columns))
+
+
+# Remove variables that Spearman correlation <= THRESHOLD
+def drop_columns(df: pl.DataFrame, threshold: float = 0.02):
+    return df.drop(excluded_columns(threshold))
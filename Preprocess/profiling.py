@@ -0,0 +1,197 @@
+"""
+Profiling hooks of the pipeline steps
+
+A step is measured with:
+    with profiling.step("family_chid", df) as s:
+        df = ...
+        s.output(df)
+which records its wall time, the CPU time of the process (every thread, e.g.
+the polars and XGBoost thread pools), the peak RSS of the process while it ran
+and the rows/columns of its input and output. enable(path) switches the hooks
+on: every process writes its steps to path.parts/, the worker processes
+started afterwards inherit the switch through the PROFILE_TRACE environment
+variable, and save() merges them into path as complete events of the Chrome
+trace format (open it in chrome://tracing or https://ui.perfetto.dev). When
+off, step returns a shared no-op context and nothing is measured.
+"""
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import threading
+import time
+
+# The trace path, set by enable and inherited by the worker processes
+env_var = "PROFILE_TRACE"
+# Interval of the RSS samples, in seconds
+sample_interval = 0.01
+
+_path = None
+_owner = False
+_file = None
+_lock = threading.Lock()
+# The peak RSS of the running steps, updated by the sampler thread
+_peaks = {}
+# ru_maxrss is in KB on Linux and in bytes on macOS
+_maxrss_unit = 1 if sys.platform == "darwin" else 1024
+
+
+def _rss():
+    """Return the resident memory of the process in bytes, 0 if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _maxrss_unit
+
+
+def _sample():
+    while True:
+        rss = _rss()
+        for peak in list(_peaks.values()):
+            peak[0] = max(peak[0], rss)
+        time.sleep(sample_interval)
+
+
+def _write(event: dict):
+    # One line per event, flushed at once: the worker processes may exit
+    # without running any exit handler
+    with _lock:
+        _file.write(json.dumps(event) + "\n")
+        _file.flush()
+
+
+def _open(path: str):
+    global _path, _file
+    _path = path
+    os.makedirs(path + ".parts", exist_ok=True)
+    _file = open(os.path.join(path + ".parts", f"{os.getpid()}.jsonl"), "a")
+    name = multiprocessing.current_process().name
+    if name == "MainProcess":
+        name = os.path.basename(sys.argv[0])
+    _write(
+        {"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": name}}
+    )
+    threading.Thread(target=_sample, daemon=True).start()
+
+
+def enable(path: str):
+    """Record the steps of this process and of the workers it starts to path."""
+    global _owner
+    if _path is not None:
+        return
+    # The parts of a former run
+    shutil.rmtree(path + ".parts", ignore_errors=True)
+    os.environ[env_var] = os.path.abspath(path)
+    _owner = True
+    _open(os.path.abspath(path))
+
+
+def enabled():
+    return _path is not None
+
+
+def save():
+    """Merge the steps of every process into the trace, in the enabling process."""
+    if not _owner:
+        return
+    events = []
+    for part in sorted(glob.glob(os.path.join(_path + ".parts", "*.jsonl"))):
+        with open(part) as f:
+            events += [json.loads(line) for line in f]
+    with open(_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    shutil.rmtree(_path + ".parts")
+    steps = sum(event["ph"] == "X" for event in events)
+    print(f"Profile: {steps} steps written to {_path}")
+
+
+def shape(df):
+    """Return the rows and columns of a DataFrame, the rows of a LazyFrame are None."""
+    return getattr(df, "height", None), len(df.columns)
+
+
+class Step:
+    """A running step, output() records the rows and columns it returns."""
+
+    def __init__(self, name: str, df=None, rows=None, columns=None, **args):
+        self.name = name
+        self.args = dict(args)
+        if df is not None:
+            rows, columns = shape(df)
+        self.args.update(rows_in=rows, columns_in=columns)
+
+    def output(self, df=None, rows=None, columns=None):
+        if df is not None:
+            rows, columns = shape(df)
+        self.args.update(rows_out=rows, columns_out=columns)
+
+    def __enter__(self):
+        self.peak = [_rss()]
+        _peaks[id(self)] = self.peak
+        self.maxrss = _maxrss()
+        self.ts = time.time_ns() // 1000
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        del _peaks[id(self)]
+        # A new peak of the process is exact, a lower one is sampled
+        maxrss = _maxrss()
+        peak = max(self.peak[0], _rss(), maxrss if maxrss > self.maxrss else 0)
+        self.args.update(
+            cpu_ms=round(cpu * 1000, 3), peak_rss_mb=round(peak / 2**20, 1)
+        )
+        _write(
+            {
+                "name": self.name,
+                "ph": "X",
+                "ts": self.ts,
+                "dur": round(seconds * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.get_native_id(),
+                "args": self.args,
+            }
+        )
+        return False
+
+
+class NoStep:
+    """The step of disabled profiling, it measures nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def output(self, df=None, rows=None, columns=None):
+        pass
+
+
+_no_step = NoStep()
+
+
+def step(name: str, df=None, rows=None, columns=None, **args):
+    """
+    Return the context of a step, df (or rows and columns) is its input. The
+    shape of a LazyFrame input has no rows and resolves its schema.
+    """
+    if _path is None:
+        return _no_step
+    return Step(name, df, rows, columns, **args)
+
+
+# A worker process started by a profiled process records its own steps
+if os.environ.get(env_var):
+    _open(os.environ[env_var])
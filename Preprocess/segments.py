@@ -0,0 +1,248 @@
+"""
+Sorted segment index of the high-cardinality keys
+
+The window aggregations of add_features hash the values of a key every time
+they are grouped. For chid, cano and mchno a SegmentIndex numbers the values
+once and keeps a stable sort of the rows by value: the rows of value g are the
+contiguous segment order[offsets[g]:offsets[g + 1]] and groups[row] is the
+value of every row. Every aggregation of a key (count, conam mean/std, null
+counts, binary sums, span means) is then a gather of its column in the order
+of the index and one np.add.reduceat over the segments, the result of each
+value is scattered back to the rows with groups, no join and no hash table.
+The sums add the rows of a value in file order, not in the chunked order of
+polars: the Float64 means and stds differ from the windows of add_features in
+their last bits, the counts and sums are the same (check_segments.py compares
+them).
+
+The index is saved with save() next to the outputs with the size and mtime of
+the raw files it was built from, and reused by the next preprocess.py
+--segments run if the files and the row count are unchanged, no key is hashed
+again. The rows of the splits are kept so preprocess.py --append finds the rows of the touched values
+without scanning the former splits, and extends the index with the new split.
+"""
+import json
+import os
+
+import numpy as np
+import polars as pl
+
+# The keys with a value for almost every card or merchant
+segment_keys = ["chid", "cano", "mchno"]
+meta_name = "segments.json"
+# The output types converted by NumPy, a count or sum is a whole number
+numpy_types = {pl.Float32: np.float32, pl.UInt32: np.uint32}
+
+
+def file_stats(paths: list):
+    """Return the [path, size, mtime] of the files an index is built from."""
+    return [[p, os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in paths]
+
+
+class SegmentIndex:
+    """The rows of a key grouped by value, in file order within a value."""
+
+    def __init__(
+        self, key: str, values: pl.Series, groups: np.ndarray, order: np.ndarray
+    ):
+        self.key = key
+        # The value of every group, null is a group of its own like in .over
+        self.values = values
+        self.groups = groups
+        self.order = order
+        self.counts = np.bincount(groups, minlength=len(values))
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+
+    @classmethod
+    def build(cls, series: pl.Series):
+        """Number the values of a key column and sort its rows by value."""
+        # A local categorical numbers the values by hashing, faster than sorting
+        # the 64 character strings
+        codes = series.cast(pl.Utf8).cast(pl.Categorical).to_physical()
+        null = 0 if codes.max() is None else codes.max() + 1
+        codes = codes.fill_null(null).to_numpy().astype(np.int64)
+        # Without gaps in the numbers, a reduceat over an empty segment is wrong
+        present = np.bincount(codes) > 0
+        groups = (np.cumsum(present) - 1)[codes].astype(np.int32)
+        order = np.argsort(groups, kind="stable").astype(np.int32)
+        first = np.searchsorted(groups[order], np.arange(present.sum()))
+        return cls(series.name, series.cast(pl.Utf8)[order[first]], groups, order)
+
+    def group_ids(self, values: pl.Series):
+        """Return the group of every value, -1 for a value not in the index."""
+        known = pl.DataFrame(
+            {"value": self.values, "group": np.arange(len(self.values), dtype=np.int64)}
+        )
+        values = values.cast(pl.Utf8).alias("value")
+        groups = values.to_frame().join(known, on="value", how="left")["group"]
+        # A null value does not join, it is the null group if there is one
+        null = np.flatnonzero(self.values.is_null().to_numpy())
+        return np.where(
+            values.is_null().to_numpy(),
+            null[0] if len(null) else -1,
+            groups.fill_null(-1).to_numpy(),
+        )
+
+    def rows(self, values: pl.Series):
+        """Return the sorted rows of the values, a value not in the index has none."""
+        groups = self.group_ids(values)
+        groups = np.unique(groups[groups >= 0])
+        start = self.offsets[groups]
+        length = self.counts[groups]
+        # The segments of the groups one after the other
+        index = np.repeat(start - np.cumsum(length) + length, length) + np.arange(
+            length.sum()
+        )
+        return np.sort(self.order[index])
+
+    def extend(self, series: pl.Series):
+        """Add the rows of series after the indexed rows, new values get new groups."""
+        groups = self.group_ids(series)
+        new = groups < 0
+        if new.any():
+            index = SegmentIndex.build(series.filter(pl.Series(new)))
+            groups[new] = index.groups + len(self.values)
+            self.values = pl.concat([self.values, index.values])
+        groups = np.concatenate([self.groups, groups.astype(np.int32)])
+        # The former rows come first, their order within a group is kept
+        self.__init__(
+            self.key,
+            self.values,
+            groups,
+            np.argsort(groups, kind="stable").astype(np.int32),
+        )
+        return self
+
+    def save(self, path: str):
+        """Save the arrays and the values of the groups in the directory path."""
+        os.makedirs(path, exist_ok=True)
+        np.savez(
+            os.path.join(path, f"{self.key}.npz"), groups=self.groups, order=self.order
+        )
+        self.values.to_frame("value").write_ipc(
+            os.path.join(path, f"{self.key}_values.arrow")
+        )
+
+    @classmethod
+    def load(cls, path: str, key: str):
+        arrays = np.load(os.path.join(path, f"{key}.npz"))
+        # Not memory-mapped, the file is overwritten by save()
+        values = pl.read_ipc(
+            os.path.join(path, f"{key}_values.arrow"), memory_map=False
+        )["value"]
+        return cls(key, values, arrays["groups"], arrays["order"])
+
+
+def save_indexes(path: str, indexes: dict, splits: list, sources: list):
+    """
+    Save the indexes of the keys, the (split, rows) of their rows and the
+    file_stats of the raw files of the rows.
+    """
+    # The metadata is written last, an interrupted save leaves no index
+    if os.path.exists(os.path.join(path, meta_name)):
+        os.remove(os.path.join(path, meta_name))
+    for index in indexes.values():
+        index.save(path)
+    meta = {"splits": splits, "sources": sources, "keys": list(indexes)}
+    with open(os.path.join(path, meta_name), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def load_indexes(path: str, keys: list = segment_keys):
+    """
+    Return the saved indexes of the keys, the (split, rows) of their rows and
+    the file_stats of their raw files, no index if there are none.
+    """
+    if not os.path.exists(os.path.join(path, meta_name)):
+        return {}, [], []
+    with open(os.path.join(path, meta_name)) as f:
+        meta = json.load(f)
+    indexes = {key: SegmentIndex.load(path, key) for key in keys if key in meta["keys"]}
+    return indexes, [tuple(s) for s in meta["splits"]], meta["sources"]
+
+
+def segment_indexes(
+    df: pl.DataFrame, keys: list, path: str = None, sources: list = None
+):
+    """
+    Return the indexes of the keys of df, the rows of the raw files of sources
+    (their file_stats). The saved indexes of path are reused when they were
+    built from the same files and rows, without reading their keys.
+    """
+    saved = {}
+    if path is not None and sources is not None:
+        saved, splits, saved_sources = load_indexes(path, keys)
+        if saved_sources != sources or sum(
+            height for _, height in splits
+        ) != len(df):
+            saved = {}
+    return {key: saved.get(key) or SegmentIndex.build(df[key]) for key in keys}
+
+
+class _Column:
+    """A column in the order of an index, with the count of its values per group."""
+
+    def __init__(self, series: pl.Series, index: SegmentIndex):
+        order, starts = index.order, index.offsets[:-1]
+        if series.null_count():
+            valid = series.is_not_null().to_numpy()[order]
+            self.n = np.add.reduceat(valid.astype(np.int64), starts)
+            self.valid = valid
+        else:
+            self.n = index.counts
+            self.valid = None
+        self.series = series
+        self.index = index
+        self._values = None
+
+    def values(self):
+        """The Float64 values sorted by group, null as 0."""
+        if self._values is None:
+            values = self.series.cast(pl.Float64).fill_null(0).to_numpy()
+            self._values = values[self.index.order]
+        return self._values
+
+    def sum(self):
+        return np.add.reduceat(self.values(), self.index.offsets[:-1])
+
+
+def _reduce(stat: str, column: _Column, index: SegmentIndex):
+    """Return the statistic of every group, NaN for a null."""
+    if stat == "count":
+        # count(col) also counts the nulls
+        return index.counts
+    if stat == "null_count":
+        return index.counts - column.n
+    if stat == "sum":
+        # The sum of only nulls is 0
+        return column.sum()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = column.sum() / column.n
+        if stat == "mean":
+            return mean
+        # The two-pass variance with ddof=1, null below two values
+        deviation = column.values() - np.repeat(mean, index.counts)
+        if column.valid is not None:
+            deviation[~column.valid] = 0
+        m2 = np.add.reduceat(deviation * deviation, index.offsets[:-1])
+        return np.where(column.n > 1, np.sqrt(m2 / (column.n - 1)), np.nan)
+
+
+def segment_features(df: pl.DataFrame, features: list, index: SegmentIndex):
+    """
+    Return the keyed features over the key of index as Series, the same as
+    the windows of add_features: every column is sorted once for all its
+    statistics and each result is scattered back with one gather.
+    """
+    columns = {}
+    output = []
+    for f in features:
+        stat, col = f.agg
+        if col is not None and col not in columns:
+            columns[col] = _Column(df[col], index)
+        values = _reduce(stat, columns.get(col), index)
+        if f.dtype in numpy_types:
+            # Converted like the cast of polars, before the gather of every row
+            values = values.astype(numpy_types[f.dtype])
+        series = pl.Series(f.name, values[index.groups], nan_to_null=True)
+        output.append(series.cast(f.dtype) if f.dtype is not None else series)
+    return output
@@ -0,0 +1,83 @@
+"""
+Sequential features of each cardholder (chid) computed from the absolute "loctm"
+"""
+import polars as pl
+
+# Output types of the time features
+time_schema = {
+    "loctm": pl.Int32,
+    "last_time": pl.Int32,
+    "first_time": pl.Int32,
+    "rel_last_time": pl.Int32,
+    "neg_loctm": pl.Int32,
+    "prev_loctm": pl.Int32,
+    "loctm_span": pl.Float32,
+}
+
+
+def chid_time_exprs():
+    """Return the aggregations of the time features over the rows of a chid."""
+    return [
+        # The absolute last timestamp of buying
+        pl.max("loctm").alias("last_time"),
+        # The absolute first timestamp of buying
+        pl.min("loctm").alias("first_time"),
+        # The previous transaction, if not, set as 0
+        pl.col("loctm").diff().last().fill_null(0).alias("prev_loctm"),
+        # The transaction span, if not, set as 0
+        pl.col("loctm").diff().mean().fill_null(0).alias("loctm_span"),
+    ]
+
+
+def add_time_features(df: pl.DataFrame, prev_loctm: str = "broadcast"):
+    """
+    Add last_time, first_time, rel_last_time, neg_loctm, prev_loctm and
+    loctm_span, and make "loctm" relative to the first transaction of the chid.
+
+    prev_loctm="broadcast": the period between the last two transactions of the
+    chid (in file order), broadcast to every transaction of the chid.
+    prev_loctm="per_row": the period since the previous transaction of the same
+    chid in time order, 0 for the first transaction.
+    """
+    if prev_loctm not in ["broadcast", "per_row"]:
+        raise ValueError(f"Unknown prev_loctm mode: {prev_loctm}")
+
+    # All windows over "chid" in one context share the same groups
+    df = df.with_columns([expr.over("chid") for expr in chid_time_exprs()])
+
+    if prev_loctm == "per_row":
+        # Sort once by (chid, loctm), a transaction has a previous one only if
+        # the row above belongs to the same chid
+        df = (
+            df.with_row_count("row_nr")
+            .sort(["chid", "loctm"])
+            .with_columns(
+                pl.when(pl.col("chid").eq_missing(pl.col("chid").shift()))
+                .then(pl.col("loctm").diff())
+                .otherwise(0)
+                .fill_null(0)
+                .alias("prev_loctm")
+            )
+            .sort("row_nr")
+            .drop("row_nr")
+        )
+
+    return relative_time_features(df)
+
+
+def relative_time_features(df: pl.DataFrame):
+    """
+    Add rel_last_time and neg_loctm, make "loctm" relative and cast the time
+    features, once last_time, first_time, prev_loctm and loctm_span are added.
+    """
+    df = df.with_columns(
+        # Transform "loctm" as relative timestamp to the absolute first timestamp
+        (pl.col("loctm") - pl.col("first_time")).alias("loctm"),
+        # The relative last timestamp to the relative timestamps
+        (pl.col("last_time") - pl.col("first_time")).alias("rel_last_time"),
+        # The period between relative last timestamp to the relative timestamps
+        (pl.col("last_time") - pl.col("loctm")).alias("neg_loctm"),
+    )
+    columns = [c for c in time_schema if c != "loctm"]
+    df = df.select([c for c in df.columns if c not in columns] + columns)
+    return df.with_columns([pl.col(c).cast(t) for c, t in time_schema.items()])
@@ -0,0 +1,399 @@
+"""
+Cached pipeline of preprocess → drop_columns → train → inference
+
+Every stage is keyed by a hash of its inputs: the upstream stage keys, the
+content of the raw files, the feature spec of the stage and the code or
+arguments it runs. The artifacts of a stage are kept in a directory of
+--cache-dir named by its key, so a change only recomputes the stages
+downstream of it, e.g. a new --threshold reuses the aggregations of every key
+and a new XGBoost parameter in train.py reuses the whole preprocessing.
+    categories     the dictionary of the categorical columns of every split
+    load_{split}   load_data and prepare of each raw split
+    time           the chid time features of the concatenated splits
+    agg_{key}      the aggregations of every feature of a grouping key
+    features       join the keys, row features, drop_columns, real_*.arrow
+    train          Model/train.py, its QuantileDMatrix is built in the folds
+                   (xgboost 1.7 saves only a plain DMatrix, not a quantized one)
+    inference      Model/inference.py, submit.csv
+The least recently used entries are evicted once the cache exceeds --budget-gb.
+Run it in the data directory like the other scripts.
+"""
+import argparse
+import ast
+import glob
+import hashlib
+import inspect
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import polars as pl
+
+root = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(root, "Preprocess"))
+from categories import Categories, categories_path
+from feature_spec import (
+    add_row_features,
+    build_feature_spec,
+    join_keyed,
+    keyed_aggregations,
+    prune_spec,
+    raw_schema,
+    required_columns,
+)
+from keyed_splits import remove_keyed
+from preprocess_utils import (
+    cast_raw,
+    categorical_cols,
+    excluded_columns,
+    load_data,
+    prepare,
+    raw_splits,
+)
+from time_features import (
+    add_time_features,
+    chid_time_exprs,
+    relative_time_features,
+    time_schema,
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--cache-dir", default=".stage_cache")
+parser.add_argument(
+    "--budget-gb",
+    type=float,
+    default=50,
+    help="Size of the cache, the least recently used stages are evicted",
+)
+parser.add_argument("--threshold", type=float, default=0.02)
+parser.add_argument("--keep-all", action="store_true")
+parser.add_argument(
+    "--selection",
+    default=None,
+    help="Also drop the features removed by this Model/select_features.py output",
+)
+parser.add_argument(
+    "--prev-loctm",
+    default="broadcast",
+    choices=["broadcast", "per_row"],
+    help="prev_loctm of add_time_features, like preprocess.py",
+)
+parser.add_argument(
+    "--until",
+    default="inference",
+    choices=["features", "train", "inference"],
+    help="The last stage, its outputs are copied to the working directory",
+)
+parser.add_argument(
+    "--train-args", default="", help='Arguments of train.py, e.g. "--folds 3"'
+)
+parser.add_argument("--inference-args", default="", help="Arguments of inference.py")
+
+
+def digest(*parts):
+    """Return the hash of the JSON of parts."""
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def source(*objects):
+    """Return the hash of the source code of functions or modules."""
+    return digest([inspect.getsource(o) for o in objects])
+
+
+def script_files(path: str, found: list = None):
+    """
+    Return the script path and the modules of Model/ and Preprocess/ it imports,
+    directly or through another of them, the code a script stage runs.
+    """
+    found = [] if found is None else found
+    found.append(path)
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.append(node.module)
+    for name in names:
+        for directory in ["Model", "Preprocess"]:
+            module = os.path.join(root, directory, f"{name}.py")
+            if os.path.exists(module) and module not in found:
+                script_files(module, found)
+    return found
+
+
+class StageCache:
+    """
+    Artifacts of the stages in directories named by the stage keys. The entries
+    used by the current run are not evicted.
+    """
+
+    def __init__(self, path: str, budget: float):
+        self.path = path
+        self.budget = budget
+        self.used = set()
+        os.makedirs(path, exist_ok=True)
+
+    def file_digest(self, path: str):
+        """Return the hash of the content of a file, rehashed when it changes."""
+        index = os.path.join(self.path, "files.json")
+        files = {}
+        if os.path.exists(index):
+            with open(index) as f:
+                files = json.load(f)
+        stat = os.stat(path)
+        entry = files.get(os.path.abspath(path))
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 24), b""):
+                    h.update(block)
+            entry = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+            files[os.path.abspath(path)] = entry
+            with open(index, "w") as f:
+                json.dump(files, f)
+        return entry[2]
+
+    def run(self, stage: str, inputs: dict, produce):
+        """
+        Return the key and the directory of the artifacts of a stage, the
+        directory is filled by produce(directory) if the key is not cached.
+        """
+        # The inputs as JSON, e.g. the polars types as strings
+        inputs = json.loads(json.dumps(inputs, sort_keys=True, default=str))
+        key = f"{stage}-{digest(stage, inputs)[:24]}"
+        path = os.path.join(self.path, key)
+        self.used.add(key)
+        if os.path.exists(path):
+            # The modification time of meta.json is the last use
+            os.utime(os.path.join(path, "meta.json"))
+            print(f"{stage}: cached")
+            return key, path
+        start = time.perf_counter()
+        # Write into a temporary directory, a stage is cached once complete
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.path)
+        try:
+            produce(tmp)
+            seconds = time.perf_counter() - start
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump({"stage": stage, "inputs": inputs, "seconds": seconds}, f)
+            os.rename(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp)
+            raise
+        print(f"{stage}: computed in {seconds:.1f}s")
+        return key, path
+
+    def evict(self):
+        """Remove the least recently used entries beyond the budget."""
+        entries = []
+        for key in os.listdir(self.path):
+            path = os.path.join(self.path, key)
+            if key.startswith(".") or not os.path.isdir(path):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+            )
+            used = os.path.getmtime(os.path.join(path, "meta.json"))
+            entries.append((used, key, size))
+        total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.budget:
+                break
+            if key not in self.used:
+                shutil.rmtree(os.path.join(self.path, key))
+                total -= size
+                print(f"Evicted {key}, {size / 1e9:.2f} GB")
+        print(f"Cache: {total / 1e9:.2f} GB of {self.budget / 1e9:.2f} GB")
+
+
+def write_splits(df: pl.DataFrame, path: str):
+    """Write the splits like preprocess.py, the label is the last column."""
+    for mode in raw_splits:
+        split = df.filter(pl.col("set") == mode)
+        if mode == "test":
+            split = split.drop(["set", "label"])
+        else:
+            split = split.select(pl.exclude(["set", "label"]), pl.col("label"))
+        split.write_ipc(os.path.join(path, f"real_{mode}.arrow"))
+    # The splits are whole, the real_keyed of a former --store run is stale
+    remove_keyed(path)
+
+
+def run_script(script: str, args: str, inputs: list, path: str):
+    """Run a script of Model/ in path with links to its input files."""
+    for file in inputs:
+        os.symlink(os.path.abspath(file), os.path.join(path, os.path.basename(file)))
+    with open(os.path.join(path, "log.txt"), "w") as log:
+        subprocess.run(
+            [sys.executable, os.path.join(root, "Model", script)] + shlex.split(args),
+            cwd=path,
+            stdout=log,
+            check=True,
+        )
+    for file in inputs:
+        os.remove(os.path.join(path, os.path.basename(file)))
+    with open(os.path.join(path, "log.txt")) as log:
+        print(log.read(), end="")
+
+
+def copy_outputs(path: str, pattern: str):
+    """Copy the outputs of a stage to the working directory."""
+    for file in glob.glob(os.path.join(path, pattern)):
+        # A copy, a later write to the output must not change the cache
+        shutil.copyfile(file, os.path.basename(file))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    cache = StageCache(args.cache_dir, args.budget_gb * 1e9)
+
+    full_spec = build_feature_spec()
+    exclude = set()
+    if not args.keep_all:
+        exclude = set(excluded_columns(args.threshold, args.selection))
+    spec = prune_spec(full_spec, exclude)
+    columns = required_columns(spec)
+
+    # The codes of the categorical columns of every split, numbered from scratch
+    # so the key only depends on the raw files
+    def produce(path):
+        df = [
+            load_data(path=raw, mode=mode, lazy=True, columns=categorical_cols)
+            for mode, raw in raw_splits.items()
+        ]
+        categories = Categories(categorical_cols).update(pl.concat(df, how="diagonal"))
+        categories.save(os.path.join(path, categories_path))
+
+    inputs = {
+        "files": [cache.file_digest(raw) for raw in raw_splits.values()],
+        "code": source(Categories, cast_raw, load_data),
+        "schema": [raw_schema, categorical_cols],
+    }
+    categories_key, categories_dir = cache.run("categories", inputs, produce)
+    categories_file = os.path.join(categories_dir, categories_path)
+    categories = Categories.load(categories_file)
+
+    loads = []
+    for mode, raw in raw_splits.items():
+        inputs = {
+            "file": cache.file_digest(raw),
+            "categories": categories_key,
+            "columns": sorted(columns),
+            "code": source(cast_raw, prepare, load_data),
+            "schema": [raw_schema, categorical_cols],
+        }
+
+        def produce(path, raw=raw, mode=mode):
+            df = load_data(path=raw, mode=mode, lazy=True, columns=columns)
+            df = prepare(df, categories).collect()
+            df.write_ipc(os.path.join(path, "rows.arrow"))
+
+        loads.append(cache.run(f"load_{mode}", inputs, produce))
+
+    def produce(path):
+        df = [pl.read_ipc(os.path.join(p, "rows.arrow")) for _, p in loads]
+        df = pl.concat(df, how="diagonal")
+        df = add_time_features(df, prev_loctm=args.prev_loctm)
+        df.write_ipc(os.path.join(path, "rows.arrow"))
+
+    inputs = {
+        "loads": [key for key, _ in loads],
+        "prev_loctm": args.prev_loctm,
+        "code": source(chid_time_exprs, add_time_features, relative_time_features),
+        "schema": time_schema,
+    }
+    time_key, time_path = cache.run("time", inputs, produce)
+    rows = pl.read_ipc(os.path.join(time_path, "rows.arrow"), memory_map=True)
+
+    # Every feature of a key is aggregated, whatever the threshold, so another
+    # threshold reuses the aggregations
+    aggregations = {}
+    for key in dict.fromkeys(f.key for f in spec if f.key is not None):
+        exprs, dtypes = keyed_aggregations(full_spec, key)
+
+        def produce(path, key=key, exprs=exprs, dtypes=dtypes):
+            df = rows.group_by(key).agg(exprs)
+            df = df.with_columns([pl.col(c).cast(t) for c, t in dtypes.items()])
+            df.write_ipc(os.path.join(path, "agg.arrow"))
+
+        inputs = {
+            "time": time_key,
+            "exprs": [str(e) for e in exprs],
+            "dtypes": dtypes,
+        }
+        aggregations[key] = cache.run(f"agg_{key}", inputs, produce)
+
+    def produce(path):
+        df = rows
+        for key, (_, agg_path) in aggregations.items():
+            agg = pl.read_ipc(os.path.join(agg_path, "agg.arrow"))
+            df = join_keyed(df, agg, key)
+        write_splits(add_row_features(df, spec, rows.columns, exclude), path)
+
+    inputs = {
+        "time": time_key,
+        "aggregations": [key for key, _ in aggregations.values()],
+        "exclude": sorted(exclude),
+        "row_features": [(f.name, str(f.expr)) for f in spec if f.key is None],
+        "code": source(join_keyed, add_row_features, prune_spec, write_splits),
+    }
+    features_key, features_path = cache.run("features", inputs, produce)
+    if args.until == "features":
+        copy_outputs(features_path, "real_*.arrow")
+        remove_keyed()
+    # The codes of real_*.arrow, for train.py, inference.py and serve.py
+    copy_outputs(categories_dir, categories_path)
+
+    if args.until in ["train", "inference"]:
+        arrows = [os.path.join(features_path, f"real_{m}.arrow") for m in raw_splits]
+        # train.py and every local module it imports
+        train_code = script_files(os.path.join(root, "Model", "train.py"))
+        inputs = {
+            "features": features_key,
+            "args": args.train_args,
+            "code": [cache.file_digest(p) for p in sorted(train_code)],
+        }
+        train_key, train_path = cache.run(
+            "train",
+            inputs,
+            lambda path: run_script(
+                "train.py", args.train_args, arrows[:2] + [categories_file], path
+            ),
+        )
+        if args.until == "train":
+            for model in glob.glob("xgb_fold*.json"):
+                os.remove(model)
+            copy_outputs(train_path, "xgb_fold*.json")
+
+    if args.until == "inference":
+        sample = "31_範例繳交檔案.csv"
+        inference_code = script_files(os.path.join(root, "Model", "inference.py"))
+        models = sorted(glob.glob(os.path.join(train_path, "xgb_fold*.json")))
+        inputs = {
+            "features": features_key,
+            "train": train_key,
+            "args": args.inference_args,
+            "sample": cache.file_digest(sample),
+            "code": [cache.file_digest(p) for p in sorted(inference_code)],
+        }
+        _, inference_path = cache.run(
+            "inference",
+            inputs,
+            lambda path: run_script(
+                "inference.py",
+                args.inference_args,
+                arrows + [categories_file] + models + [sample],
+                path,
+            ),
+        )
+        copy_outputs(inference_path, "submit.csv")
+
+    cache.evict()